@@ -5,12 +5,14 @@ import bjoern
 import falcon
 from falcon_cors import CORS
 
+from .middleware import CompressionMiddleware
 from .routes import routes
 from .routes import version
 
 
 cors = CORS(allow_all_origins=True)
-api = application = falcon.App(middleware=[cors.middleware])
+api = application = falcon.App(
+    middleware=[cors.middleware, CompressionMiddleware()])
 
 r = routes()
 for route in r:
@@ -1,7 +1,15 @@
+import bisect
 import configparser
 import datetime
+import hashlib
+import io
+import ipaddress
 import json
 import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 import falcon
@@ -9,9 +17,188 @@ import httpx
 from poseidon_core.constants import NO_DATA
 
 from .__init__ import __version__
+from .middleware import accepted_encoding
+from .middleware import encoded_etag
 from .routes import paths
 from .routes import version
 
+# last value of each series exported by Poseidon, within PROM_LOOKBACK.
+PROM_QUERIES = {
+    'metadata': 'poseidon_endpoint_metadata',
+    'top': 'poseidon_role_confidence_top',
+    'second': 'poseidon_role_confidence_second',
+    'third': 'poseidon_role_confidence_third'}
+PROM_LOOKBACK = '6h'
+PROM_TIMEOUT = 10
+# seconds scrape results are shared between requests (override with PROM_CACHE_TTL).
+PROM_CACHE_TTL = 5
+PROM_EXECUTOR = ThreadPoolExecutor(
+    max_workers=len(PROM_QUERIES), thread_name_prefix='prometheus')
+_prom_client = None
+
+
+def get_prom_client():
+    global _prom_client
+    if _prom_client is None:
+        _prom_client = httpx.Client(timeout=PROM_TIMEOUT)
+    return _prom_client
+
+
+def prom_instant_query(client, prometheus_addr, metric):
+    payload = {'query': f'last_over_time({metric}[{PROM_LOOKBACK}])'}
+    response = client.get('http://'+prometheus_addr +
+                          '/api/v1/query', params=payload)
+    response.raise_for_status()
+    return response.json().get('data', {}).get('result', [])
+
+
+class ResponseCache:
+    '''
+    Short lived cache of values shared across requests. Only one caller
+    fetches a missing or expired value (single flight), while concurrent
+    callers for the same key wait for its result. Failures are not cached.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (expiry, value)
+        self.values = {}
+        # key -> threading.Event set when the in flight fetch completes.
+        self.in_flight = {}
+
+    def get(self, key, fetch, ttl):
+        while True:
+            with self.lock:
+                cached = self.values.get(key, None)
+                if cached is not None and cached[0] > time.monotonic():
+                    return cached[1]
+                done = self.in_flight.get(key, None)
+                if done is None:
+                    done = threading.Event()
+                    self.in_flight[key] = done
+                    break
+            # another caller is fetching, use its result (or retry if it failed).
+            done.wait()
+        try:
+            value = fetch()
+            with self.lock:
+                self.values[key] = (time.monotonic() + ttl, value)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
+
+
+PROM_CACHE = ResponseCache()
+# fields key -> (scrape result, NodeIndex built from it)
+_node_indexes = {}
+
+COMPACT_JSON = json.JSONEncoder(separators=(',', ':'))
+# size of the blocks of JSON streamed in responses.
+STREAM_CHUNK_SIZE = 65536
+
+
+def stream_dataset(nodes, fields, extra=None, chunk_size=STREAM_CHUNK_SIZE):
+    ''' yield {"dataset": [nodes projected to fields], **extra} as blocks of compact JSON. '''
+    chunk = io.StringIO()
+    chunk.write('{"dataset":[')
+    separator = ''
+    for node in nodes:
+        chunk.write(separator)
+        chunk.write(COMPACT_JSON.encode(
+            {field: node[field] for field in fields}))
+        separator = ','
+        if chunk.tell() >= chunk_size:
+            yield chunk.getvalue().encode('utf-8')
+            chunk = io.StringIO()
+    chunk.write(']')
+    if extra:
+        for key, value in extra.items():
+            chunk.write(',' + COMPACT_JSON.encode(key) +
+                        ':' + COMPACT_JSON.encode(value))
+    chunk.write('}')
+    yield chunk.getvalue().encode('utf-8')
+
+
+class NodeIndex:
+    '''
+    Nodes in hash_id order, indexed by the fields they can be filtered on,
+    so requests can be filtered and paged (by hash_id cursor) without
+    scanning every node.
+    '''
+
+    # filter parameter -> node fields it matches (any of).
+    FILTERS = {
+        'state': ('state',),
+        'role': ('top_role',),
+        'segment': ('segment',),
+        'tenant': ('tenant',),
+        'ip': ('ipv4_address', 'ipv6_address')}
+    SUBNET_FIELDS = ('ipv4_subnet', 'ipv6_subnet')
+
+    def __init__(self, nodes):
+        self.nodes = sorted(nodes, key=lambda node: str(node['hash_id']))
+        self.hash_ids = [str(node['hash_id']) for node in self.nodes]
+        # field -> value -> positions of nodes with that value, ascending.
+        self.index = defaultdict(lambda: defaultdict(list))
+        indexed_fields = set(self.SUBNET_FIELDS).union(*self.FILTERS.values())
+        # content version, for ETags.
+        version = hashlib.sha1()
+        for position, node in enumerate(self.nodes):
+            version.update(repr(tuple(node.items())).encode('utf-8'))
+            for field in indexed_fields:
+                if field in node:
+                    self.index[field][str(node[field])].append(position)
+        self.version = version.hexdigest()
+        # when the content last changed, for Last-Modified.
+        self.modified = int(time.time())
+
+    def subnet_positions(self, subnet):
+        ''' return positions of nodes with a subnet within subnet (raises ValueError if invalid). '''
+        network = ipaddress.ip_network(subnet, strict=False)
+        positions = set()
+        for field in self.SUBNET_FIELDS:
+            for value, value_positions in self.index[field].items():
+                try:
+                    node_network = ipaddress.ip_network(value, strict=False)
+                except ValueError:
+                    continue
+                if node_network.version == network.version and node_network.subnet_of(network):
+                    positions.update(value_positions)
+        return positions
+
+    def select(self, filters):
+        ''' return positions of the nodes matching all filters (filter parameter -> value), ascending. '''
+        selected = None
+        for name, value in filters.items():
+            if name == 'subnet':
+                positions = self.subnet_positions(value)
+            else:
+                positions = set()
+                for field in self.FILTERS[name]:
+                    positions.update(self.index[field].get(value, ()))
+            selected = positions if selected is None else selected & positions
+            if not selected:
+                return []
+        if selected is None:
+            return range(len(self.nodes))
+        return sorted(selected)
+
+    def page(self, positions, cursor=None, limit=None):
+        ''' return nodes at positions after the cursor hash_id, up to limit, and the cursor for the next page if any. '''
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_left(
+                positions, bisect.bisect_right(self.hash_ids, cursor))
+        end = len(positions)
+        if limit is not None:
+            end = min(start + limit, end)
+        next_cursor = None
+        if end < len(positions):
+            next_cursor = self.hash_ids[positions[end - 1]]
+        return [self.nodes[position] for position in positions[start:end]], next_cursor
+
 
 class Endpoints:
 
@@ -35,6 +222,127 @@ class Info:
         resp.status = falcon.HTTP_200
 
 
+class EndpointReplica:
+    '''
+    In memory replica of the endpoints Poseidon publishes to its endpoint
+    feed (a snapshot file plus a log of deltas, see poseidon_core's
+    FileEndpointFeed), refreshed by applying new deltas on each read.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.deltas_path = path + '.deltas'
+        self.lock = threading.Lock()
+        self.snapshot_id = None
+        self.seq = 0
+        # offset in the deltas file of the next delta to apply.
+        self.offset = 0
+        # name -> Endpoint.encode() record
+        self.endpoints = {}
+        # replaced whenever endpoints change, so readers can tell if their copy is current.
+        self.version = None
+
+    def _load_snapshot(self, snapshot_id):
+        with open(self.path, 'r') as f:
+            header = json.loads(f.readline())
+            if header['snapshot'] != snapshot_id:
+                # a new snapshot is being published, use it once its deltas are.
+                return False
+            endpoints = {}
+            for line in f:
+                record = json.loads(line)
+                endpoints[record['name']] = record
+        self.endpoints = endpoints
+        self.snapshot_id = snapshot_id
+        self.seq = header['seq']
+        return True
+
+    def _apply_deltas(self, data):
+        for line in data.splitlines():
+            delta = json.loads(line)
+            for name in delta['removed']:
+                self.endpoints.pop(name, None)
+            for record in delta['put']:
+                self.endpoints[record['name']] = record
+            self.seq = delta['seq']
+
+    def refresh(self):
+        ''' apply any new snapshot or deltas, and return True if the replica has endpoints to serve. '''
+        changed = False
+        try:
+            with open(self.deltas_path, 'rb') as deltas:
+                snapshot_id = json.loads(deltas.readline())['snapshot']
+                if snapshot_id != self.snapshot_id:
+                    if not self._load_snapshot(snapshot_id):
+                        return self.snapshot_id is not None
+                    self.offset = deltas.tell()
+                    changed = True
+                deltas.seek(self.offset)
+                data = deltas.read()
+            # only apply complete deltas.
+            end = data.rfind(b'\n') + 1
+            if end:
+                self._apply_deltas(data[:end].decode('utf-8'))
+                self.offset += end
+                changed = True
+        except (OSError, ValueError, KeyError) as e:
+            if self.snapshot_id is not None:
+                print(f'Unable to read endpoint feed {self.path} because: {e}')
+        if changed:
+            self.version = (self.snapshot_id, self.seq)
+        return self.snapshot_id is not None
+
+    def read(self):
+        ''' return (version, endpoint records) if the replica has endpoints to serve, else (None, None). '''
+        with self.lock:
+            if not self.refresh():
+                return None, None
+            return self.version, list(self.endpoints.values())
+
+
+_endpoint_replicas = {}
+
+
+def get_endpoint_replica(path):
+    replica = _endpoint_replicas.get(path, None)
+    if replica is None:
+        replica = EndpointReplica(path)
+        _endpoint_replicas[path] = replica
+    return replica
+
+
+def record_node(node, record):
+    ''' fill in a node's fields from an endpoint feed record (Endpoint.encode()). '''
+    endpoint_data = record.get('endpoint_data', None) or {}
+    metadata = record.get('metadata', None) or {}
+    values = {
+        'hash_id': record['name'],
+        'state': record.get('state', None),
+        'next_state': record.get('p_next_state', None),
+        'prev_state': record.get('p_prev_state', None),
+        'ignore': str(record.get('ignore', False)),
+        'acls': str(record.get('acl_data', [])),
+        'ipv4_address': endpoint_data.get('ipv4', None),
+        'ipv6_address': endpoint_data.get('ipv6', None)}
+    for field in ('mac', 'tenant', 'segment', 'port', 'ipv4_subnet', 'ipv6_subnet',
+                  'ipv4_rdns', 'ipv6_rdns', 'ether_vendor', 'controller_type'):
+        values[field] = endpoint_data.get(field, None)
+    for mac_metadata in metadata.get('mac_addresses', {}).values():
+        classification = mac_metadata.get('classification', {})
+        if classification.get('labels', None):
+            values['top_role'] = classification['labels'][0]
+        if classification.get('confidences', None):
+            values['top_confidence'] = classification['confidences'][0]
+    for version in ('ipv4', 'ipv6'):
+        ip_metadata = metadata.get(version + '_addresses', {}).get(
+            endpoint_data.get(version, None), {})
+        values[version + '_os'] = ip_metadata.get('short_os', None)
+    for field, value in values.items():
+        if field in node and value is not None:
+            node[field] = value
+    return node
+
+
 class Nodes:
 
     def __init__(self, fields, ip=None):
@@ -43,6 +351,7 @@ class Nodes:
         self.ip = ip
         self.r = None
         self.prometheus_addr = os.environ.get('PROM_ADDR', 'prometheus:9090')
+        self.feed_path = os.environ.get('ENDPOINT_FEED_FILE', None)
         for field in fields:
             self.node[field] = fields[field]
 
@@ -59,95 +368,66 @@ class Nodes:
                     prometheus_ip = config['Poseidon']['prometheus_ip']
                 if 'prometheus_port' in config['Poseidon']:
                     prometheus_port = config['Poseidon']['prometheus_port']
+                if self.feed_path is None and 'endpoint_feed_file' in config['Poseidon']:
+                    self.feed_path = config['Poseidon']['endpoint_feed_file'].strip(
+                        "'") or None
         except Exception as e:
             print(f'Failed to get config options because {e}, using defaults')
         if prometheus_ip and prometheus_port:
             self.prometheus_addr = prometheus_ip + ':' + prometheus_port
 
+    def query_prometheus(self):
+        ''' run the instant queries concurrently, raising if any fails. '''
+        client = get_prom_client()
+        futures = {
+            name: PROM_EXECUTOR.submit(
+                prom_instant_query, client, self.prometheus_addr, metric)
+            for name, metric in PROM_QUERIES.items()}
+        return self.parse_prometheus(
+            {name: future.result() for name, future in futures.items()})
+
+    @staticmethod
+    def parse_prometheus(results):
+        role_hashes = {}
+        hashes = {}
+        for metric in results['top']:
+            if not metric['metric']['hash_id'] in role_hashes:
+                role_hashes[metric['metric']['hash_id']] = {'mac': metric['metric']['mac'],
+                                                            'ipv4_address': metric['metric'].get('ipv4_address', ''),
+                                                            'ipv4_os': metric['metric'].get('ipv4_os', NO_DATA),
+                                                            'timestamp': str(metric['value'][0]),
+                                                            'top_role': metric['metric'].get('role', NO_DATA),
+                                                            'top_confidence': float(metric['value'][1])}
+        for rank in ('second', 'third'):
+            for metric in results[rank]:
+                if metric['metric']['hash_id'] in role_hashes:
+                    role_hashes[metric['metric']['hash_id']][rank + '_role'] = metric['metric'].get(
+                        'role', NO_DATA)
+                    role_hashes[metric['metric']['hash_id']][rank + '_confidence'] = float(
+                        metric['value'][1])
+        for metric in results['metadata']:
+            hash_id = metric['metric']['hash_id']
+            latest = float(metric['value'][1])
+            if hash_id not in hashes or latest > hashes[hash_id]['latest']:
+                hashes[hash_id] = dict(metric['metric'], latest=latest)
+        return role_hashes, hashes
+
     def scrape_prometheus(self):
         self.get_prom_addr()
-        r1 = None
-        r2 = None
-        r3 = None
-        mr = None
-        current_time = datetime.datetime.utcnow()
-        # 6 hours in the past and 2 hours in the future
-        start_time = current_time - datetime.timedelta(hours=6)
-        end_time = current_time + datetime.timedelta(hours=2)
-        start_time_str = start_time.isoformat()[:-4]+'Z'
-        end_time_str = end_time.isoformat()[:-4]+'Z'
+        ttl = float(os.environ.get('PROM_CACHE_TTL', PROM_CACHE_TTL))
         try:
-            payload = {'query': 'poseidon_endpoint_metadata',
-                       'start': start_time_str, 'end': end_time_str, 'step': '30s'}
-            mr = httpx.get('http://'+self.prometheus_addr +
-                           '/api/v1/query_range', params=payload)
-            payload = {'query': 'poseidon_role_confidence_top',
-                       'start': start_time_str, 'end': end_time_str, 'step': '30s'}
-            r1 = httpx.get('http://'+self.prometheus_addr +
-                           '/api/v1/query_range', params=payload)
-            payload = {'query': 'poseidon_role_confidence_second',
-                       'start': start_time_str, 'end': end_time_str, 'step': '30s'}
-            r2 = httpx.get('http://'+self.prometheus_addr +
-                           '/api/v1/query_range', params=payload)
-            payload = {'query': 'poseidon_role_confidence_third',
-                       'start': start_time_str, 'end': end_time_str, 'step': '30s'}
-            r3 = httpx.get('http://'+self.prometheus_addr +
-                           '/api/v1/query_range', params=payload)
+            return PROM_CACHE.get(self.prometheus_addr, self.query_prometheus, ttl)
         except Exception as e:
             print(f'Unable to get endpoints from Prometheus because: {e}')
-        role_hashes = {}
-        hashes = {}
-        if r1:
-            results = r1.json()
-            if 'result' in results['data'] and results['data']['result']:
-                for metric in results['data']['result']:
-                    if not metric['metric']['hash_id'] in role_hashes:
-                        role_hashes[metric['metric']['hash_id']] = {'mac': metric['metric']['mac'],
-                                                                    'ipv4_address': metric['metric'].get('ipv4_address', ''),
-                                                                    'ipv4_os': metric['metric'].get('ipv4_os', NO_DATA),
-                                                                    'timestamp': str(metric['values'][-1][0]),
-                                                                    'top_role': metric['metric'].get('role', NO_DATA),
-                                                                    'top_confidence': float(metric['values'][-1][1])}
-        if r2:
-            results = r2.json()
-            if 'data' in results:
-                if 'result' in results['data'] and results['data']['result']:
-                    for metric in results['data']['result']:
-                        if metric['metric']['hash_id'] in role_hashes:
-                            role_hashes[metric['metric']['hash_id']]['second_role'] = metric['metric'].get(
-                                'role', NO_DATA)
-                            role_hashes[metric['metric']['hash_id']]['second_confidence'] = float(
-                                metric['values'][-1][1])
-        if r3:
-            results = r3.json()
-            if 'data' in results:
-                if 'result' in results['data'] and results['data']['result']:
-                    for metric in results['data']['result']:
-                        if metric['metric']['hash_id'] in role_hashes:
-                            role_hashes[metric['metric']['hash_id']]['third_role'] = metric['metric'].get(
-                                'role', NO_DATA)
-                            role_hashes[metric['metric']['hash_id']]['third_confidence'] = float(
-                                metric['values'][-1][1])
-        if mr:
-            results = mr.json()
-            if 'data' in results:
-                if 'result' in results['data'] and results['data']['result']:
-                    for metric in results['data']['result']:
-                        if metric['metric']['hash_id'] in hashes:
-                            if float(metric['values'][-1][1]) > hashes[metric['metric']['hash_id']]['latest']:
-                                hashes[metric['metric']['hash_id']
-                                       ] = metric['metric']
-                                hashes[metric['metric']['hash_id']]['latest'] = float(
-                                    metric['values'][-1][1])
-                        else:
-                            hashes[metric['metric']['hash_id']
-                                   ] = metric['metric']
-                            hashes[metric['metric']['hash_id']]['latest'] = float(
-                                metric['values'][-1][1])
-        return role_hashes, hashes
-
-    def build_nodes(self):
-        role_hashes, hashes = self.scrape_prometheus()
+        return {}, {}
+
+    def build_nodes(self, scrape=None):
+        if scrape is None:
+            scrape, records = self.get_source()
+            if records is not None:
+                self.build_replica_nodes(records)
+                return
+        role_hashes, hashes = scrape
         for h in hashes:
             node = deepcopy(self.node)
             for field in hashes[h]:
@@ -157,7 +437,114 @@ class Nodes:
                 for field in role_hashes[h]:
                     if field in node:
                         node[field] = role_hashes[h][field]
-            self.nodes.append(node)
+            self.add_node(node)
+
+    def add_node(self, node):
+        if self.ip and self.ip not in (node.get('ipv4_address', None), node.get('ipv6_address', None)):
+            return
+        self.nodes.append(node)
+
+    def build_replica_nodes(self, records):
+        for record in records:
+            self.add_node(record_node(deepcopy(self.node), record))
+
+    def get_source(self):
+        '''
+        return the endpoint feed replica's (version, records) if Poseidon
+        publishes one, else (the Prometheus scrape result, None).
+        '''
+        self.get_prom_addr()
+        if self.feed_path:
+            version, records = get_endpoint_replica(self.feed_path).read()
+            if version is not None:
+                return version, records
+        return self.scrape_prometheus(), None
+
+    def get_index(self):
+        ''' return a NodeIndex of all nodes, rebuilt only when the source data changes. '''
+        source, records = self.get_source()
+        key = tuple(self.node)
+        cached = _node_indexes.get(key, None)
+        if cached is not None and cached[0] is source:
+            return cached[1]
+        self.nodes = []
+        if records is not None:
+            self.build_replica_nodes(records)
+        else:
+            self.build_nodes(source)
+        index = NodeIndex(self.nodes)
+        if cached is not None and cached[1].version == index.version:
+            index.modified = cached[1].modified
+        _node_indexes[key] = (source, index)
+        return index
+
+
+def not_modified(req, etag, modified):
+    ''' return True if the client's copy is current, per If-None-Match (or failing that, If-Modified-Since). '''
+    if req.if_none_match is not None:
+        return any(tag in ('*', etag) for tag in req.if_none_match)
+    since = req.if_modified_since
+    if since is not None:
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return modified <= since.timestamp()
+    return False
+
+
+def network_response(req, resp, all_fields, ip=None, configuration=None):
+    '''
+    stream nodes with all_fields (or the fields parameter) as compact JSON,
+    filtered by the NodeIndex.FILTERS and subnet parameters (and ip, if
+    given), and paged by the limit and cursor parameters.
+    '''
+    # accept fields=a,b as well as fields=a&fields=b.
+    fields = [
+        field for value in req.get_param_as_list('fields', default=[])
+        for field in value.split(',') if field] or list(all_fields)
+    unknown_fields = set(fields) - set(all_fields)
+    if unknown_fields:
+        raise falcon.HTTPBadRequest(
+            title='Unknown fields', description=', '.join(sorted(unknown_fields)))
+    limit = req.get_param_as_int('limit', min_value=1)
+    cursor = req.get_param('cursor')
+    filters = {}
+    for name in list(NodeIndex.FILTERS) + ['subnet']:
+        value = req.get_param(name)
+        if value is not None:
+            filters[name] = value
+    if ip is not None:
+        filters['ip'] = ip
+    index = Nodes(all_fields).get_index()
+    try:
+        positions = index.select(filters)
+    except ValueError as e:
+        raise falcon.HTTPBadRequest(title='Invalid subnet', description=str(e))
+    # the response depends on the content version and on the request (path and parameters).
+    etag = hashlib.sha1(
+        f'{index.version} {req.relative_uri}'.encode('utf-8')).hexdigest()
+    resp.etag = etag
+    resp.last_modified = datetime.datetime.fromtimestamp(
+        index.modified, datetime.timezone.utc)
+    # the response is streamed, so CompressionMiddleware compresses it whenever
+    # the client accepts that, and suffixes the ETag with the encoding.
+    encoding = accepted_encoding(req.get_header('Accept-Encoding', default=''))
+    if encoding is not None:
+        etag = encoded_etag(etag, encoding)
+    if not_modified(req, etag, index.modified):
+        resp.etag = etag
+        resp.status = falcon.HTTP_304
+        return
+    nodes, next_cursor = index.page(positions, cursor, limit)
+    extra = {}
+    if configuration is not None:
+        extra['configuration'] = {'fields': [
+            field_config for field_config in configuration['fields']
+            if field_config['path'][0] in fields]}
+    if limit is not None:
+        extra['next_cursor'] = next_cursor
+    resp.stream = stream_dataset(nodes, fields, extra)
+    resp.content_type = falcon.MEDIA_JSON
+    resp.status = falcon.HTTP_200
 
 
 class NetworkFull:
@@ -182,14 +569,8 @@ class NetworkFull:
         return n.nodes
 
     @staticmethod
-    def on_get(_req, resp):
-        network = {}
-        dataset = NetworkFull.get_dataset()
-        network['dataset'] = dataset
-
-        resp.text = json.dumps(network, indent=2)
-        resp.content_type = falcon.MEDIA_JSON
-        resp.status = falcon.HTTP_200
+    def on_get(req, resp):
+        network_response(req, resp, NetworkFull.get_fields())
 
 
 class Network:
@@ -237,16 +618,9 @@ class Network:
         return configuration
 
     @staticmethod
-    def on_get(_req, resp):
-        network = {}
-        dataset = Network.get_dataset()
-        configuration = Network.get_configuration()
-
-        network['dataset'] = dataset
-        network['configuration'] = configuration
-        resp.text = json.dumps(network, indent=2)
-        resp.content_type = falcon.MEDIA_JSON
-        resp.status = falcon.HTTP_200
+    def on_get(req, resp):
+        network_response(req, resp, Network.get_fields(),
+                         configuration=Network.get_configuration())
 
 
 class NetworkByIp:
@@ -267,13 +641,6 @@ class NetworkByIp:
         return configuration
 
     @staticmethod
-    def on_get(_req, resp, ip):
-        network = {}
-        dataset = NetworkByIp.get_dataset(ip)
-        configuration = NetworkByIp.get_configuration()
-
-        network['dataset'] = dataset
-        network['configuration'] = configuration
-        resp.text = json.dumps(network, indent=2)
-        resp.content_type = falcon.MEDIA_JSON
-        resp.status = falcon.HTTP_200
+    def on_get(req, resp, ip):
+        network_response(req, resp, Network.get_fields(), ip=ip,
+                         configuration=NetworkByIp.get_configuration())
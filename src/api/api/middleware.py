@@ -0,0 +1,75 @@
+import zlib
+
+# only compress bodies at least this big (bytes), streamed bodies are always compressed.
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+# Content-Encoding -> zlib wbits, in order of preference.
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+STREAM_READ_SIZE = 65536
+
+
+def accepted_encoding(accept_encoding):
+    ''' return the preferred encoding in ENCODINGS allowed by an Accept-Encoding header, or None. '''
+    accepted = set()
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def encoded_etag(etag, encoding):
+    ''' return the (unquoted) ETag of the representation of etag with a content-coding, which needs its own validator. '''
+    return f'{etag}-{encoding}'
+
+
+def compress_stream(stream, compressor):
+    if hasattr(stream, 'read'):
+        stream = iter(lambda: stream.read(STREAM_READ_SIZE), b'')
+    for chunk in stream:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class CompressionMiddleware:
+    '''
+    gzip or deflate response bodies (streamed, or at least COMPRESS_MIN_SIZE
+    bytes) for clients that accept it. A compressed response's ETag is
+    suffixed with its encoding (see encoded_etag()), so it differs from the
+    identity response's.
+    '''
+
+    def process_response(self, req, resp, _resource, req_succeeded):
+        if not req_succeeded or req.method == 'HEAD':
+            return
+        resp.vary = ('Accept-Encoding',)
+        if resp.get_header('Content-Encoding'):
+            return
+        encoding = accepted_encoding(req.get_header('Accept-Encoding', default=''))
+        if encoding is None:
+            return
+        compressor = zlib.compressobj(
+            COMPRESS_LEVEL, zlib.DEFLATED, ENCODINGS[encoding])
+        if resp.stream is not None:
+            resp.stream = compress_stream(resp.stream, compressor)
+        else:
+            body = resp.render_body()
+            if body is None or len(body) < COMPRESS_MIN_SIZE:
+                return
+            resp.text = None
+            resp.data = compressor.compress(body) + compressor.flush()
+        resp.set_header('Content-Encoding', encoding)
+        etag = resp.get_header('ETag')
+        if etag and etag.endswith('"'):
+            resp.set_header('ETag', '{0}"'.format(encoded_etag(etag[:-1], encoding)))
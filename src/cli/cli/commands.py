@@ -27,7 +27,8 @@ class Commands:
             self.config = Config().get_config()
         prom = Prometheus()
         self.sdnc = SDNConnect(self.config, logger, prom,
-                               faucetconfgetsetter_cl=faucetconfgetsetter_cl)
+                               faucetconfgetsetter_cl=faucetconfgetsetter_cl,
+                               read_only=True)
 
     def _publish_action(self, address, payload):
         if payload:
@@ -35,8 +36,8 @@ class Commands:
 
     def _get_endpoints(self, args, idx, match_all=False):
         ''' get endpoints that match '''
-        self.sdnc.get_stored_endpoints()
         device = args.rsplit(' ', 1)[idx]
+        self.sdnc.get_stored_endpoints(key=device)
         endpoints = {}
         for match_func in (
                 self.sdnc.endpoint_by_name,
@@ -55,9 +56,8 @@ class Commands:
         return endpoints.values()
 
     def _ignored_endpoints(self):
-        return [
-            endpoint for endpoint in self.sdnc.endpoints.values()
-            if endpoint.ignore]
+        self.sdnc.get_stored_endpoints(ignored=True)
+        return self.sdnc.ignored_endpoints()
 
     def what_is(self, args):
         ''' what is a specific thing '''
@@ -112,6 +112,7 @@ class Commands:
         show all devices that are of a specific filter. i.e. windows,
         developer workstation, mirroring, etc.
         '''
+        self.sdnc.get_stored_endpoints()
         return self.sdnc.show_endpoints(arg)
 
     def change_devices(self, args):
@@ -1,20 +1,59 @@
+import copy
 import logging
 import os
 import sys
+import time
+from collections import defaultdict
 
 import yaml
 from faucetconfrpc.faucetconfrpc_client_lib import FaucetConfRpcClient
 
 
 class FaucetRemoteConfGetSetter:
+    '''
+    Reads and writes FAUCET config via faucetconfrpc.
+
+    Reads of the default config file are served from a snapshot, refetched
+    when Poseidon itself writes the config or after cache_ttl seconds (to
+    pick up changes made by others). Port config and mirror changes are queued
+    against a snapshot fetched when the first of them is queued, and sent
+    together by flush() as a single SetDpInterfaces request, so that changes
+    which cancel out (e.g. mirror then unmirror of the same port in one pass)
+    never reach FAUCET. The snapshot isn't refetched while changes are queued.
+    '''
 
     DEFAULT_CONFIG_FILE = ''
+    DEFAULT_CACHE_TTL = 60
+    # pending_port_confs value for port config that must be sent regardless.
+    FORCE_PORT_CONF = object()
 
     def __init__(self, client_key=None, client_cert=None,
-                 ca_cert=None, server_addr=None):
+                 ca_cert=None, server_addr=None, cache_ttl=DEFAULT_CACHE_TTL):
         self.client = FaucetConfRpcClient(
             client_key=client_key, client_cert=client_cert,
             ca_cert=ca_cert, server_addr=server_addr)
+        self.faucet_conf = {}
+        self.init_snapshot(cache_ttl)
+
+    def init_snapshot(self, cache_ttl):
+        self.cache_ttl = cache_ttl
+        self.snapshot = None
+        self.snapshot_time = 0
+        # incremented each time a new snapshot is fetched.
+        self.snapshot_version = 0
+        # lookups precomputed from the snapshot, sharing its dicts.
+        self.snapshot_dps = {}
+        self.snapshot_ports = {}
+        self.snapshot_root_switch = None
+        # other config file path -> (time read, doc), reused for cache_ttl seconds.
+        self.file_cache = {}
+        # hit/miss/refresh counts since the last pop_snapshot_stats().
+        self.snapshot_stats = defaultdict(int)
+        # (dp, port) -> port conf before the first queued change.
+        self.pending_port_confs = {}
+        # True if queued changes failed to be sent by a flush() the caller
+        # didn't see (e.g. before a write), so the next flush() reports it.
+        self.flush_failed = False
 
     @staticmethod
     def config_file_path(config_file):
@@ -22,7 +61,13 @@ class FaucetRemoteConfGetSetter:
             return os.path.basename(config_file)
         return config_file
 
+    def _flush_pending(self):
+        if not self.flush():
+            self.flush_failed = True
+
     def read_faucet_conf(self, config_file):
+        if not config_file:
+            self._flush_pending()
         self.faucet_conf = self.client.get_config_file(
             config_filename=self.config_file_path(config_file))
         if self.faucet_conf is None:
@@ -31,18 +76,75 @@ class FaucetRemoteConfGetSetter:
         return self.faucet_conf
 
     def write_faucet_conf(self, config_file=None, faucet_conf=None, merge=False):
+        self._flush_pending()
         if not config_file:
             config_file = self.DEFAULT_CONFIG_FILE
         if faucet_conf is None:
             faucet_conf = self.faucet_conf
-        return self.client.set_config_file(
-            self.faucet_conf,
-            config_filename=self.config_file_path(config_file),
+        config_file_path = self.config_file_path(config_file)
+        result = self.client.set_config_file(
+            faucet_conf,
+            config_filename=config_file_path,
             merge=merge)
+        self.file_cache.pop(config_file_path, None)
+        if config_file_path == self.config_file_path(self.DEFAULT_CONFIG_FILE):
+            self.invalidate_snapshot()
+        return result
+
+    def read_config_file(self, config_file):
+        ''' return a config file other than the default, reusing a read from the last cache_ttl seconds. '''
+        config_file_path = self.config_file_path(config_file)
+        cached = self.file_cache.get(config_file_path, None)
+        if cached is not None and time.time() - cached[0] < self.cache_ttl:
+            return cached[1]
+        conf = self.read_faucet_conf(config_file)
+        self.file_cache[config_file_path] = (time.time(), conf)
+        return conf
+
+    def read_snapshot(self):
+        ''' return the default config, fetching it only if not cached or expired (and no changes are queued against it). '''
+        if self.snapshot is not None:
+            if self.pending_port_confs or time.time() - self.snapshot_time < self.cache_ttl:
+                self.snapshot_stats['hit'] += 1
+                return self.snapshot
+            self.snapshot_stats['refresh'] += 1
+        else:
+            self.snapshot_stats['miss'] += 1
+        # Fetching flushes pending changes first, so none are lost.
+        snapshot = self.read_faucet_conf(config_file=None)
+        self.snapshot = snapshot
+        self.snapshot_time = time.time()
+        self.snapshot_version += 1
+        self._index_snapshot()
+        return self.snapshot
+
+    def _index_snapshot(self):
+        dps = self.snapshot.get('dps', None) or {}
+        self.snapshot_dps = dps
+        self.snapshot_ports = {
+            (dp, port): port_conf
+            for dp, switch_conf in dps.items() if switch_conf
+            for port, port_conf in switch_conf.get('interfaces', {}).items()}
+        root_stack_switch = [
+            switch for switch, switch_conf in dps.items()
+            if switch_conf and switch_conf.get('stack', {}).get('priority', None)]
+        self.snapshot_root_switch = None
+        if root_stack_switch:
+            self.snapshot_root_switch = root_stack_switch[0]
+
+    def invalidate_snapshot(self):
+        if not self.pending_port_confs:
+            self.snapshot = None
+
+    def pop_snapshot_stats(self):
+        ''' return snapshot hit/miss/refresh counts since the last call, and reset. '''
+        stats = self.snapshot_stats
+        self.snapshot_stats = defaultdict(int)
+        return stats
 
     def get_dps(self):
-        self.read_faucet_conf(config_file=None)
-        return self.faucet_conf.get('dps', {})
+        self.read_snapshot()
+        return self.snapshot_dps
 
     def set_acls(self, acls):
         self.read_faucet_conf(config_file=None)
@@ -50,35 +152,95 @@ class FaucetRemoteConfGetSetter:
         self.write_faucet_conf(config_file=None)
 
     def get_port_conf(self, dp, port):
-        switch_conf = self.get_switch_conf(dp)
-        if not switch_conf:
-            return None
-        return switch_conf['interfaces'].get(port, None)
+        ''' return a copy of the port's config, that the caller may modify. '''
+        self.read_snapshot()
+        return copy.deepcopy(self.snapshot_ports.get((dp, port), None))
 
     def get_switch_conf(self, dp):
-        return self.get_dps().get(dp, None)
+        self.read_snapshot()
+        return self.snapshot_dps.get(dp, None)
 
     def get_stack_root_switch(self):
-        root_stack_switch = [
-            switch for switch, switch_conf in self.get_dps().items()
-            if switch_conf.get('stack', {}).get('priority', None)]
-        if root_stack_switch:
-            return root_stack_switch[0]
-        return None
+        self.read_snapshot()
+        return self.snapshot_root_switch
+
+    def _queue_port_conf(self, dp, port, force=False):
+        ''' return the snapshot interfaces for dp, with dp/port queued for the next flush(). '''
+        if not self.pending_port_confs:
+            # compute each batch against current config, not a snapshot up to cache_ttl old.
+            self.invalidate_snapshot()
+        switch_conf = self.get_switch_conf(dp)
+        if not switch_conf:
+            logging.error('Unknown switch {0}, not updating port {1}'.format(dp, port))
+            return None
+        interfaces = switch_conf.setdefault('interfaces', {})
+        key = (dp, port)
+        if force:
+            self.pending_port_confs[key] = self.FORCE_PORT_CONF
+        elif key not in self.pending_port_confs:
+            self.pending_port_confs[key] = copy.deepcopy(
+                interfaces.get(port, None))
+        return interfaces
+
+    def _queue_mirror_ports(self, dp, mirror_port, update_mirrors):
+        interfaces = self._queue_port_conf(dp, mirror_port)
+        if interfaces is None:
+            return
+        mirror_port_conf = interfaces.get(mirror_port, None)
+        if mirror_port_conf is None:
+            logging.error('Mirror port {0} not configured on {1}'.format(
+                mirror_port, dp))
+            return
+        mirrors = mirror_port_conf.get('mirror', [])
+        if not isinstance(mirrors, list):
+            mirrors = [mirrors]
+        mirrors = update_mirrors(mirrors)
+        if mirrors:
+            mirror_port_conf['mirror'] = mirrors
+        else:
+            mirror_port_conf.pop('mirror', None)
+
+    def flush(self):
+        ''' send queued port config changes as one request, returning False if it (or an unreported earlier one) failed. '''
+        flush_failed = self.flush_failed
+        self.flush_failed = False
+        if not self.pending_port_confs:
+            return not flush_failed
+        dp_interfaces = defaultdict(dict)
+        for (dp, port), orig_port_conf in self.pending_port_confs.items():
+            port_conf = self.snapshot_ports.get((dp, port), None)
+            if port_conf is not None and port_conf != orig_port_conf:
+                dp_interfaces[dp][port] = yaml.dump(port_conf)
+        self.pending_port_confs = {}
+        if not dp_interfaces:
+            return not flush_failed
+        try:
+            result = self.client.set_dp_interfaces(list(dp_interfaces.items()))
+        finally:
+            # whether or not FAUCET got the changes, refetch rather than trust the snapshot.
+            self.invalidate_snapshot()
+        return result is not None and not flush_failed
 
     def set_port_conf(self, dp, port, port_conf):
-        return self.client.set_dp_interfaces(
-            [(dp, {port: yaml.dump(port_conf)})])
+        interfaces = self._queue_port_conf(dp, port, force=True)
+        if interfaces is not None:
+            port_conf = copy.deepcopy(port_conf)
+            interfaces[port] = port_conf
+            self.snapshot_ports[(dp, port)] = port_conf
 
     def update_switch_conf(self, dp, switch_conf):
         return self.write_faucet_conf(
             faucet_conf={'dps': {dp: switch_conf}}, merge=True)
 
-    def mirror_port(self, dp, mirror_port, port):  # pragma: no cover
-        self.client.add_port_mirror(dp, port, mirror_port)
+    def mirror_port(self, dp, mirror_port, port):
+        self._queue_mirror_ports(
+            dp, mirror_port,
+            lambda mirrors: mirrors + [port] if port not in mirrors else mirrors)
 
-    def unmirror_port(self, dp, mirror_port, port):  # pragma: no cover
-        self.client.remove_port_mirror(dp, port, mirror_port)
+    def unmirror_port(self, dp, mirror_port, port):
+        self._queue_mirror_ports(
+            dp, mirror_port,
+            lambda mirrors: [mirror for mirror in mirrors if mirror != port])
 
-    def clear_mirror_port(self, dp, mirror_port):  # pragma: no cover
-        self.client.clear_port_mirror(dp, mirror_port)
+    def clear_mirror_port(self, dp, mirror_port):
+        self._queue_mirror_ports(dp, mirror_port, lambda _mirrors: [])
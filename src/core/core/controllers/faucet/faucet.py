@@ -37,6 +37,8 @@ class FaucetProxy:
         self.ignore_vlans = kwargs.get('ignore_vlans', config['ignore_vlans'])
         self.ignore_ports = kwargs.get('ignore_ports', config['ignore_ports'])
         self.mirror_counts = kwargs.get('mirror_counts', defaultdict(int))
+        # (switch, port) -> mirror count before the first change since the last flush.
+        self.pending_mirror_counts = {}
         self.frpc = None
         faucetconfgetsetter_cl = kwargs.get(
             'faucetconfgetsetter_cl', FaucetRemoteConfGetSetter)
@@ -111,6 +113,7 @@ class FaucetProxy:
                         })
                     self.frpc.set_port_conf(
                         switch, mirror_port, mirror_port_conf)
+            self.frpc.flush()
 
     def _get_frpc(self, config, faucetconfgetsetter_cl=FaucetRemoteConfGetSetter):
         faucetconfrpc_address = config['faucetconfrpc_address']
@@ -123,7 +126,8 @@ class FaucetProxy:
             client_key='/certs/%s.key' % faucetconfrpc_client,
             client_cert='/certs/%s.crt' % faucetconfrpc_client,
             ca_cert='/certs/%s-ca.crt' % server,
-            server_addr=faucetconfrpc_address)
+            server_addr=faucetconfrpc_address,
+            cache_ttl=config['faucetconfrpc_cache_ttl'])
 
     @staticmethod
     def format_endpoints(data):
@@ -255,13 +259,23 @@ class FaucetProxy:
             self.logger.error(
                 'Unable to read or parse rules file, not applying ACLs')
             return False
-        self.frpc.read_faucet_conf(config_file=None)
+        obj_doc = self.frpc.read_faucet_conf(config_file=None)
+        includes = list(obj_doc.get('include', []))
+        acl = ACL(self.frpc)
         # TODO coprocess_rules_files is set to None, which was previous default but removes functionality
-        self.frpc.faucet_conf = ACL(self.frpc).apply_acls(
+        obj_doc = acl.apply_acls(
             rules_file, endpoints,
             force_apply_rules, force_remove_rules,
-            None, self.frpc.faucet_conf, rules_doc)
-        self.frpc.write_faucet_conf(config_file=None)
+            None, obj_doc, rules_doc)
+        if obj_doc.get('include', []) != includes:
+            self.frpc.faucet_conf = obj_doc
+            self.frpc.write_faucet_conf(config_file=None)
+        elif acl.port_acl_changes:
+            # only ports whose ACLs changed need to be sent.
+            for switch, port in acl.port_acl_changes:
+                self.frpc.set_port_conf(
+                    switch, port, obj_doc['dps'][switch]['interfaces'][port])
+            self.flush()
         return True
 
     def _mac_switch_port(self, my_mac):
@@ -296,6 +310,30 @@ class FaucetProxy:
                 mirror_port = self.mirror_switch_port(switch)
                 if mirror_port:
                     self.frpc.clear_mirror_port(switch, mirror_port)
+            self.flush()
+
+    def flush(self):
+        ''' send any queued mirror and port config changes to FAUCET, returning False if they could not be sent. '''
+        pending_mirror_counts = self.pending_mirror_counts
+        self.pending_mirror_counts = {}
+        try:
+            if self.frpc.flush() is not False:
+                return True
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to send config changes to FAUCET because: {0}'.format(str(e)))
+        self.logger.error('Mirror changes were not applied, reverting mirror counts')
+        self.mirror_counts.update(pending_mirror_counts)
+        return False
+
+    def _change_mirror_count(self, mirror_key, change):
+        self.pending_mirror_counts.setdefault(
+            mirror_key, self.mirror_counts[mirror_key])
+        self.mirror_counts[mirror_key] += change
+
+    def pop_config_stats(self):
+        ''' return FAUCET config cache hit/miss/refresh counts since the last call. '''
+        return self.frpc.pop_snapshot_stats()
 
     def mirror_mac(self, my_mac, my_switch, my_port):
         self.logger.debug('Mirroring mac %s', my_mac)
@@ -307,7 +345,7 @@ class FaucetProxy:
                 mirror_key = (switch, port)
                 self.logger.info(f'Request mirror of {mirror_key}')
                 self.frpc.mirror_port(switch, mirror_port, port)
-                self.mirror_counts[mirror_key] += 1
+                self._change_mirror_count(mirror_key, 1)
                 count = self.mirror_counts[mirror_key]
                 self.logger.info(f'Mirroring {count} MACs on {mirror_key}')
             else:
@@ -331,7 +369,7 @@ class FaucetProxy:
                     mirror_key = (switch, port)
                     self.logger.info(f'Request unmirror of {mirror_key}')
                     if self.mirror_counts[mirror_key]:
-                        self.mirror_counts[mirror_key] -= 1
+                        self._change_mirror_count(mirror_key, -1)
                         if not self.mirror_counts[mirror_key]:
                             self.logger.info(
                                 f'Removing last remaining mirror on {mirror_key}')
@@ -1,107 +1,235 @@
 import difflib
 import ipaddress
 import json
+import logging
 import time
-from copy import deepcopy
 
-import pika
 from poseidon_core.constants import NO_DATA
 from poseidon_core.controllers.faucet.config import FaucetRemoteConfGetSetter
 from poseidon_core.controllers.faucet.faucet import FaucetProxy
 from poseidon_core.helpers.actions import Actions
+from poseidon_core.helpers.changes import EndpointChangeLog
+from poseidon_core.helpers.collector import get_network_tap_client
+from poseidon_core.helpers.config import apply_config_changes
 from poseidon_core.helpers.endpoint import Endpoint
 from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.helpers.endpoint import EndpointData
+from poseidon_core.helpers.endpoint import HEARTBEAT_FIELDS
 from poseidon_core.helpers.endpoint import MACHINE_IP_FIELDS
 from poseidon_core.helpers.endpoint import MACHINE_IP_PREFIXES
+from poseidon_core.helpers.feed import get_endpoint_feed
 from poseidon_core.helpers.metadata import DNSResolver
 from poseidon_core.helpers.metadata import get_ether_vendor
 from poseidon_core.helpers.prometheus import Prometheus
+from poseidon_core.helpers.rabbit import get_publisher
+from poseidon_core.helpers.registry import EndpointRegistry
+from poseidon_core.helpers.store import get_endpoint_store
+from poseidon_core.operations.primitives.acl import ACL_ENDPOINT_FIELDS
+from poseidon_core.operations.primitives.acl import rules_file_mtime
 
 
 class SDNConnect:
 
-    def __init__(self, config, logger, prom, faucetconfgetsetter_cl=FaucetRemoteConfGetSetter):
+    # routing keys endpoint changes, and changes requested by consumers catching up, are published on.
+    CHANGES_ROUTING_KEY = 'poseidon.endpoints.changes'
+    CATCHUP_ROUTING_KEY = 'poseidon.endpoints.catchup'
+
+    # config that the SDN controller proxy is built from.
+    SDN_CONTEXT_KEYS = frozenset((
+        'TYPE', 'MIRROR_PORTS', 'controller_proxy_mirror_ports', 'tunnel_vlan', 'tunnel_name',
+        'LEARN_PUBLIC_ADDRESSES', 'trunk_ports', 'ignore_vlans', 'ignore_ports', 'faucetconfrpc_address',
+        'faucetconfrpc_client', 'faucetconfrpc_cache_ttl', 'enable_volos', 'volos_cfg_file',
+        'acl_dir', 'coprocessor_nic', 'coprocessor_port', 'coprocessor_vlans',
+        'ignore_copro_ports', 'coprocessing_frequency'))
+    # config mainly used by the Monitor, that the SDN controller proxy keeps a copy of
+    # (as attributes of the same name) but that doesn't need a new proxy.
+    SDN_PROXY_ATTR_KEYS = frozenset((
+        'reinvestigation_frequency', 'max_concurrent_reinvestigations'))
+
+    def __init__(self, config, logger, prom, faucetconfgetsetter_cl=FaucetRemoteConfGetSetter, read_only=False):
         self.config = config
         self.r = None
         self.sdnc = None
-        self.endpoints = {}
+        self._endpoints = EndpointRegistry()
         self.investigations = 0
         self.coprocessing = 0
-        trunk_ports = self.config['trunk_ports']
-        if isinstance(trunk_ports, str):
-            self.trunk_ports = json.loads(trunk_ports)
-        else:
-            self.trunk_ports = trunk_ports
+        # mtime of the rules file when automated ACLs were last evaluated.
+        self.acl_rules_mtime = None
+        self.set_trunk_ports()
         self.logger = logger
         self.prom = prom
         self.faucetconfgetsetter_cl = faucetconfgetsetter_cl
+        if read_only:
+            # only looks up stored endpoints (e.g. for the CLI), which callers
+            # load as needed; doesn't connect to the controller or publish anything.
+            self.store = get_endpoint_store(self.config, read_only=True)
+            return
         self.get_sdn_context()
-        self.dns_resolver = DNSResolver()
+        self.dns_resolver = DNSResolver(timeout=self.config['rdns_timeout'])
+        self.network_tap = get_network_tap_client(self.config)
+        self.network_tap.request_secs = self.prom.prom_metrics.get(
+            'collector_request_secs', None)
+        self.store = get_endpoint_store(self.config)
         self.get_stored_endpoints()
+        self.feed = get_endpoint_feed(self.config)
+        self.changes = EndpointChangeLog(
+            size=self.config['endpoint_changes_log_size'])
+
+    @property
+    def endpoints(self):
+        return self._endpoints
+
+    @endpoints.setter
+    def endpoints(self, endpoints):
+        if not isinstance(endpoints, EndpointRegistry):
+            endpoints = EndpointRegistry(endpoints)
+        self._endpoints = endpoints
+
+    def mirror_endpoints(self, endpoints):
+        ''' mirror endpoints. '''
+        statuses = Actions(None, self.sdnc, config=self.config).mirror_endpoints(
+            endpoints)
+        for endpoint, status in zip(endpoints, statuses):
+            if not status:
+                self.logger.warning(
+                    'Unable to mirror the endpoint: {0}'.format(endpoint.name))
 
     def mirror_endpoint(self, endpoint):
         ''' mirror an endpoint. '''
-        status = Actions(endpoint, self.sdnc).mirror_endpoint()
-        if not status:
-            self.logger.warning(
-                'Unable to mirror the endpoint: {0}'.format(endpoint.name))
-
-    def unmirror_endpoint(self, endpoint):
-        ''' unmirror an endpoint. '''
-        if endpoint.operation_active():
-            status = Actions(endpoint, self.sdnc).unmirror_endpoint()
+        self.mirror_endpoints([endpoint])
+
+    def unmirror_endpoints(self, endpoints):
+        ''' unmirror endpoints. '''
+        active_endpoints = []
+        for endpoint in endpoints:
+            if endpoint.operation_active():
+                active_endpoints.append(endpoint)
+            else:
+                self.logger.info('Not unmirroring endpoint {0} in state {1}'.format(
+                    endpoint.name, endpoint.state))
+        if not active_endpoints:
+            return
+        statuses = Actions(None, self.sdnc, config=self.config).unmirror_endpoints(
+            active_endpoints)
+        for endpoint, status in zip(active_endpoints, statuses):
             if not status:
                 self.logger.warning(
                     'Unable to unmirror the endpoint: {0}'.format(endpoint.name))
             endpoint.force_unknown()
-        else:
-            self.logger.info('Not unmirroring endpoint {0} in state {1}'.format(
-                endpoint.name, endpoint.state))
+
+    def unmirror_endpoint(self, endpoint):
+        ''' unmirror an endpoint. '''
+        self.unmirror_endpoints([endpoint])
 
     def clear_filters(self):
         ''' clear any exisiting filters. '''
         if isinstance(self.sdnc, FaucetProxy):
             self.sdnc.clear_mirrors()
 
+    def flush_sdn(self):
+        ''' send SDN changes queued since the last flush. '''
+        if isinstance(self.sdnc, FaucetProxy):
+            self.sdnc.flush()
+
+    def sdn_config_stats(self):
+        ''' return SDN controller config cache counts since the last call. '''
+        if isinstance(self.sdnc, FaucetProxy):
+            return self.sdnc.pop_config_stats()
+        return {}
+
     def default_endpoints(self):
         ''' set endpoints to default state. '''
         self.clear_filters()
         for endpoint in self.endpoints.values():
             endpoint.default()
 
-    def get_stored_endpoints(self):
-        ''' load existing endpoints from Prometheus. '''
-        new_endpoints = self.prom.get_stored_endpoints()
+    def get_stored_endpoints(self, key=None, ignored=None):
+        '''
+        load existing endpoints from the endpoint store, or failing that from Prometheus.
+        If key (a name, MAC or IP) or ignored are given, only matching endpoints
+        are loaded, if the store can look them up.
+        '''
+        if key is not None or ignored is not None:
+            new_endpoints = self.store.find(key=key, ignored=ignored)
+            if new_endpoints is not None:
+                self.endpoints = new_endpoints
+                return
+        new_endpoints = self.store.load()
+        source = 'endpoint store'
+        if not new_endpoints:
+            new_endpoints = self.prom.get_stored_endpoints()
+            source = 'Prometheus'
         if new_endpoints:
             self.logger.info(
-                f'Loaded {len(new_endpoints)} endpoints previously learned.')
+                f'Loaded {len(new_endpoints)} endpoints previously learned from {source}.')
             self.endpoints = new_endpoints
 
+    def store_endpoints(self):
+        ''' write endpoints changed since the last call through to the endpoint store. '''
+        self.store.delete_endpoints(self.endpoints.pop_removed('store'))
+        self.store.put_endpoints(self.endpoints.pop_dirty('store').values())
+
+    def publish_endpoints(self):
+        ''' publish endpoints changed since the last call to the endpoint feed, or a snapshot when one is due. '''
+        if not self.feed.enabled:
+            return
+        removed = self.endpoints.pop_removed('feed')
+        dirty = self.endpoints.pop_dirty_fields('feed')
+        if self.feed.snapshot_due():
+            self.feed.put_snapshot(self.endpoints.values())
+        else:
+            # readers don't need an endpoint again just because it was seen again.
+            self.feed.put_delta([
+                endpoint for endpoint, fields in dirty.values()
+                if fields is None or not fields <= HEARTBEAT_FIELDS], removed)
+
+    def set_trunk_ports(self):
+        trunk_ports = self.config['trunk_ports']
+        if isinstance(trunk_ports, str):
+            self.trunk_ports = json.loads(trunk_ports)
+        else:
+            self.trunk_ports = trunk_ports
+
+    def update_config(self, snapshot, changed):
+        ''' apply a changed config (see ConfigWatcher), reconnecting to the controller if its config changed. '''
+        apply_config_changes(self.config, snapshot, changed)
+        if 'trunk_ports' in changed:
+            self.set_trunk_ports()
+        if 'rdns_timeout' in changed:
+            self.dns_resolver.timeout = self.config['rdns_timeout']
+        if not self.SDN_CONTEXT_KEYS.isdisjoint(changed):
+            self.logger.info('Controller config changed, reconnecting')
+            self.get_sdn_context()
+        elif isinstance(self.sdnc, FaucetProxy):
+            for key in self.SDN_PROXY_ATTR_KEYS & changed:
+                setattr(self.sdnc, key, self.config[key])
+
     def get_sdn_context(self):
         controller_type = self.config.get('TYPE', None)
         if controller_type == 'faucet':
-            self.sdnc = FaucetProxy(
-                self.config, faucetconfgetsetter_cl=self.faucetconfgetsetter_cl)
+            old_sdnc = self.sdnc
+            if isinstance(old_sdnc, FaucetProxy):
+                # keep track of existing mirrors and learned MACs, so they can still be unmirrored.
+                self.sdnc = FaucetProxy(
+                    self.config, faucetconfgetsetter_cl=self.faucetconfgetsetter_cl,
+                    mirror_counts=old_sdnc.mirror_counts)
+                self.sdnc.mac_table = old_sdnc.mac_table
+            else:
+                self.sdnc = FaucetProxy(
+                    self.config, faucetconfgetsetter_cl=self.faucetconfgetsetter_cl)
         else:
             self.logger.error(
                 'Unknown SDN controller config: {0}'.format(
                     self.config))
 
     def not_ignored_endpoints(self, state=None):
-        endpoints = [endpoint for endpoint in self.endpoints.values()
-                     if not endpoint.ignore]
-        if state:
-            endpoints = [
-                endpoint for endpoint in endpoints if endpoint.state == state]
-        return endpoints
+        return self.endpoints.not_ignored(state)
 
     def not_copro_ignored_endpoints(self, state=None):
-        endpoints = [endpoint for endpoint in self.endpoints.values()
-                     if not endpoint.copro_ignore]
-        if state:
-            endpoints = [
-                endpoint for endpoint in endpoints if endpoint.copro_state == state]
-        return endpoints
+        return self.endpoints.not_copro_ignored(state)
+
+    def ignored_endpoints(self):
+        return self.endpoints.ignored()
 
     def endpoint_by_name(self, name):
         return self.endpoints.get(name, None)
@@ -110,58 +238,69 @@ class SDNConnect:
         return self.endpoint_by_name(hash_id)
 
     def endpoints_by_ip(self, ip):
-        return [
-            endpoint for endpoint in self.endpoints.values()
-            if ip == endpoint.endpoint_data.get('ipv4', None) or
-            ip == endpoint.endpoint_data.get('ipv6', None)]
+        return self.endpoints.by_ip(ip)
 
     def endpoints_by_mac(self, mac):
-        return [
-            endpoint for endpoint in self.endpoints.values()
-            if mac == endpoint.endpoint_data['mac']]
+        return self.endpoints.by_mac(mac)
 
     def investigation_budget(self):
-        self.investigations = len([
-            endpoint for endpoint in self.not_ignored_endpoints()
-            if endpoint.operation_active()])
+        self.investigations = self.endpoints.count_not_ignored('operating')
         return max(
             self.config['max_concurrent_reinvestigations'] - self.investigations, 0)
 
     def coprocessing_budget(self):
-        self.coprocessing = len([
-            endpoint for endpoint in self.not_ignored_endpoints()
-            if endpoint.copro_state == 'copro_coprocessing'])
+        self.coprocessing = self.endpoints.count_not_ignored_copro(
+            'copro_coprocessing')
         return max(
             self.config['max_concurrent_coprocessing'] - self.coprocessing, 0)
 
-    @staticmethod
-    def _connect_rabbit():
-        # Rabbit settings
-        exchange = 'topic-poseidon-internal'
-        exchange_type = 'topic'
-
-        # Starting rabbit connection
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='RABBIT_SERVER')
-        )
+    def publish_changes(self):
+        ''' publish endpoint changes since the last call, on CHANGES_ROUTING_KEY. '''
+        if not self.config['publish_endpoint_changes']:
+            return
+        records = self.changes.capture(self.endpoints)
+        if records:
+            self.publish_actions_background(self.changes.messages(
+                self.CHANGES_ROUTING_KEY, records))
+
+    def publish_changes_since(self, seq, epoch, routing_key=None):
+        '''
+        publish the endpoint changes after seq in epoch on routing_key
+        (CATCHUP_ROUTING_KEY by default), or if they are no longer logged,
+        all endpoints as of the current seq (flagged as a resync).
+        '''
+        if not self.config['publish_endpoint_changes']:
+            return
+        if routing_key is None:
+            routing_key = self.CATCHUP_ROUTING_KEY
+        # don't miss changes not yet captured.
+        self.publish_changes()
+        records = None
+        if epoch == self.changes.epoch:
+            records = self.changes.since(seq)
+        if records is None:
+            messages = self.changes.messages(
+                routing_key, self.changes.snapshot(self.endpoints.values()), resync=True)
+        else:
+            messages = self.changes.messages(routing_key, records)
+        self.publish_actions_background(messages)
 
-        channel = connection.channel()
-        channel.exchange_declare(
-            exchange=exchange, exchange_type=exchange_type
-        )
+    @staticmethod
+    def publish_action(action, message):
+        ''' publish an action for Poseidon to carry out, e.g. from the CLI. '''
+        return SDNConnect.publish_actions([(action, message)])
 
-        return channel, exchange, connection
+    @staticmethod
+    def publish_actions(actions):
+        ''' publish a batch of (action, message), over the shared connection. '''
+        publisher = get_publisher('RABBIT_SERVER', 'topic-poseidon-internal')
+        return publisher.publish_batch(actions)
 
     @staticmethod
-    def publish_action(action, message):
-        try:
-            channel, exchange, connection = SDNConnect._connect_rabbit()
-            channel.basic_publish(exchange=exchange,
-                                  routing_key=action,
-                                  body=message)
-            connection.close()
-        except Exception as e:  # pragma: no cover
-            print(str(e))
+    def publish_actions_background(actions):
+        ''' like publish_actions(), but without waiting for them to be published. '''
+        publisher = get_publisher('RABBIT_SERVER', 'topic-poseidon-internal')
+        return publisher.publish_batch_background(actions)
 
     def show_endpoints(self, arg):
         endpoints = []
@@ -227,7 +366,7 @@ class SDNConnect:
     def _diff_machine(machine_a, machine_b):
 
         def _machine_strlines(machine):
-            return str(json.dumps(machine, indent=2)).splitlines()
+            return str(json.dumps(dict(machine), indent=2)).splitlines()
 
         machine_a_strlines = _machine_strlines(machine_a)
         machine_b_strlines = _machine_strlines(machine_b)
@@ -278,6 +417,22 @@ class SDNConnect:
                     if field in old_machine:
                         new_machine[field] = old_machine[field]
 
+    def update_rdns(self):
+        ''' fill in rdns names of endpoints whose IPs were resolved in the background. '''
+        updated = 0
+        for ip, result in self.dns_resolver.pop_resolved().items():
+            for endpoint in self.endpoints.by_ip(ip):
+                endpoint_data = endpoint.endpoint_data
+                for ip_field in MACHINE_IP_FIELDS:
+                    rdns_field = '_'.join((ip_field, 'rdns'))
+                    if endpoint_data.get(ip_field, None) == ip and endpoint_data.get(rdns_field, None) != result:
+                        endpoint_data = endpoint_data.copy()
+                        endpoint_data[rdns_field] = result
+                        endpoint.set_endpoint_data(
+                            endpoint_data, changed_fields={rdns_field})
+                        updated += 1
+        return updated
+
     def find_new_machines(self, machines):
         '''parse switch structure to find new machines added to network
         since last call'''
@@ -296,8 +451,9 @@ class SDNConnect:
 
         if machine_ips:
             self.logger.debug('resolving %s' % machine_ips)
+            # if asynchronous, only cached names are used now and the rest are filled in by update_rdns().
             resolved_machine_ips = self.dns_resolver.resolve_ips(
-                list(machine_ips))
+                list(machine_ips), timeout=0 if self.config['rdns_async'] else None)
             self.logger.debug('resolver results %s', resolved_machine_ips)
             for machine in machines:
                 self._update_machine_rdns(machine, resolved_machine_ips)
@@ -313,7 +469,7 @@ class SDNConnect:
             if ep is None:
                 change_acls = True
                 m = endpoint_factory(h)
-                m.endpoint_data = deepcopy(machine)
+                m.endpoint_data = EndpointData(machine)
                 m.touch()
                 self.endpoints[m.name] = m
                 self.logger.info(
@@ -321,18 +477,23 @@ class SDNConnect:
                 continue
 
             self.merge_machine_ip(ep.endpoint_data, machine)
-            if ep.endpoint_data != machine and not ep.ignore:
-                diff_txt = self._diff_machine(ep.endpoint_data, machine)
-                self.logger.info(
-                    'Endpoint changed: {0}:\n{1}'.format(h, diff_txt))
+            changed_fields = ep.endpoint_data.changed_fields(machine)
+            if changed_fields and not ep.ignore:
+                if self.logger.isEnabledFor(logging.INFO):
+                    diff_txt = self._diff_machine(ep.endpoint_data, machine)
+                    self.logger.info(
+                        'Endpoint changed: {0}:\n{1}'.format(h, diff_txt))
                 change_acls = True
-                ep.endpoint_data = deepcopy(machine)
+                ep.set_endpoint_data(machine, changed_fields=changed_fields)
             ep.touch()
 
         if change_acls and self.config['AUTOMATED_ACLS']:
             status = Actions(None, self.sdnc).update_acls(
                 rules_file=self.config['RULES_FILE'],
-                endpoints=self.endpoints.values())
+                endpoints=self.acl_endpoints())
+            if not status:
+                # re-evaluate every endpoint next time.
+                self.acl_rules_mtime = None
             if isinstance(status, list):
                 self.logger.info(
                     'Automated ACLs did the following: {0}'.format(status[1]))
@@ -344,12 +505,29 @@ class SDNConnect:
                     if ep:
                         ep.acl_data.append(
                             ((item[0], item[4], item[5]), int(time.time())))
+                        ep.mark_dirty(('acl_data',))
+
+    def acl_endpoints(self):
+        ''' return endpoints whose ACL relevant fields changed since ACL rules were last evaluated, or all if the rules file changed. '''
+        endpoints = self.endpoints.pop_dirty_fields('acls')
+        rules_mtime = rules_file_mtime(self.config['RULES_FILE'])
+        if rules_mtime is None or rules_mtime != self.acl_rules_mtime:
+            self.acl_rules_mtime = rules_mtime
+            return list(self.endpoints.values())
+        return [
+            endpoint for endpoint, fields in endpoints.values()
+            if fields is None or not ACL_ENDPOINT_FIELDS.isdisjoint(fields)]
 
     @staticmethod
     def coprocess_endpoint(_endpoint):
         '''TODO.'''
         return
 
+    def coprocess_endpoints(self, endpoints):
+        ''' coprocess endpoints. '''
+        for endpoint in endpoints:
+            self.coprocess_endpoint(endpoint)
+
     @staticmethod
     def uncoprocess_endpoint(_endpoint):
         '''TODO'''
@@ -1,26 +1,72 @@
 import json
 import queue
+import threading
 import time
 from collections import defaultdict
 from functools import partial
+from itertools import groupby
+from operator import itemgetter
 
 from poseidon_core.helpers.actions import Actions
+from poseidon_core.helpers.config import apply_config_changes
 from poseidon_core.helpers.config import Config
+from poseidon_core.helpers.rabbit import AsyncRabbit
 from poseidon_core.helpers.rabbit import Rabbit
 
 
+class WakeupQueue(queue.Queue):
+    ''' queue.Queue that also sets an event whenever an item is put. '''
+
+    def __init__(self, wakeup):
+        super().__init__()
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block=block, timeout=timeout)
+        self.wakeup.set()
+
+
 class SDNEvents:
 
+    # most rabbit messages to take off the queue at once.
+    RABBIT_BATCH_SIZE = 1000
+
     def __init__(self, logger, prom, sdnc):
         self.logger = logger
         self.prom = prom
-        self.m_queue = queue.Queue()
-        self.job_queue = queue.Queue()
+        # set when there is new work in m_queue or job_queue.
+        self.wakeup = threading.Event()
+        self.m_queue = WakeupQueue(self.wakeup)
+        self.job_queue = WakeupQueue(self.wakeup)
         self.rabbits = []
         self.config = Config().get_config()
+        self.batching_window = self.config['event_batching_window']
+        # routing key -> (handler, handler name for runtime metrics).
+        self.rabbit_handlers = {
+            routing_key: (handler, self.prom.runtime_method_name(handler))
+            for routing_key, handler in (
+                ('poseidon.algos.decider', self.handler_algos_decider),
+                ('poseidon.action.ignore', self.handler_action_ignore),
+                ('poseidon.action.clear.ignored', self.handler_action_clear_ignored),
+                ('poseidon.action.change', self.handler_action_change),
+                ('poseidon.action.update_acls', self.handler_action_update_acls),
+                ('poseidon.action.remove', self.handler_action_remove),
+                ('poseidon.action.remove.ignored', self.handler_action_remove_ignored),
+                ('poseidon.action.changes_since', self.handler_action_changes_since),
+                (self.config['FA_RABBIT_ROUTING_KEY'], self.handler_faucet_event))}
         self.sdnc = sdnc
+        # fill in names from background rDNS lookups as soon as they finish.
+        self.sdnc.dns_resolver.on_resolved = self.wakeup.set
         self.sdnc.default_endpoints()
         self.prom.update_endpoint_metadata(self.sdnc.endpoints)
+        self.sdnc.store_endpoints()
+        self.sdnc.publish_endpoints()
+        self.sdnc.publish_changes()
+
+    def update_config(self, snapshot, changed):
+        ''' apply a changed config (see ConfigWatcher); rabbit connections are not changed. '''
+        apply_config_changes(self.config, snapshot, changed)
+        self.batching_window = self.config['event_batching_window']
 
     def create_message_queue(self, host, port, exchange, binding_key):
         waiting = True
@@ -36,14 +82,20 @@ class SDNEvents:
     def start_message_queues(self):
         host = self.config['FA_RABBIT_HOST']
         port = int(self.config['FA_RABBIT_PORT'])
-        exchange = 'topic-poseidon-internal'
-        binding_key = ['poseidon.algos.#', 'poseidon.action.#']
-        self.create_message_queue(
-            host, port, exchange, binding_key)
-        exchange = self.config['FA_RABBIT_EXCHANGE']
-        binding_key = [self.config['FA_RABBIT_ROUTING_KEY']+'.#']
-        self.create_message_queue(
-            host, port, exchange, binding_key)
+        exchange_keys = {
+            'topic-poseidon-internal': ['poseidon.algos.#', 'poseidon.action.#'],
+            self.config['FA_RABBIT_EXCHANGE']: [self.config['FA_RABBIT_ROUTING_KEY']+'.#'],
+        }
+        if self.config['rabbit_consumer'] == 'asyncio':
+            rabbit = AsyncRabbit(
+                prefetch_count=self.config['rabbit_prefetch_count'])
+            rabbit.start(host, port, exchange_keys,
+                         partial(self.rabbit_messages, q=self.m_queue))
+            self.rabbits.append(rabbit)
+            return
+        for exchange, binding_key in exchange_keys.items():
+            self.create_message_queue(
+                host, port, exchange, binding_key)
 
     def merge_metadata(self, new_metadata):
         updated = set()
@@ -64,48 +116,60 @@ class SDNEvents:
                         endpoint.metadata[metadata_type][key].update(data)
                     else:
                         endpoint.metadata[metadata_type][key] = data
+                    endpoint.mark_dirty(('metadata',))
                     updated.add(endpoint)
         return updated
 
-    def format_rabbit_message(self, item, faucet_event, remove_list):
+    def format_rabbit_messages(self, routing_key, my_objs, faucet_event, remove_list):
         '''
-        read a message off the rabbit_q
-        the message should be item = (routing_key,msg)
+        handle consecutive messages (my_objs) with the same routing key with
+        one handler call, returning False if there is no handler for them.
         '''
-        routing_key, my_obj = item
+        handler, _ = self.rabbit_handlers.get(routing_key, (None, None))
+        if handler is None:
+            self.logger.error(
+                'no handler for routing_key {0}'.format(routing_key))
+            return False
         self.logger.debug(
-            'routing_key: {0} rabbit_message: {1}'.format(routing_key, my_obj))
+            'routing_key: {0} rabbit_messages: {1}'.format(routing_key, my_objs))
+        handler(my_objs, faucet_event, remove_list)
+        return True
+
+    # Handlers are called with a list of consecutive messages with their routing key.
 
-        def handler_algos_decider(my_obj):
+    def handler_algos_decider(self, my_objs, _faucet_event, _remove_list):
+        tools = set()
+        investigated = {}
+        for my_obj in my_objs:
             self.logger.debug('decider value:{0}'.format(my_obj))
-            tool = my_obj.get('tool', 'unknown')
-            self.update_prom_var_time(
-                'last_tool_result_time', 'tool', tool)
+            tools.add(my_obj.get('tool', 'unknown'))
             data = my_obj.get('data', None)
             if isinstance(data, dict) and data:
-                updated = self.merge_metadata(data)
-                if updated:
-                    for endpoint in updated:
-                        if endpoint.operation_active():
-                            self.sdnc.unmirror_endpoint(endpoint)
-                    return data
-            return {}
+                for endpoint in self.merge_metadata(data):
+                    if endpoint.operation_active():
+                        investigated[endpoint.name] = endpoint
+        for tool in tools:
+            self.update_prom_var_time(
+                'last_tool_result_time', 'tool', tool)
+        if investigated:
+            self.sdnc.unmirror_endpoints(list(investigated.values()))
 
-        def handler_action_ignore(my_obj):
+    def handler_action_ignore(self, my_objs, _faucet_event, _remove_list):
+        for my_obj in my_objs:
             for name in my_obj:
                 endpoint = self.sdnc.endpoints.get(name, None)
                 if endpoint:
                     endpoint.ignore = True
-            return {}
 
-        def handler_action_clear_ignored(my_obj):
+    def handler_action_clear_ignored(self, my_objs, _faucet_event, _remove_list):
+        for my_obj in my_objs:
             for name in my_obj:
                 endpoint = self.sdnc.endpoints.get(name, None)
                 if endpoint:
                     endpoint.ignore = False
-            return {}
 
-        def handler_action_change(my_obj):
+    def handler_action_change(self, my_objs, _faucet_event, _remove_list):
+        for my_obj in my_objs:
             for name, state in my_obj:
                 endpoint = self.sdnc.endpoints.get(name, None)
                 if endpoint:
@@ -122,9 +186,9 @@ class SDNEvents:
                     except Exception as e:  # pragma: no cover
                         self.logger.error(
                             'Unable to change endpoint {0} because: {1}'.format(endpoint.name, str(e)))
-            return {}
 
-        def handler_action_update_acls(my_obj):
+    def handler_action_update_acls(self, my_objs, _faucet_event, _remove_list):
+        for my_obj in my_objs:
             for ip in my_obj:
                 rules = my_obj[ip]
                 endpoints = self.sdnc.endpoints_by_ip(ip)
@@ -140,43 +204,31 @@ class SDNEvents:
                     except Exception as e:
                         self.logger.error(
                             'Unable to apply rules: {0} to endpoint: {1} because {2}'.format(rules, endpoint.name, str(e)))
-            return {}
 
-        def handler_action_remove(my_obj):
+    def handler_action_remove(self, my_objs, _faucet_event, remove_list):
+        for my_obj in my_objs:
             remove_list.extend([name for name in my_obj])
-            return {}
 
-        def handler_action_remove_ignored(_my_obj):
-            remove_list.extend([
-                endpoint.name for endpoint in self.sdnc.endpoints.values()
-                if endpoint.ignore])
-            return {}
+    def handler_action_remove_ignored(self, _my_objs, _faucet_event, remove_list):
+        remove_list.extend([
+            endpoint.name for endpoint in self.sdnc.ignored_endpoints()])
 
-        def handler_faucet_event(my_obj):
-            if self.sdnc and self.sdnc.sdnc:
-                faucet_event.append(my_obj)
-                return my_obj
-            return {}
-
-        handlers = {
-            'poseidon.algos.decider': handler_algos_decider,
-            'poseidon.action.ignore': handler_action_ignore,
-            'poseidon.action.clear.ignored': handler_action_clear_ignored,
-            'poseidon.action.change': handler_action_change,
-            'poseidon.action.update_acls': handler_action_update_acls,
-            'poseidon.action.remove': handler_action_remove,
-            'poseidon.action.remove.ignored': handler_action_remove_ignored,
-            self.config['FA_RABBIT_ROUTING_KEY']: handler_faucet_event,
-        }
+    def handler_action_changes_since(self, my_objs, _faucet_event, _remove_list):
+        ''' replay endpoint changes to consumers catching up, each message being {"seq": n, "epoch": epoch[, "reply_to": routing_key]}. '''
+        for my_obj in my_objs:
+            try:
+                seq = int(my_obj.get('seq', 0))
+            except (AttributeError, TypeError, ValueError) as e:
+                self.logger.error(
+                    'Invalid endpoint changes request {0}: {1}'.format(my_obj, str(e)))
+                continue
+            self.sdnc.publish_changes_since(
+                seq, my_obj.get('epoch', None), my_obj.get('reply_to', None))
 
-        handler = handlers.get(routing_key, None)
-        if handler is not None:
-            ret_val = handler(my_obj)
-            return ret_val, True
-
-        self.logger.error(
-            'no handler for routing_key {0}'.format(routing_key))
-        return {}, False
+    def handler_faucet_event(self, my_objs, faucet_event, _remove_list):
+        # FAUCET events are all handled by one check_endpoints() later in the pass.
+        if self.sdnc and self.sdnc.sdnc:
+            faucet_event.extend(my_objs)
 
     def update_prom_var_time(self, var, label_name, label_value):
         if self.prom:
@@ -187,14 +239,25 @@ class SDNEvents:
         faucet_event = []
         remove_list = []
         while True:
-            found_work, rabbit_msg = self.prom.runtime_callable(
-                partial(self.get_q_item, self.m_queue))
-            if not found_work:
+            items = self.get_q_items(self.m_queue, self.RABBIT_BATCH_SIZE)
+            if not items:
                 break
-            events += 1
-            # faucet_event and remove_list get updated as references because partial()
-            self.prom.runtime_callable(
-                partial(self.format_rabbit_message, rabbit_msg, faucet_event, remove_list))
+            events += len(items)
+            # handle runs of messages with the same routing key together,
+            # keeping the order of messages with different routing keys.
+            for routing_key, run in groupby(items, key=itemgetter(0)):
+                my_objs = [my_obj for _, my_obj in run]
+                _, handler_name = self.rabbit_handlers.get(
+                    routing_key, (None, None))
+                if handler_name is None:
+                    self.format_rabbit_messages(
+                        routing_key, my_objs, faucet_event, remove_list)
+                    continue
+                # faucet_event and remove_list get updated as references because partial()
+                self.prom.runtime_callable(
+                    partial(self.format_rabbit_messages, routing_key,
+                            my_objs, faucet_event, remove_list),
+                    method_name=handler_name)
         return (events, faucet_event, remove_list)
 
     def ignore_rabbit(self, routing_key, body):
@@ -205,20 +268,52 @@ class SDNEvents:
                     return True
         return False
 
-    def rabbit_callback(self, ch, method, _properties, body, q=None):
-        ''' callback, places rabbit data into internal queue'''
+    def queue_rabbit_message(self, routing_key, body, q):
+        ''' decode a rabbit message, and place it into the internal queue unless ignored. '''
         body = json.loads(body)
         self.logger.debug('got a message: {0}:{1} (qsize {2})'.format(
-            method.routing_key, body, q.qsize()))
+            routing_key, body, q.qsize()))
+        self.update_prom_var_time(
+            'last_rabbitmq_routing_key_time', 'routing_key', routing_key)
+        if not self.ignore_rabbit(routing_key, body):
+            q.put((routing_key, body))
+
+    def rabbit_callback(self, ch, method, _properties, body, q=None):
+        ''' callback, places rabbit data into internal queue'''
         if q is not None:
-            self.update_prom_var_time(
-                'last_rabbitmq_routing_key_time', 'routing_key', method.routing_key)
-            if not self.ignore_rabbit(method.routing_key, body):
-                q.put((method.routing_key, body))
+            self.queue_rabbit_message(method.routing_key, body, q)
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
+    def rabbit_messages(self, messages, q=None):
+        ''' AsyncRabbit callback, places a batch of (routing_key, body) into internal queue. '''
+        for routing_key, body in messages:
+            try:
+                self.queue_rabbit_message(routing_key, body, q)
+            except ValueError as e:
+                self.logger.error(
+                    'Unable to decode message for {0}: {1}'.format(routing_key, str(e)))
+
+    def wait_for_work(self, scheduler=None):
+        '''
+        block until there is new work or a scheduled job is due, and then
+        for up to batching_window seconds more, to handle bursts together.
+        '''
+        timeout = None
+        if scheduler is not None:
+            timeout = scheduler.idle_seconds()
+            if timeout is not None:
+                timeout = max(timeout, 0)
+        if self.wakeup.wait(timeout) and self.batching_window:
+            time.sleep(self.batching_window)
+        if scheduler is not None:
+            # due jobs are put on job_queue.
+            scheduler.run_pending()
+        # anything put from here on wakes the next wait.
+        self.wakeup.clear()
+
     def process(self, monitor):
         while True:
+            self.wait_for_work(monitor.schedule)
             events, faucet_event, remove_list = self.prom.runtime_callable(
                 self.handle_rabbit)
             if remove_list:
@@ -228,15 +323,39 @@ class SDNEvents:
             if faucet_event:
                 self.prom.runtime_callable(
                     partial(self.sdnc.check_endpoints, faucet_event))
+            events += self.prom.runtime_callable(self.sdnc.update_rdns)
             # schedule_mirroring should be abstracted out
             events += self.prom.runtime_callable(monitor.schedule_mirroring)
-            found_work, schedule_func = self.prom.runtime_callable(
-                partial(self.get_q_item, self.job_queue))
-            if found_work and callable(schedule_func):
-                events += self.prom.runtime_callable(schedule_func)
+            while True:
+                found_work, schedule_func = self.prom.runtime_callable(
+                    partial(self.get_q_item, self.job_queue))
+                if not found_work:
+                    break
+                if callable(schedule_func):
+                    events += self.prom.runtime_callable(schedule_func)
+            self.prom.runtime_callable(self.sdnc.flush_sdn)
+            self.prom.update_faucet_config_metrics(self.sdnc.sdn_config_stats())
             if events:
                 self.prom.update_endpoint_metadata(self.sdnc.endpoints)
-            time.sleep(1)
+                self.sdnc.store_endpoints()
+                # work done this pass (e.g. timed out mirrors freeing budget)
+                # may let schedule_mirroring do more, so don't wait to rerun it.
+                self.wakeup.set()
+            # changes are published as deltas, but snapshots are also due without events.
+            self.sdnc.publish_endpoints()
+            self.sdnc.publish_changes()
+
+    @staticmethod
+    def get_q_items(q, max_items):
+        ''' return up to max_items work items from the queue, without blocking. '''
+        items = []
+        try:
+            while len(items) < max_items:
+                items.append(q.get_nowait())
+                q.task_done()
+        except queue.Empty:
+            pass
+        return items
 
     @staticmethod
     def get_q_item(q):
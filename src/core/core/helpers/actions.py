@@ -9,38 +9,63 @@ from poseidon_core.operations.volos.acls import VolosAcl
 
 class Actions:
 
-    def __init__(self, endpoint, sdnc):
+    def __init__(self, endpoint, sdnc, config=None):
         self.endpoint = endpoint
         self.sdnc = sdnc
+        self.config = config
+
+    def _collectors(self, endpoints, sdnc_method):
+        '''
+        call sdnc_method for each endpoint and send the resulting controller
+        changes, returning statuses and collectors of endpoints it succeeded for.
+        '''
+        statuses = [False] * len(endpoints)
+        succeeded = []
+        for i, endpoint in enumerate(endpoints):
+            endpoint_data = endpoint.endpoint_data
+            if sdnc_method(endpoint_data['mac'], endpoint_data['segment'], endpoint_data['port']):
+                succeeded.append((i, endpoint))
+        collectors = {}
+        if not self.sdnc.flush():
+            return statuses, collectors
+        for i, endpoint in succeeded:
+            collector = Collector(
+                endpoint, endpoint.endpoint_data['segment'], config=self.config)
+            if collector.nic:
+                collectors[i] = collector
+        return statuses, collectors
+
+    def mirror_endpoints(self, endpoints):
+        '''
+        tell network_tap to start collectors and the controller to begin
+        mirroring traffic, for several endpoints
+        '''
+        if not self.sdnc:
+            return [True] * len(endpoints)
+        statuses, collectors = self._collectors(endpoints, self.sdnc.mirror_mac)
+        for i, status in zip(collectors, Collector.start_collectors(list(collectors.values()))):
+            statuses[i] = status
+        return statuses
+
+    def unmirror_endpoints(self, endpoints):
+        ''' tell the controller to unmirror traffic, and network_tap to stop collectors, for several endpoints '''
+        if not self.sdnc:
+            return [True] * len(endpoints)
+        statuses, collectors = self._collectors(endpoints, self.sdnc.unmirror_mac)
+        for i, status in zip(collectors, Collector.stop_collectors(list(collectors.values()))):
+            statuses[i] = status
+        return statuses
 
     def mirror_endpoint(self):
         '''
         tell network_tap to start a collector and the controller to begin
         mirroring traffic
         '''
-        status = False
-        if self.sdnc:
-            endpoint_data = self.endpoint.endpoint_data
-            if self.sdnc.mirror_mac(endpoint_data['mac'], endpoint_data['segment'], endpoint_data['port']):
-                collector = Collector(self.endpoint, endpoint_data['segment'])
-                if collector.nic:
-                    status = collector.start_collector()
-        else:
-            status = True
-        return status
+        return self.mirror_endpoints([self.endpoint])[0]
 
     def unmirror_endpoint(self):
         ''' tell the controller to unmirror traffic '''
-        status = False
-        if self.sdnc:
-            endpoint_data = self.endpoint.endpoint_data
-            if self.sdnc.unmirror_mac(endpoint_data['mac'], endpoint_data['segment'], endpoint_data['port']):
-                collector = Collector(self.endpoint, endpoint_data['segment'])
-                if collector.nic:
-                    status = collector.stop_collector()
-        else:
-            status = True
-        return status
+        return self.unmirror_endpoints([self.endpoint])[0]
 
     def coprocess_endpoint(self):
         '''
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Change data capture for endpoints: sequence numbered change records, kept
+in a bounded log so consumers that missed some can catch up.
+"""
+import itertools
+import json
+import uuid
+from collections import deque
+
+from poseidon_core.helpers.endpoint import HEARTBEAT_FIELDS
+
+
+class EndpointChangeLog:
+    '''
+    Sequence numbered records of changes to endpoints, captured from the
+    EndpointRegistry's dirty tracking (so every mutation that marks an
+    endpoint dirty is captured, whatever made it).
+
+    Each record has a seq, the endpoint name and an op: "update" (with
+    the changed fields and their new values, e.g. {"state": "operating"}
+    or {"endpoint_data.port": "2"}), "put" (with the whole endpoint, when
+    which fields changed isn't known, e.g. a new endpoint) or "remove".
+
+    Changes only to HEARTBEAT_FIELDS (e.g. observed_time, on every L2_LEARN)
+    are not recorded, and are left out of update records.
+
+    Sequence numbers restart from 1 with a new epoch (e.g. when Poseidon
+    restarts), so consumers should resync if the epoch changes.
+    '''
+
+    CONSUMER = 'changes'
+    # most records per published message.
+    BATCH_SIZE = 1000
+
+    def __init__(self, size=10000):
+        self.registry = None
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.log = deque(maxlen=size)
+
+    @staticmethod
+    def field_value(endpoint, field):
+        if field.startswith('endpoint_data.'):
+            endpoint_data = endpoint.endpoint_data
+            if endpoint_data is None:
+                return None
+            return endpoint_data.get(field[len('endpoint_data.'):], None)
+        return getattr(endpoint, field, None)
+
+    @staticmethod
+    def put_record(endpoint):
+        return {'name': endpoint.name, 'op': 'put', 'endpoint': json.loads(endpoint.encode())}
+
+    def _append(self, record):
+        self.seq += 1
+        record['seq'] = self.seq
+        self.log.append(record)
+        return record
+
+    def capture(self, endpoints):
+        ''' log changes to endpoints (an EndpointRegistry) since the last capture, and return the new records. '''
+        if endpoints is not self.registry:
+            # start a new epoch, consumers resync to get the current endpoints.
+            self.registry = endpoints
+            self.epoch = uuid.uuid4().hex
+            self.seq = 0
+            self.log.clear()
+            endpoints.pop_dirty(self.CONSUMER)
+            return []
+        records = [
+            self._append({'name': name, 'op': 'remove'})
+            for name in endpoints.pop_removed(self.CONSUMER)]
+        for name, (endpoint, fields) in endpoints.pop_dirty_fields(self.CONSUMER).items():
+            if fields is None:
+                record = self.put_record(endpoint)
+            else:
+                fields = fields - HEARTBEAT_FIELDS
+                if not fields:
+                    continue
+                record = {'name': name, 'op': 'update', 'fields': {
+                    field: self.field_value(endpoint, field) for field in sorted(fields)}}
+            records.append(self._append(record))
+        return records
+
+    def since(self, seq):
+        ''' return the records after seq, or None if they are no longer all logged. '''
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.log or self.log[0]['seq'] > seq + 1:
+            return None
+        return list(itertools.islice(self.log, seq + 1 - self.log[0]['seq'], None))
+
+    def snapshot(self, endpoints):
+        ''' return put records for all endpoints, as of the current seq. '''
+        records = []
+        for endpoint in endpoints:
+            record = self.put_record(endpoint)
+            record['seq'] = self.seq
+            records.append(record)
+        return records
+
+    def messages(self, routing_key, records, resync=False):
+        ''' return (routing_key, body) messages of records, in batches (at least one message). '''
+        messages = []
+        for start in range(0, max(len(records), 1), self.BATCH_SIZE):
+            message = {'epoch': self.epoch, 'seq': self.seq,
+                       'changes': records[start:start + self.BATCH_SIZE]}
+            if resync:
+                message['resync'] = True
+            messages.append((routing_key, json.dumps(message)))
+        return messages
@@ -6,16 +6,79 @@ Created on 9 December 2018
 import ast
 import json
 import logging
+import threading
+import time
 
 import httpx
 from poseidon_core.helpers.config import Config
 
 
+class NetworkTapClient:
+    '''
+    Client for the network_tap API, keeping a pool of connections to it
+    and applying timeouts to every request. If request_secs is set (to a
+    Histogram with an action label), the time of each request is observed.
+    '''
+
+    DEFAULT_TIMEOUT = 10
+    DEFAULT_CONNECT_TIMEOUT = 2
+
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.logger = logging.getLogger('collector')
+        self.base_uri = 'http://' + address
+        self.client = httpx.Client(
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_keepalive_connections=4))
+        self.request_secs = None
+
+    @staticmethod
+    def parse_response(text):
+        ''' return network_tap's response, which may be JSON or a Python literal. '''
+        try:
+            return json.loads(text)
+        except ValueError:
+            return ast.literal_eval(text)
+
+    def request(self, action, method='POST', payload=None):
+        ''' make a request to network_tap's action endpoint, returning the response text. '''
+        start = time.monotonic()
+        try:
+            resp = self.client.request(
+                method, '/'.join((self.base_uri, action)), json=payload)
+            return resp.text
+        finally:
+            if self.request_secs is not None:
+                self.request_secs.labels(action=action).observe(
+                    time.monotonic() - start)
+
+    def close(self):
+        self.client.close()
+
+
+# network_tap address -> NetworkTapClient shared by all collectors using it.
+_network_tap_clients = {}
+_network_tap_clients_lock = threading.Lock()
+
+
+def get_network_tap_client(config):
+    ''' return the shared NetworkTapClient for the network_tap in config. '''
+    address = ':'.join((config['network_tap_ip'], str(config['network_tap_port'])))
+    with _network_tap_clients_lock:
+        client = _network_tap_clients.get(address, None)
+        if client is None:
+            client = NetworkTapClient(address)
+            _network_tap_clients[address] = client
+    return client
+
+
 class Collector(object):
 
-    def __init__(self, endpoint, switch, iterations=1):
+    def __init__(self, endpoint, switch, iterations=1, config=None):
         self.logger = logging.getLogger('collector')
-        self.config = Config().get_config()
+        if config is None:
+            config = Config().get_snapshot()
+        self.config = config
+        self.client = get_network_tap_client(config)
         self.endpoint = endpoint
         self.id = endpoint.name
         self.mac = endpoint.endpoint_data['mac']
@@ -33,13 +96,8 @@ class Collector(object):
         self.interval = str(self.config['reinvestigation_frequency'])
         self.iterations = str(iterations)
 
-    def start_collector(self):
-        '''
-        Starts collector for a given endpoint with the
-        options passed in at the creation of the class instance.
-        '''
-        status = False
-        payload = {
+    def create_payload(self):
+        return {
             'nic': self.nic,
             'id': self.id,
             'interval': self.interval,
@@ -47,23 +105,30 @@ class Collector(object):
             'iters': self.iterations,
             'metadata': "{'endpoint_data': " + str(self.endpoint.endpoint_data) + '}'}
 
+    def start_collector(self):
+        '''
+        Starts collector for a given endpoint with the
+        options passed in at the creation of the class instance.
+        '''
+        status = False
+        payload = self.create_payload()
         self.logger.debug('Payload: {0}'.format(str(payload)))
 
-        network_tap_addr = self.config['network_tap_ip'] + \
-            ':' + self.config['network_tap_port']
-        uri = 'http://' + network_tap_addr + '/create'
-
         try:
-            resp = httpx.post(uri, json=payload)
+            text = self.client.request('create', payload=payload)
             # TODO improve logged output
             self.logger.debug(
-                'Collector response: {0}'.format(resp.text))
-            response = ast.literal_eval(resp.text)
+                'Collector response: {0}'.format(text))
+            response = self.client.parse_response(text)
             if response[0]:
                 self.logger.info(
                     'Successfully started the collector for: {0}'.format(self.id))
-                self.endpoint.endpoint_data['container_id'] = response[1].rsplit(
+                # assign a changed copy, so the change is tracked (and stored).
+                endpoint_data = self.endpoint.endpoint_data.copy()
+                endpoint_data['container_id'] = response[1].rsplit(
                     ':', 1)[-1].strip()
+                self.endpoint.set_endpoint_data(
+                    endpoint_data, changed_fields={'container_id'})
                 status = True
             else:
                 self.logger.error(
@@ -77,45 +142,65 @@ class Collector(object):
         '''
         Stops collector for a given endpoint.
         '''
-        status = False
-        if 'container_id' not in self.endpoint.endpoint_data:
-            self.logger.warning(
-                'No collector to stop because no container_id for endpoint')
-            return True
+        return self.stop_collectors([self])[0]
 
-        payload = {'id': [self.endpoint.endpoint_data['container_id']]}
-        self.logger.debug('Payload: {0}'.format(str(payload)))
-
-        network_tap_addr = self.config['network_tap_ip'] + \
-            ':' + self.config['network_tap_port']
-        uri = 'http://' + network_tap_addr + '/stop'
+    @staticmethod
+    def start_collectors(collectors):
+        '''
+        Starts collectors for several endpoints, over the shared connection
+        pool, returning a list of their statuses.
+        '''
+        return [collector.start_collector() for collector in collectors]
 
+    @staticmethod
+    def stop_collectors(collectors):
+        '''
+        Stops collectors for several endpoints, with one request per network_tap,
+        returning a list of their statuses.
+        '''
+        statuses = [True] * len(collectors)
+        client_collectors = {}
+        for i, collector in enumerate(collectors):
+            if 'container_id' not in collector.endpoint.endpoint_data:
+                collector.logger.warning(
+                    'No collector to stop because no container_id for endpoint')
+                continue
+            client_collectors.setdefault(collector.client, []).append(i)
+        for client, indexes in client_collectors.items():
+            status = Collector._stop(
+                client, [collectors[i] for i in indexes])
+            for i in indexes:
+                statuses[i] = status
+        return statuses
+
+    @staticmethod
+    def _stop(client, collectors):
+        logger = collectors[0].logger
+        ids = [collector.id for collector in collectors]
+        payload = {'id': [
+            collector.endpoint.endpoint_data['container_id'] for collector in collectors]}
+        logger.debug('Payload: {0}'.format(str(payload)))
         try:
-            resp = httpx.post(uri, json=payload)
-            self.logger.debug(
-                'Collector response: {0}'.format(resp.text))
-            response = ast.literal_eval(resp.text)
+            text = client.request('stop', payload=payload)
+            logger.debug(
+                'Collector response: {0}'.format(text))
+            response = client.parse_response(text)
             if response[0]:
-                self.logger.info(
-                    'Successfully stopped the collector for: {0}'.format(self.id))
-                status = True
-            else:
-                self.logger.error(
-                    'Failed to stop collector because response failed with: {0}'.format(response[1]))
+                logger.info(
+                    'Successfully stopped the collector for: {0}'.format(', '.join(ids)))
+                return True
+            logger.error(
+                'Failed to stop collector because response failed with: {0}'.format(response[1]))
         except Exception as e:  # pragma: no cover
-            self.logger.error(
+            logger.error(
                 'Failed to stop collector because: {0}'.format(str(e)))
-        return status
+        return False
 
     # returns a dictionary of existing collectors keyed on dev_hash
     def get_collectors(self):
-        network_tap_addr = self.config['network_tap_ip'] + \
-            ':' + self.config['network_tap_port']
-        uri = 'http://' + network_tap_addr + '/list'
         collectors = {}
         try:
-            resp = httpx.get(uri)
-            text = resp.text
+            text = self.client.request('list', method='GET')
             # TODO need to parse out text
             self.logger.debug('collector list response: ' + text)
         except Exception as e:  # pragma: no cover
@@ -4,30 +4,61 @@ Created on 5 December 2018
 @author: Charlie Lewis
 """
 import configparser
+import copy
+import hashlib
 import json
 import logging
 import os
 import tempfile
+import threading
 from distutils import util
+from types import MappingProxyType
 
 import yaml
 from poseidon_core.helpers.exception_decor import exception
 
 
+# config path -> ((mtime, size) of the file, read only snapshot parsed from it).
+_config_snapshots = {}
+_config_snapshots_lock = threading.Lock()
+
+
 class Config():
+    '''
+    Poseidon configuration. The config file is parsed once into a read only
+    snapshot shared by the whole process, and reparsed only when its mtime
+    or size changes.
+    '''
 
     def __init__(self):
         self.logger = logging.getLogger('config')
-        self.config = configparser.RawConfigParser()
-        self.config.optionxform = str
         if os.environ.get('POSEIDON_CONFIG') is not None:
             self.config_path = os.environ.get('POSEIDON_CONFIG')
         else:  # pragma: no cover
             raise Exception(
                 'Could not find poseidon config. Make sure to set the POSEIDON_CONFIG environment variable')
-        self.config.read_file(open(self.config_path, 'r'))
+
+    def get_snapshot(self):
+        ''' return the read only config, reparsing the file only if it changed. '''
+        stat = os.stat(self.config_path)
+        file_version = (stat.st_mtime_ns, stat.st_size)
+        with _config_snapshots_lock:
+            cached = _config_snapshots.get(self.config_path, None)
+            if cached is not None and cached[0] == file_version:
+                return cached[1]
+            snapshot = MappingProxyType(self._parse_config())
+            _config_snapshots[self.config_path] = (file_version, snapshot)
+        return snapshot
 
     def get_config(self):
+        ''' return a copy of the config, that the caller may modify. '''
+        return copy.deepcopy(dict(self.get_snapshot()))
+
+    def _parse_config(self):
+        config = configparser.RawConfigParser()
+        config.optionxform = str
+        with open(self.config_path, 'r') as f:
+            config.read_file(f)
         # set some defaults
         controller = {
             'TYPE': 'faucet',
@@ -41,8 +72,20 @@ class Config():
             'logger_level': 'INFO',
             'faucetconfrpc_address': 'faucetconfrpc:59999',
             'faucetconfrpc_client': 'faucetconfrpc',
+            'faucetconfrpc_cache_ttl': 60,
             'prometheus_ip': 'prometheus',
             'prometheus_port': 9090,
+            'endpoint_store_file': None,
+            'endpoint_feed_file': None,
+            'endpoint_feed_snapshot_frequency': 60,
+            'publish_endpoint_changes': True,
+            'endpoint_changes_log_size': 10000,
+            'event_batching_window': 0.05,
+            'rabbit_consumer': 'blocking',
+            'rabbit_prefetch_count': 100,
+            'rdns_timeout': 5.0,
+            'rdns_async': False,
+            'config_check_frequency': 10,
         }
 
         config_map = {
@@ -64,10 +107,19 @@ class Config():
             'ignore_ports': ('ignore_ports', [json.loads]),
             'trunk_ports': ('trunk_ports', [json.loads]),
             'logger_level': ('logger_level', []),
+            'faucetconfrpc_cache_ttl': ('faucetconfrpc_cache_ttl', [int]),
+            'event_batching_window': ('event_batching_window', [float]),
+            'rabbit_prefetch_count': ('rabbit_prefetch_count', [int]),
+            'rdns_timeout': ('rdns_timeout', [float]),
+            'rdns_async': ('rdns_async', [util.strtobool]),
+            'config_check_frequency': ('config_check_frequency', [int]),
+            'endpoint_feed_snapshot_frequency': ('endpoint_feed_snapshot_frequency', [int]),
+            'publish_endpoint_changes': ('publish_endpoint_changes', [util.strtobool]),
+            'endpoint_changes_log_size': ('endpoint_changes_log_size', [int]),
         }
 
-        for section in self.config.sections():
-            for key, val in self.config[section].items():
+        for section in config.sections():
+            for key, val in config[section].items():
                 if isinstance(val, str):
                     val = val.strip("'")
                 controller_key, val_funcs = config_map.get(key, (key, []))
@@ -82,12 +134,96 @@ class Config():
         return controller
 
 
+class ConfigWatcher:
+    '''
+    Watches the config file, and when it changes calls each subscriber
+    with the new snapshot and the set of keys whose values changed.
+    check() is expected to be called periodically (e.g. by the scheduler).
+    '''
+
+    def __init__(self, config=None):
+        self.logger = logging.getLogger('config')
+        if config is None:
+            config = Config()
+        self.config = config
+        self.snapshot = config.get_snapshot()
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def check(self):
+        ''' reload the config if it changed, and return the keys that changed. '''
+        try:
+            snapshot = self.config.get_snapshot()
+        except (OSError, configparser.Error) as e:
+            self.logger.error(
+                'Unable to reload config {0} because: {1}'.format(self.config.config_path, str(e)))
+            return set()
+        if snapshot is self.snapshot:
+            return set()
+        changed = {
+            key for key in set(snapshot) | set(self.snapshot)
+            if snapshot.get(key, None) != self.snapshot.get(key, None)}
+        self.snapshot = snapshot
+        if changed:
+            self.logger.info('Config changed: {0}'.format(sorted(changed)))
+            for callback in self.subscribers:
+                callback(snapshot, changed)
+        return changed
+
+
+def apply_config_changes(config, snapshot, changed):
+    ''' update a config dict from get_config() with the changed keys of snapshot. '''
+    for key in changed:
+        if key in snapshot:
+            config[key] = copy.deepcopy(snapshot[key])
+        else:
+            config.pop(key, None)
+
+
 def represent_none(dumper, _):
     return dumper.represent_scalar('tag:yaml.org,2002:null', '')
 
 
+# config file -> ((mtime, size), sha256 of content, parsed doc) of the last parse.
+_parsed_yaml_cache = {}
+
+
 def parse_rules(config_file):
-    obj_doc = yaml_in(config_file)
+    obj_doc = cached_yaml_in(config_file)
+    return obj_doc
+
+
+def cached_yaml_in(config_file):
+    '''
+    yaml_in(), but reusing the previous parse while the file's mtime and size,
+    or failing that its content, are unchanged. The returned doc is shared,
+    so must not be modified.
+    '''
+    try:
+        stat = os.stat(config_file)
+    except (OSError, TypeError):
+        _parsed_yaml_cache.pop(config_file, None)
+        return yaml_in(config_file)
+    file_version = (stat.st_mtime_ns, stat.st_size)
+    cached = _parsed_yaml_cache.get(config_file, None)
+    if cached is not None and cached[0] == file_version:
+        return cached[2]
+    try:
+        with open(config_file, 'rb') as stream:
+            content = stream.read()
+    except OSError:  # pragma: no cover
+        return False
+    digest = hashlib.sha256(content).hexdigest()
+    if cached is not None and cached[1] == digest:
+        obj_doc = cached[2]
+    else:
+        try:
+            obj_doc = yaml.safe_load(content)
+        except yaml.YAMLError:
+            obj_doc = False
+    _parsed_yaml_cache[config_file] = (file_version, digest, obj_doc)
     return obj_doc
 
 
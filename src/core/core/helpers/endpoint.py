@@ -5,16 +5,22 @@ Created on 3 December 2018
 """
 import hashlib
 import json
+import sys
 import time
+from collections.abc import Mapping
+from collections.abc import MutableMapping
 
 from poseidon_core.constants import NO_DATA
-from transitions import Machine
+from transitions import MachineError
 
 MACHINE_IP_FIELDS = {
     'ipv4': ('ipv4_rdns', 'ipv4_subnet'),
     'ipv6': ('ipv6_rdns', 'ipv6_subnet')}
 MACHINE_IP_PREFIXES = {
     'ipv4': 24, 'ipv6': 64}
+# fields updated whenever an endpoint is seen again (see Endpoint.touch()), so
+# changes only to these aren't worth telling other processes about.
+HEARTBEAT_FIELDS = frozenset(('observed_time',))
 
 
 def transit_wrap(trigger, source, dest, before=None, after=None):
@@ -34,6 +40,192 @@ def endpoint_copro_transit_wrap(trigger, source, dest):
     return transit_wrap(trigger, source, dest, after='_update_copro_state_time')
 
 
+class EndpointMachine:
+    '''
+    Table driven state machine for one state family (state or copro_state).
+
+    A single EndpointMachine is shared by every Endpoint, rather than each
+    endpoint building (and binding trigger methods from) its own
+    transitions.Machine. Triggers are looked up in a (trigger, source)
+    table and are installed once as Endpoint methods, so the trigger API
+    (endpoint.operate(), endpoint.copro_queue(), etc) is unchanged.
+    '''
+
+    def __init__(self, name, model_attribute, states, transitions, initial):
+        self.name = name
+        self.model_attribute = model_attribute
+        self.states = states
+        self.initial = initial
+        self.table = {}
+        for transition in transitions:
+            self.table[(transition['trigger'], transition['source'])] = (
+                transition['dest'], transition.get('after', None))
+        self.triggers = tuple(sorted(
+            {trigger for trigger, _ in self.table}))
+
+    def trigger(self, model, trigger):
+        if trigger not in self.triggers:
+            raise KeyError(trigger)
+        source = getattr(model, self.model_attribute)
+        try:
+            dest, after = self.table[(trigger, source)]
+        except KeyError:
+            raise MachineError(
+                f"{model.name[:8]} Can't trigger event {trigger} from state {source}!")
+        setattr(model, self.model_attribute, dest)
+        if after is not None:
+            getattr(model, after)()
+        return True
+
+    def trigger_method(self, trigger):
+        def trigger_method(model):
+            return self.trigger(model, trigger)
+        trigger_method.__name__ = trigger
+        return trigger_method
+
+
+_MISSING = object()
+
+
+class EndpointData(MutableMapping):
+    '''
+    Compact record of an endpoint's network data (mac, segment, port, etc).
+
+    The fields the controllers report are kept in slots, with strings
+    shared by many endpoints (switch, VLAN, vendor, subnet, etc) interned,
+    and anything else in a small overflow dict. It behaves as a dict (so
+    endpoint.endpoint_data['mac'], .get(), `in`, == with a dict and
+    dict(endpoint_data) all work), and copies are shallow since values
+    are scalars.
+    '''
+
+    FIELDS = (
+        'mac', 'segment', 'port', 'vlan', 'tenant', 'active',
+        'ipv4', 'ipv6', 'ipv4_subnet', 'ipv6_subnet', 'ipv4_rdns', 'ipv6_rdns',
+        'ether_vendor', 'controller_type', 'controller', 'name', 'container_id')
+    INTERNED_FIELDS = frozenset((
+        'segment', 'port', 'vlan', 'tenant', 'ipv4_subnet', 'ipv6_subnet',
+        'ether_vendor', 'controller_type', 'controller'))
+    _FIELD_SET = frozenset(FIELDS)
+
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, *args, **kwargs):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, _MISSING)
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    @classmethod
+    def from_value(cls, value):
+        ''' convert a dict to an EndpointData (None and EndpointData pass through). '''
+        if value is None or isinstance(value, cls):
+            return value
+        return cls(value)
+
+    def __getitem__(self, key):
+        if key in self._FIELD_SET:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._FIELD_SET:
+            if key in self.INTERNED_FIELDS and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELD_SET:
+            if getattr(self, key) is _MISSING:
+                raise KeyError(key)
+            setattr(self, key, _MISSING)
+            return
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._FIELD_SET:
+            return getattr(self, key) is not _MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field) is not _MISSING:
+                yield field
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        fields = len([
+            field for field in self.FIELDS if getattr(self, field) is not _MISSING])
+        return fields + len(self._extra or ())
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, _memo):
+        return self.copy()
+
+    def copy(self):
+        return EndpointData(self)
+
+    def changed_fields(self, other):
+        ''' return the set of keys added, removed or changed in other (a mapping) relative to this record. '''
+        changed = {key for key, value in self.items()
+                   if other.get(key, _MISSING) != value}
+        changed.update(key for key in other if key not in self)
+        return changed
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+def endpoint_data_field(key):
+    ''' name of an endpoint_data key, as reported in an endpoint's changed fields. '''
+    return 'endpoint_data.' + key
+
+
+def _notifying_property(attr, notify):
+    private_attr = '_' + attr
+    fields = (attr,)
+
+    def getter(endpoint):
+        return getattr(endpoint, private_attr)
+
+    def setter(endpoint, value):
+        setattr(endpoint, private_attr, value)
+        notify(endpoint, fields)
+
+    return property(getter, setter)
+
+
+def indexed_property(attr):
+    ''' attribute that reindexes and marks the endpoint dirty when assigned. '''
+    return _notifying_property(attr, lambda endpoint, fields: endpoint.reindex(fields))
+
+
+def tracked_property(attr):
+    ''' attribute that marks the endpoint dirty when assigned. '''
+    return _notifying_property(attr, lambda endpoint, fields: endpoint.mark_dirty(fields))
+
+
 class Endpoint:
 
     states = ['known', 'unknown', 'operating', 'queued']
@@ -80,7 +272,14 @@ class Endpoint:
             'copro_coprocess', 'copro_suspicious', 'copro_coprocessing'),
     ]
 
+    __slots__ = (
+        'registry', 'name', '_ignore', '_copro_ignore', '_endpoint_data',
+        '_p_next_state', '_p_prev_state', 'p_next_copro_state', 'p_prev_copro_state',
+        '_acl_data', '_metadata', '_state', '_copro_state',
+        'state_time', 'copro_state_time', 'observed_time', 'investigation_time')
+
     def __init__(self, hashed_val):
+        self.registry = None
         self.name = hashed_val.strip()
         self.ignore = False
         self.copro_ignore = False
@@ -96,9 +295,57 @@ class Endpoint:
         self.state_time = 0
         self.copro_state_time = 0
         self.observed_time = 0
+        # when the endpoint last started being investigated (0 if never).
+        self.investigation_time = 0
+
+    def reindex(self, fields=None):
+        if self.registry is not None:
+            self.registry.reindex(self)
+            self.registry.mark_dirty(self, fields)
+
+    def mark_dirty(self, fields=None):
+        ''' flag this endpoint as needing to be exported again, with the fields that changed if known. '''
+        if self.registry is not None:
+            self.registry.mark_dirty(self, fields)
+
+    # Assigning any of these updates the EndpointRegistry indexes and dirty set.
+    # Note that modifying endpoint_data or metadata in place is not detected:
+    # assign a new dict (as find_new_machines does) or call mark_dirty().
+    # endpoint_data is stored as a compact EndpointData record, and changes
+    # to it are reported per key (see endpoint_data_field()).
+    state = indexed_property('state')
+    copro_state = indexed_property('copro_state')
+    ignore = indexed_property('ignore')
+    copro_ignore = indexed_property('copro_ignore')
+    metadata = tracked_property('metadata')
+    acl_data = tracked_property('acl_data')
+    p_next_state = tracked_property('p_next_state')
+    p_prev_state = tracked_property('p_prev_state')
+
+    @property
+    def endpoint_data(self):
+        return self._endpoint_data
+
+    @endpoint_data.setter
+    def endpoint_data(self, endpoint_data):
+        self.set_endpoint_data(endpoint_data)
+
+    def set_endpoint_data(self, endpoint_data, changed_fields=None):
+        ''' assign endpoint_data, given the keys that changed (if not given, they are computed). '''
+        endpoint_data = EndpointData.from_value(endpoint_data)
+        old_endpoint_data = getattr(self, '_endpoint_data', None)
+        if changed_fields is None and old_endpoint_data is not None and endpoint_data is not None:
+            changed_fields = old_endpoint_data.changed_fields(endpoint_data)
+        self._endpoint_data = endpoint_data
+        fields = None
+        if changed_fields is not None:
+            fields = tuple(endpoint_data_field(key) for key in changed_fields)
+        self.reindex(fields)
 
     def _update_state_time(self, *args, **kwargs):
         self.state_time = time.time()
+        if self.state == 'operating':
+            self.investigation_time = self.state_time
 
     def _update_copro_state_time(self, *args, **kwargs):
         self.copro_state_time = time.time()
@@ -109,12 +356,13 @@ class Endpoint:
             'state': self.state,
             'copro_state': self.copro_state,
             'ignore': self.ignore,
-            'endpoint_data': self.endpoint_data,
+            'endpoint_data': self.endpoint_data.to_dict() if self.endpoint_data is not None else None,
             'p_next_state': self.p_next_state,
             'p_prev_state': self.p_prev_state,
             'acl_data': self.acl_data,
             'metadata': self.metadata,
             'observed_time': self.observed_time,
+            'investigation_time': self.investigation_time,
         }
         return str(json.dumps(endpoint_d))
 
@@ -151,6 +399,7 @@ class Endpoint:
 
     def touch(self):
         self.observed_time = time.time()
+        self.mark_dirty(('observed_time',))
 
     def observed_timeout(self, timeout):
         return time.time() - self.observed_time > timeout
@@ -172,9 +421,7 @@ class Endpoint:
         self.queue()  # pytype: disable=attribute-error
 
     def machine_trigger(self, state):
-        # pytype: disable=attribute-error
-        self.machine.events[state].trigger(self)
-        # pytype: enable=attribute-error
+        return self.machine.trigger(self, state)
 
     def trigger_next(self):
         self.p_prev_state = self.state
@@ -187,9 +434,7 @@ class Endpoint:
         self.copro_queue()  # pytype: disable=attribute-error
 
     def copro_machine_trigger(self, state):
-        # pytype: disable=attribute-error
-        self.copro_machine.events[state].trigger(self)
-        # pytype: enable=attribute-error
+        return self.copro_machine.trigger(self, state)
 
     def copro_trigger_next(self):
         if self.p_next_copro_state:
@@ -233,26 +478,19 @@ class Endpoint:
         return post_h
 
 
+Endpoint.machine = EndpointMachine(
+    'state', 'state', Endpoint.states, Endpoint.transitions, 'unknown')
+Endpoint.copro_machine = EndpointMachine(
+    'copro_state', 'copro_state', Endpoint.copro_states, Endpoint.copro_transitions, 'copro_unknown')
+for _machine in (Endpoint.machine, Endpoint.copro_machine):
+    for _trigger in _machine.triggers:
+        setattr(Endpoint, _trigger, _machine.trigger_method(_trigger))
+
+
 def endpoint_factory(hashed_val):
     endpoint = Endpoint(hashed_val)
-    machine = Machine(
-        model=endpoint,
-        model_attribute='state',
-        states=Endpoint.states,
-        transitions=Endpoint.transitions,
-        initial='unknown',
-        send_event=True)
-    machine.name = endpoint.name[:8]+' '
-    endpoint.machine = machine
-    copro_machine = Machine(
-        model=endpoint,
-        model_attribute='copro_state',
-        states=Endpoint.copro_states,
-        transitions=Endpoint.copro_transitions,
-        initial='copro_unknown',
-        send_event=True)
-    copro_machine.name = endpoint.name[:8]+'_copro'
-    endpoint.copro_machine = copro_machine
+    endpoint.state = Endpoint.machine.initial
+    endpoint.copro_state = Endpoint.copro_machine.initial
     return endpoint
 
 
@@ -273,6 +511,7 @@ class EndpointDecoder:
         self.endpoint.p_next_state = e['p_next_state']
         self.endpoint.p_prev_state = e.get('p_prev_state', None)
         self.endpoint.observed_time = e.get('observed_time', 0)
+        self.endpoint.investigation_time = e.get('investigation_time', 0)
 
     def get_endpoint(self):
         return self.endpoint
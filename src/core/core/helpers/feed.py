@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only feed of endpoints for other processes (e.g. the API), written as
+a snapshot file plus a log of deltas, so readers can keep an up to date
+replica without going through Prometheus.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+
+
+class EndpointFeed:
+    '''
+    Endpoint feed that doesn't publish anything (feed disabled).
+    '''
+
+    enabled = False
+
+    def snapshot_due(self):
+        return False
+
+    def put_snapshot(self, endpoints):
+        return
+
+    def put_delta(self, endpoints, removed):
+        return
+
+    def close(self):
+        return
+
+
+class FileEndpointFeed(EndpointFeed):
+    '''
+    Endpoint feed written to files, which readers poll:
+
+    path: a snapshot, being a header line ({"snapshot": id, "seq": n})
+    followed by one Endpoint.encode() record per line.
+
+    path.deltas: a header line ({"snapshot": id}) naming the snapshot
+    the deltas apply to, followed by one line per delta
+    ({"seq": n, "removed": [names], "put": [records]}).
+
+    Both files are replaced atomically when a new snapshot is written, the
+    snapshot first. A reader that finds a deltas header naming a snapshot
+    other than the one it has should (re)load the snapshot, and should only
+    apply complete (newline terminated) delta lines.
+    '''
+
+    enabled = True
+
+    def __init__(self, path, snapshot_secs=60):
+        self.logger = logging.getLogger('feed')
+        self.path = path
+        self.deltas_path = path + '.deltas'
+        self.snapshot_secs = snapshot_secs
+        self.snapshot_id = None
+        self.snapshot_time = 0
+        self.seq = 0
+        self.deltas = None
+
+    def snapshot_due(self):
+        return self.snapshot_id is None or time.time() - self.snapshot_time >= self.snapshot_secs
+
+    def _replace(self, path, lines):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for line in lines:
+                f.write(line)
+                f.write('\n')
+        os.replace(tmp_path, path)
+
+    def put_snapshot(self, endpoints):
+        snapshot_id = uuid.uuid4().hex
+        self.close()
+        self.snapshot_id = None
+        try:
+            self._replace(self.path, [json.dumps({'snapshot': snapshot_id, 'seq': self.seq})] + [
+                endpoint.encode() for endpoint in endpoints])
+            self._replace(self.deltas_path, [
+                json.dumps({'snapshot': snapshot_id})])
+            self.deltas = open(self.deltas_path, 'a')
+        except OSError as e:
+            self.logger.error(
+                'Unable to write endpoint feed {0} because: {1}'.format(self.path, str(e)))
+            return
+        self.snapshot_id = snapshot_id
+        self.snapshot_time = time.time()
+
+    def put_delta(self, endpoints, removed):
+        records = [endpoint.encode() for endpoint in endpoints]
+        if not records and not removed:
+            return
+        if self.deltas is None:
+            return
+        self.seq += 1
+        try:
+            self.deltas.write('{{"seq": {0}, "removed": {1}, "put": [{2}]}}\n'.format(
+                self.seq, json.dumps(list(removed)), ', '.join(records)))
+            self.deltas.flush()
+        except OSError as e:
+            self.logger.error(
+                'Unable to write endpoint feed {0} because: {1}'.format(self.deltas_path, str(e)))
+            # start again from a new snapshot.
+            self.close()
+            self.snapshot_id = None
+
+    def close(self):
+        if self.deltas is not None:
+            try:
+                self.deltas.close()
+            except OSError:  # pragma: no cover
+                pass
+            self.deltas = None
+
+
+def get_endpoint_feed(config):
+    ''' return the endpoint feed configured by endpoint_feed_file, if any. '''
+    logger = logging.getLogger('feed')
+    path = config.get('endpoint_feed_file', None)
+    if path:
+        if os.path.isdir(os.path.dirname(path) or '.'):
+            return FileEndpointFeed(
+                path, snapshot_secs=config.get('endpoint_feed_snapshot_frequency', 60))
+        logger.warning(
+            'Directory for endpoint feed {0} does not exist, not publishing endpoints'.format(path))
+    return EndpointFeed()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Priority queue of endpoints waiting to be investigated (mirrored), so the
+Monitor can pick the most deserving endpoints within its budget without
+rescanning and sorting every endpoint each time.
+"""
+import heapq
+import itertools
+import time
+
+
+class InvestigationQueue:
+    '''
+    Heaps of candidate endpoints, one per candidate state (queued and known)
+    and whether the endpoint has an operation requested, so callers wanting
+    only endpoints with (or without) a request never scan past the others.
+
+    Endpoints are ordered by (never investigated first, then) their last
+    investigation time, pushed later in proportion to the confidence of
+    their top role: an endpoint classified with confidence 1.0 is treated
+    as if investigated one reinvestigation_frequency more recently, so
+    poorly classified endpoints are reinvestigated sooner.
+
+    The heaps are maintained incrementally from the EndpointRegistry's
+    dirty tracking (see sync()), with stale heap entries discarded lazily
+    when they reach the top.
+    '''
+
+    CONSUMER = 'investigations'
+    CANDIDATE_STATES = ('queued', 'known')
+
+    def __init__(self, confidence_secs=0):
+        self.confidence_secs = confidence_secs
+        self.registry = None
+        self.heaps = self._new_heaps()
+        # name -> (heap key, priority) of the endpoint's current heap entry.
+        self.entries = {}
+        self.counter = itertools.count()
+
+    @classmethod
+    def _new_heaps(cls):
+        return {
+            (state, requested): []
+            for state in cls.CANDIDATE_STATES for requested in (True, False)}
+
+    @staticmethod
+    def heap_key(endpoint):
+        return (endpoint.state, endpoint.operation_requested())
+
+    def reset(self, confidence_secs=None):
+        ''' rebuild the heaps on the next sync(), e.g. because priorities were reconfigured. '''
+        if confidence_secs is not None:
+            self.confidence_secs = confidence_secs
+        self.registry = None
+
+    @staticmethod
+    def top_confidence(endpoint):
+        _, confidences, _ = endpoint.get_roles_confidences_pcap_labels()
+        try:
+            return min(max(float(confidences[0]), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def priority(self, endpoint):
+        ''' return the heap key for an endpoint, lowest is investigated first. '''
+        investigation_time = endpoint.investigation_time
+        if not investigation_time:
+            return (0, endpoint.state_time)
+        return (1, investigation_time + self.confidence_secs * self.top_confidence(endpoint))
+
+    def update(self, endpoint):
+        ''' (re)queue an endpoint after it changed, or drop it if it is no longer a candidate. '''
+        name = endpoint.name
+        if endpoint.ignore or endpoint.state not in self.CANDIDATE_STATES:
+            self.entries.pop(name, None)
+            return
+        entry = (self.heap_key(endpoint), self.priority(endpoint))
+        if self.entries.get(name, None) == entry:
+            return
+        self.entries[name] = entry
+        heapq.heappush(
+            self.heaps[entry[0]], (entry[1], next(self.counter), name))
+
+    def _compact(self, key):
+        heap = self.heaps[key]
+        heap[:] = [
+            item for item in heap
+            if self.entries.get(item[2], None) == (key, item[0])]
+        heapq.heapify(heap)
+
+    def sync(self, endpoints):
+        ''' apply changes to endpoints (an EndpointRegistry) since the last sync. '''
+        if endpoints is not self.registry:
+            self.registry = endpoints
+            self.entries = {}
+            self.heaps = self._new_heaps()
+            endpoints.pop_dirty(self.CONSUMER)
+            for endpoint in endpoints.values():
+                self.update(endpoint)
+            return
+        for name in endpoints.pop_removed(self.CONSUMER):
+            self.entries.pop(name, None)
+        for endpoint in endpoints.pop_dirty(self.CONSUMER).values():
+            self.update(endpoint)
+        for key, heap in self.heaps.items():
+            if len(heap) > 2 * len(self.entries) + 64:
+                self._compact(key)
+
+    def top(self, state, count, requested=None):
+        ''' return up to count endpoints in state in priority order, with (or without) an operation requested if requested is given. '''
+        keys = [
+            (state, key_requested) for key_requested in (True, False)
+            if requested is None or key_requested == requested]
+        selected = []
+        popped = []
+        seen = set()
+        while len(selected) < count:
+            heads = [(self.heaps[key][0], key) for key in keys if self.heaps[key]]
+            if not heads:
+                break
+            item, key = min(heads)
+            heapq.heappop(self.heaps[key])
+            priority, _, name = item
+            # stale entries are dropped for good.
+            if name in seen or self.entries.get(name, None) != (key, priority):
+                continue
+            seen.add(name)
+            popped.append((key, item))
+            endpoint = self.registry.get(name, None)
+            if endpoint is not None:
+                selected.append(endpoint)
+        # Selected endpoints stay queued until their state change is synced.
+        for key, item in popped:
+            heapq.heappush(self.heaps[key], item)
+        return selected
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def investigation_ages(endpoints, now=None):
+        ''' return seconds since last investigation, for each endpoint that has been investigated. '''
+        if now is None:
+            now = time.time()
+        return [
+            now - endpoint.investigation_time
+            for endpoint in endpoints if endpoint.investigation_time]
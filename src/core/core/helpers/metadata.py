@@ -3,31 +3,127 @@
 Created on 19 February 2019
 @author: Charlie Lewis
 """
-import functools
+import logging
+import os
 import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import partial
 
 from poseidon_core.constants import NO_DATA
 
 
-@functools.lru_cache()
+class OUIIndex:
+    '''
+    Index of an nmap-mac-prefixes style file (hex prefix, whitespace, vendor),
+    supporting 24, 28 and 36 bit (6, 7 and 9 hex digit) prefixes.
+
+    The file is read once into per prefix length dicts, and reread when its
+    mtime changes (checked at most every RELOAD_CHECK_SECS).
+    '''
+
+    PREFIX_LENS = (9, 7, 6)
+    RELOAD_CHECK_SECS = 10
+
+    def __init__(self, lookup_path):
+        self.logger = logging.getLogger('metadata')
+        self.lookup_path = lookup_path
+        self.prefixes = {}
+        self.mtime = None
+        self.last_check = None
+
+    def _load(self):
+        prefixes = {prefix_len: {} for prefix_len in self.PREFIX_LENS}
+        with open(self.lookup_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or line.startswith('#'):
+                    continue
+                prefix = fields[0].upper()
+                prefix_vendors = prefixes.get(len(prefix), None)
+                if prefix_vendors is not None:
+                    prefix_vendors.setdefault(prefix, sys.intern(fields[1]))
+        self.prefixes = prefixes
+
+    def check_reload(self):
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.RELOAD_CHECK_SECS:
+            return
+        self.last_check = now
+        mtime = os.stat(self.lookup_path).st_mtime_ns
+        if mtime != self.mtime:
+            self._load()
+            self.mtime = mtime
+            self.logger.debug('loaded {0} OUI prefixes from {1}'.format(
+                sum(len(prefix_vendors) for prefix_vendors in self.prefixes.values()), self.lookup_path))
+
+    def vendor(self, mac):
+        self.check_reload()
+        if self.mtime is None:
+            return NO_DATA
+        mac = ''.join(mac.split(':')).upper()
+        for prefix_len in self.PREFIX_LENS:
+            vendor = self.prefixes[prefix_len].get(mac[:prefix_len], None)
+            if vendor is not None:
+                return vendor
+        return None
+
+
+# lookup path -> OUIIndex for that file.
+_oui_indexes = {}
+
+
 def get_ether_vendor(mac, lookup_path):
     """
     Takes a MAC address and looks up and returns the vendor for it.
     """
-    mac = ''.join(mac.split(':'))[:6].upper()
     try:
-        with open(lookup_path, 'r') as f:
-            for line in f:
-                if line.startswith(mac):
-                    return line.split()[1].strip()
+        oui_index = _oui_indexes.get(lookup_path, None)
+        if oui_index is None:
+            oui_index = OUIIndex(lookup_path)
+            _oui_indexes[lookup_path] = oui_index
+        return oui_index.vendor(mac)
     except Exception:  # pragma: no cover
         return NO_DATA
 
 
 class DNSResolver:
+    '''
+    Reverse DNS resolver, with a long lived pool of resolver threads and a
+    bounded LRU cache of results (failed lookups, NO_DATA, are cached for
+    NEGATIVE_TTL rather than TTL).
+
+    resolve_ips() waits at most timeout seconds for lookups; those still
+    running are returned as NO_DATA, and once they finish their results are
+    cached and returned by pop_resolved(), so callers can fill them in later.
+    If set, on_resolved is called (from a resolver thread) whenever a lookup
+    finishes, so callers needn't poll pop_resolved().
+    '''
 
     TIMEOUT = 5
+    CACHE_SIZE = 4096
+    TTL = 3600
+    NEGATIVE_TTL = 300
+
+    def __init__(self, timeout=TIMEOUT, cache_size=CACHE_SIZE, ttl=TTL,
+                 negative_ttl=NEGATIVE_TTL, max_workers=None, on_resolved=None):
+        self.timeout = timeout
+        self.on_resolved = on_resolved
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.RLock()
+        # ip -> (result, expiry time), least recently used first.
+        self.cache = OrderedDict()
+        # ip -> future for lookups in progress.
+        self.pending = {}
+        # ip -> result for lookups that finished since the last pop_resolved().
+        self.resolved = {}
 
     @staticmethod
     def _resolve_ip(ip):
@@ -36,9 +132,73 @@ class DNSResolver:
             if result == ip:
                 return NO_DATA
             return result
-        except socket.gaierror:
+        except (socket.gaierror, socket.herror):
             return NO_DATA
 
-    def resolve_ips(self, ips):
-        with ThreadPoolExecutor() as executor:
-            return {ip: result for ip, result in zip(ips, executor.map(DNSResolver()._resolve_ip, list(ips)))}
+    def _cached(self, ip, now):
+        cached = self.cache.get(ip, None)
+        if cached is None:
+            return None
+        result, expiry = cached
+        if now > expiry:
+            del self.cache[ip]
+            return None
+        self.cache.move_to_end(ip)
+        return result
+
+    def _cache_result(self, ip, future):
+        try:
+            result = future.result()
+        except Exception:  # pragma: no cover
+            result = NO_DATA
+        ttl = self.ttl
+        if result == NO_DATA:
+            ttl = self.negative_ttl
+        with self.lock:
+            self.pending.pop(ip, None)
+            self.cache[ip] = (result, time.monotonic() + ttl)
+            self.cache.move_to_end(ip)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            self.resolved[ip] = result
+        if self.on_resolved is not None:
+            self.on_resolved()
+
+    def pop_resolved(self):
+        ''' return ip -> result for lookups that finished since the last call. '''
+        with self.lock:
+            resolved = self.resolved
+            self.resolved = {}
+        return resolved
+
+    def resolve_ips(self, ips, timeout=None):
+        ''' return ip -> rdns name (or NO_DATA), waiting up to timeout (default self.timeout) for lookups. '''
+        if timeout is None:
+            timeout = self.timeout
+        results = {}
+        futures = {}
+        now = time.monotonic()
+        with self.lock:
+            for ip in ips:
+                result = self._cached(ip, now)
+                if result is not None:
+                    results[ip] = result
+                    continue
+                future = self.pending.get(ip, None)
+                if future is None:
+                    future = self.executor.submit(self._resolve_ip, ip)
+                    self.pending[ip] = future
+                    future.add_done_callback(partial(self._cache_result, ip))
+                futures[ip] = future
+        if futures and timeout:
+            wait(futures.values(), timeout=timeout)
+        with self.lock:
+            for ip, future in futures.items():
+                result = NO_DATA
+                if future.done():
+                    # returned now, so not needed from pop_resolved().
+                    self.resolved.pop(ip, None)
+                    if not future.exception():
+                        result = future.result()
+                results[ip] = result
+        return results
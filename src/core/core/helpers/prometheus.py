@@ -6,9 +6,9 @@ Created on 5 December 2018
 import datetime
 import ipaddress
 import logging
-import re
 import time
 from collections import defaultdict
+from functools import partial
 
 import httpx
 from poseidon_core import __version__
@@ -16,8 +16,10 @@ from poseidon_core.constants import NO_DATA
 from poseidon_core.helpers.config import Config
 from poseidon_core.helpers.endpoint import Endpoint
 from poseidon_core.helpers.endpoint import EndpointDecoder
+from poseidon_core.helpers.registry import EndpointRegistry
 from prometheus_client import Counter
 from prometheus_client import Gauge
+from prometheus_client import Histogram
 from prometheus_client import Info
 from prometheus_client import start_http_server
 from prometheus_client import Summary
@@ -25,25 +27,47 @@ from prometheus_client import Summary
 
 class Prometheus():
 
+    # per endpoint gauges whose value is the time the endpoint was last exported.
+    ENDPOINT_TIME_GAUGES = (
+        'endpoints', 'endpoint_state', 'endpoint_os', 'endpoint_role',
+        'endpoint_ip', 'endpoint_metadata')
+    # endpoint fields that no exported label depends on.
+    UNLABELLED_ENDPOINT_FIELDS = frozenset(('observed_time',))
+    # upper bounds (secs) of the endpoints_investigation_age buckets.
+    INVESTIGATION_AGE_BUCKETS = (3600, 6 * 3600, 86400, 7 * 86400)
+
     def __init__(self):
         self.logger = logging.getLogger('prometheus')
         self.prom_metrics = {}
+        # metric var -> hash_id -> label values last set for that endpoint.
+        self.endpoint_series = defaultdict(dict)
+        # endpoint gauge var -> its label names, in order.
+        self.endpoint_labels = {}
+        # metric var -> label values last set for aggregate gauges.
+        self.aggregate_series = defaultdict(set)
+        # method name -> method_runtime_secs child for that method.
+        self.method_runtimes = {}
         self.config = Config().get_config()
         self.prometheus_addr = self.config['prometheus_ip'] + \
             ':' + self.config['prometheus_port']
 
+    def _add_endpoint_gauge(self, var, name, documentation, labels):
+        self.endpoint_labels[var] = tuple(labels)
+        self.prom_metrics[var] = Gauge(name, documentation, labels)
+
     def initialize_metrics(self):
+        self.method_runtimes = {}
         self.prom_metrics['info'] = Info(
             'poseidon_version', 'Info about Poseidon')
-        self.prom_metrics['ipv4_table'] = Gauge('poseidon_endpoint_ip_table',
-                                                'IP Table',
-                                                ['mac',
-                                                 'tenant',
-                                                 'segment',
-                                                 'port',
-                                                 'role',
-                                                 'ipv4_os',
-                                                 'hash_id'])
+        self._add_endpoint_gauge('ipv4_table', 'poseidon_endpoint_ip_table',
+                                 'IP Table',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'port',
+                                  'role',
+                                  'ipv4_os',
+                                  'hash_id'])
         self.prom_metrics['roles'] = Gauge('poseidon_endpoint_roles',
                                            'Number of endpoints by role',
                                            ['role'])
@@ -74,116 +98,132 @@ class Prometheus():
         self.prom_metrics['method_runtime_secs'] = Summary('poseidon_method_runtime_secs',
                                                            'Time spent in Monitor methods',
                                                            ['method'])
-        self.prom_metrics['endpoint_role_confidence_top'] = Gauge('poseidon_role_confidence_top',
-                                                                  'Confidence of top role prediction',
-                                                                  ['mac',
-                                                                   'name',
-                                                                   'role',
-                                                                   'pcap_labels',
-                                                                   'ipv4_os',
-                                                                   'ipv4_address',
-                                                                   'ipv6_address',
-                                                                   'hash_id'])
-        self.prom_metrics['endpoint_role_confidence_second'] = Gauge('poseidon_role_confidence_second',
-                                                                     'Confidence of second role prediction',
-                                                                     ['mac',
-                                                                      'name',
-                                                                      'role',
-                                                                      'pcap_labels',
-                                                                      'ipv4_os',
-                                                                      'ipv4_address',
-                                                                      'ipv6_address',
-                                                                      'hash_id'])
-        self.prom_metrics['endpoint_role_confidence_third'] = Gauge('poseidon_role_confidence_third',
-                                                                    'Confidence of third role prediction',
-                                                                    ['mac',
-                                                                     'name',
-                                                                     'role',
-                                                                     'pcap_labels',
-                                                                     'ipv4_os',
-                                                                     'ipv4_address',
-                                                                     'ipv6_address',
-                                                                     'hash_id'])
-        self.prom_metrics['endpoints'] = Gauge('poseidon_endpoints',
-                                               'All endpoints',
-                                               ['mac',
-                                                'tenant',
-                                                'segment',
-                                                'ether_vendor',
-                                                'controller_type',
-                                                'controller',
-                                                'name',
-                                                'port',
-                                                'hash_id'])
-        self.prom_metrics['endpoint_state'] = Gauge('poseidon_endpoint_state',
-                                                    'State for all endpoints',
-                                                    ['mac',
-                                                     'tenant',
-                                                     'segment',
-                                                     'ether_vendor',
-                                                     'name',
-                                                     'port',
-                                                     'state',
-                                                     'hash_id'])
-        self.prom_metrics['endpoint_os'] = Gauge('poseidon_endpoint_os',
-                                                 'Operating System for all endpoints',
-                                                 ['mac',
-                                                  'tenant',
-                                                  'segment',
-                                                  'ether_vendor',
-                                                  'name',
-                                                  'port',
-                                                  'ipv4_os',
-                                                  'hash_id'])
-        self.prom_metrics['endpoint_role'] = Gauge('poseidon_endpoint_role',
-                                                   'Top role for all endpoints',
-                                                   ['mac',
-                                                    'tenant',
-                                                    'segment',
-                                                    'ether_vendor',
-                                                    'name',
-                                                    'port',
-                                                    'top_role',
-                                                    'hash_id'])
-        self.prom_metrics['endpoint_ip'] = Gauge('poseidon_endpoint_ip',
-                                                 'IP Address for all endpoints',
-                                                 ['mac',
-                                                  'tenant',
-                                                  'segment',
-                                                  'ether_vendor',
-                                                  'name',
-                                                  'port',
-                                                  'ipv4_address',
-                                                  'ipv6_address',
-                                                  'ipv4_subnet',
-                                                  'ipv6_subnet',
-                                                  'ipv4_rdns',
-                                                  'ipv6_rdns',
-                                                  'hash_id'])
-        self.prom_metrics['endpoint_metadata'] = Gauge('poseidon_endpoint_metadata',
-                                                       'Metadata for all endpoints',
-                                                       ['mac',
-                                                        'tenant',
-                                                        'segment',
-                                                        'ether_vendor',
-                                                        'prev_state',
-                                                        'next_state',
-                                                        'acls',
-                                                        'ignore',
-                                                        'ipv4_subnet',
-                                                        'ipv6_subnet',
-                                                        'ipv4_rdns',
-                                                        'ipv6_rdns',
-                                                        'controller_type',
-                                                        'controller',
-                                                        'name',
-                                                        'state',
-                                                        'port',
-                                                        'top_role',
-                                                        'ipv4_os',
-                                                        'ipv4_address',
-                                                        'ipv6_address',
-                                                        'hash_id'])
+        self.prom_metrics['collector_request_secs'] = Histogram('poseidon_collector_request_secs',
+                                                                'Time spent in requests to network_tap, by action',
+                                                                ['action'])
+        self.prom_metrics['faucet_config_cache'] = Counter('poseidon_faucet_config_cache',
+                                                           'FAUCET config cache lookups, by hit, miss or refresh (TTL expired)',
+                                                           ['result'])
+        self.prom_metrics['endpoint_investigation_age_max'] = Gauge('poseidon_endpoint_investigation_age_max_secs',
+                                                                    'Most seconds since any endpoint was last investigated')
+        self.prom_metrics['endpoints_investigation_age'] = Gauge('poseidon_endpoints_investigation_age',
+                                                                 'Number of investigated endpoints last investigated at most le seconds ago',
+                                                                 ['le'])
+        self.prom_metrics['endpoints_never_investigated'] = Gauge('poseidon_endpoints_never_investigated',
+                                                                  'Number of endpoints not investigated yet')
+        self.prom_metrics['metric_series'] = Gauge('poseidon_metric_series',
+                                                   'Number of label sets currently exported per metric',
+                                                   ['metric'])
+        self._add_endpoint_gauge('endpoint_role_confidence_top', 'poseidon_role_confidence_top',
+                                 'Confidence of top role prediction',
+                                 ['mac',
+                                  'name',
+                                  'role',
+                                  'pcap_labels',
+                                  'ipv4_os',
+                                  'ipv4_address',
+                                  'ipv6_address',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_role_confidence_second', 'poseidon_role_confidence_second',
+                                 'Confidence of second role prediction',
+                                 ['mac',
+                                  'name',
+                                  'role',
+                                  'pcap_labels',
+                                  'ipv4_os',
+                                  'ipv4_address',
+                                  'ipv6_address',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_role_confidence_third', 'poseidon_role_confidence_third',
+                                 'Confidence of third role prediction',
+                                 ['mac',
+                                  'name',
+                                  'role',
+                                  'pcap_labels',
+                                  'ipv4_os',
+                                  'ipv4_address',
+                                  'ipv6_address',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoints', 'poseidon_endpoints',
+                                 'All endpoints',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'ether_vendor',
+                                  'controller_type',
+                                  'controller',
+                                  'name',
+                                  'port',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_state', 'poseidon_endpoint_state',
+                                 'State for all endpoints',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'ether_vendor',
+                                  'name',
+                                  'port',
+                                  'state',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_os', 'poseidon_endpoint_os',
+                                 'Operating System for all endpoints',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'ether_vendor',
+                                  'name',
+                                  'port',
+                                  'ipv4_os',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_role', 'poseidon_endpoint_role',
+                                 'Top role for all endpoints',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'ether_vendor',
+                                  'name',
+                                  'port',
+                                  'top_role',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_ip', 'poseidon_endpoint_ip',
+                                 'IP Address for all endpoints',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'ether_vendor',
+                                  'name',
+                                  'port',
+                                  'ipv4_address',
+                                  'ipv6_address',
+                                  'ipv4_subnet',
+                                  'ipv6_subnet',
+                                  'ipv4_rdns',
+                                  'ipv6_rdns',
+                                  'hash_id'])
+        self._add_endpoint_gauge('endpoint_metadata', 'poseidon_endpoint_metadata',
+                                 'Metadata for all endpoints',
+                                 ['mac',
+                                  'tenant',
+                                  'segment',
+                                  'ether_vendor',
+                                  'prev_state',
+                                  'next_state',
+                                  'acls',
+                                  'ignore',
+                                  'ipv4_subnet',
+                                  'ipv6_subnet',
+                                  'ipv4_rdns',
+                                  'ipv6_rdns',
+                                  'controller_type',
+                                  'controller',
+                                  'name',
+                                  'state',
+                                  'port',
+                                  'top_role',
+                                  'ipv4_os',
+                                  'ipv4_address',
+                                  'ipv6_address',
+                                  'hash_id'])
 
     @staticmethod
     def get_metrics():
@@ -211,34 +251,75 @@ class Prometheus():
             metrics['current_states'][host['state']] += 1
 
         if self.prom_metrics:
+            current_hosts = set()
             for host in hosts:
                 if host['ipv4']:
-                    self.prom_metrics['ipv4_table'].labels(mac=host['mac'],
-                                                           tenant=host['tenant'],
-                                                           segment=host['segment'],
-                                                           port=host['port'],
-                                                           role=host['role'],
-                                                           ipv4_os=host['ipv4_os'],
-                                                           hash_id=host['id']).set(int(ipaddress.ip_address(host['ipv4'])))
-            for role in metrics['roles']:
-                self.prom_metrics['roles'].labels(
-                    role=role).set(metrics['roles'][role])
-            for os_t in metrics['oses']:
-                self.prom_metrics['oses'].labels(
-                    ipv4_os=os_t).set(metrics['oses'][os_t])
-            for current_state in metrics['current_states']:
-                self.prom_metrics['current_states'].labels(current_state=current_state).set(
-                    metrics['current_states'][current_state])
-            for vlan in metrics['vlans']:
-                self.prom_metrics['vlans'].labels(
-                    tenant=vlan).set(metrics['vlans'][vlan])
-            for port_tenant in metrics['port_tenants']:
-                self.prom_metrics['port_tenants'].labels(port=port_tenant[0],
-                                                         tenant=port_tenant[1]).set(metrics['port_tenants'][port_tenant])
-            for port_host in metrics['port_hosts']:
-                self.prom_metrics['port_hosts'].labels(
-                    port=port_host).set(metrics['port_hosts'][port_host])
+                    current_hosts.add(host['id'])
+                    self._set_endpoint_prom(
+                        'ipv4_table', host['id'], int(ipaddress.ip_address(host['ipv4'])),
+                        {'mac': host['mac'],
+                         'tenant': host['tenant'],
+                         'segment': host['segment'],
+                         'port': host['port'],
+                         'role': host['role'],
+                         'ipv4_os': host['ipv4_os'],
+                         'hash_id': host['id']})
+            for hash_id in set(self.endpoint_series['ipv4_table']) - current_hosts:
+                self._remove_endpoint_prom('ipv4_table', hash_id)
+            self._set_aggregate_prom('roles', {
+                (role,): count for role, count in metrics['roles'].items()})
+            self._set_aggregate_prom('oses', {
+                (os_t,): count for os_t, count in metrics['oses'].items()})
+            self._set_aggregate_prom('current_states', {
+                (current_state,): count for current_state, count in metrics['current_states'].items()})
+            self._set_aggregate_prom('vlans', {
+                (vlan,): count for vlan, count in metrics['vlans'].items()})
+            self._set_aggregate_prom('port_tenants', dict(
+                metrics['port_tenants']))
+            self._set_aggregate_prom('port_hosts', {
+                (port_host,): count for port_host, count in metrics['port_hosts'].items()})
             self.prom_metrics['info'].info(metrics['info'])
+            self.update_series_counts()
+
+    def update_investigation_ages(self, ages, never_investigated):
+        ''' export the max and cumulative buckets of seconds since endpoints were last investigated. '''
+        if not self.prom_metrics:
+            return
+        self.prom_metrics['endpoint_investigation_age_max'].set(
+            max(ages, default=0))
+        buckets = {
+            (bucket,): sum(1 for age in ages if age <= bucket)
+            for bucket in self.INVESTIGATION_AGE_BUCKETS}
+        buckets[('+Inf',)] = len(ages)
+        self._set_aggregate_prom('endpoints_investigation_age', buckets)
+        self.prom_metrics['endpoints_never_investigated'].set(
+            never_investigated)
+
+    def _set_aggregate_prom(self, var, counts):
+        ''' set an aggregate gauge, removing label sets no longer counted. '''
+        metric = self.prom_metrics[var]
+        label_values = {
+            tuple(str(label_value) for label_value in labels): count
+            for labels, count in counts.items()}
+        for old_label_values in self.aggregate_series[var] - set(label_values):
+            try:
+                metric.remove(*old_label_values)
+            except KeyError:  # pragma: no cover
+                pass
+        for labels, count in label_values.items():
+            metric.labels(*labels).set(count)
+        self.aggregate_series[var] = set(label_values)
+
+    def update_series_counts(self):
+        ''' export how many label sets each tracked metric currently has. '''
+        if 'metric_series' not in self.prom_metrics:
+            return
+        for var in set(self.endpoint_series) | set(self.aggregate_series):
+            count = len(self.endpoint_series.get(var, ())) + \
+                len(self.aggregate_series.get(var, ()))
+            metric_name = self.prom_metrics[var].describe()[0].name
+            self.prom_metrics['metric_series'].labels(
+                metric=metric_name).set(count)
 
     @staticmethod
     def latest_metric(metric):
@@ -393,115 +474,158 @@ class Prometheus():
         hashes, role_hashes = self.scrape_prom()
         return self.prom_endpoints(hashes, role_hashes)
 
-    def runtime_callable(self, method):
-        method_name = str(method)
-        method_re = re.compile(r'.+bound method (\S+).+')
-        method_match = method_re.match(method_name)
-        if method_match:
-            method_name = method_match.group(1)
-        with self.prom_metrics['method_runtime_secs'].labels(method=method_name).time():
+    def update_faucet_config_metrics(self, stats):
+        for result, count in stats.items():
+            if count:
+                self.prom_metrics['faucet_config_cache'].labels(
+                    result=result).inc(count)
+
+    @staticmethod
+    def runtime_method_name(method):
+        ''' return the method label runtime_callable() uses, e.g. SDNEvents.handle_rabbit. '''
+        while isinstance(method, partial):
+            method = method.func
+        return getattr(method, '__qualname__', str(method))
+
+    def runtime_callable(self, method, method_name=None):
+        if method_name is None:
+            method_name = self.runtime_method_name(method)
+        method_runtime = self.method_runtimes.get(method_name, None)
+        if method_runtime is None:
+            method_runtime = self.prom_metrics['method_runtime_secs'].labels(
+                method=method_name)
+            self.method_runtimes[method_name] = method_runtime
+        with method_runtime.time():
             return method()
 
-    def update_endpoint_metadata(self, endpoints):
-        update_time = time.time()
-        for hash_id, endpoint in endpoints.items():
-            ipv4 = endpoint.endpoint_data['ipv4']
-            ipv6 = endpoint.endpoint_data['ipv6']
-            ipv4_subnet = endpoint.endpoint_data['ipv4_subnet']
-            ipv6_subnet = endpoint.endpoint_data['ipv6_subnet']
-            ipv4_rdns = endpoint.endpoint_data['ipv4_rdns']
-            ipv6_rdns = endpoint.endpoint_data['ipv6_rdns']
-            port = endpoint.endpoint_data['port']
-            tenant = endpoint.endpoint_data['tenant']
-            segment = endpoint.endpoint_data['segment']
-            ether_vendor = endpoint.endpoint_data['ether_vendor']
-            controller = endpoint.endpoint_data['controller']
-            controller_type = endpoint.endpoint_data['controller_type']
-            roles, confidences, pcap_labels = endpoint.get_roles_confidences_pcap_labels()
-            top_role, second_role, third_role = roles
-            top_conf, second_conf, third_conf = confidences
-            ipv4_os = endpoint.get_ipv4_os()
-
-            def set_prom(var, val, **prom_labels):
-                prom_labels.update({
-                    'mac': endpoint.endpoint_data['mac'],
-                    'name': endpoint.endpoint_data['name'],
-                    'hash_id': hash_id,
-                })
-                try:
-                    self.prom_metrics[var].labels(**prom_labels).set(val)
-                except ValueError:
-                    pass
-
-            def set_prom_role(var, val, role):
-                set_prom(
-                    var,
-                    val,
-                    role=role,
+    def _remove_endpoint_prom(self, var, hash_id):
+        old_label_values = self.endpoint_series[var].pop(hash_id, None)
+        if old_label_values is not None:
+            try:
+                self.prom_metrics[var].remove(*old_label_values)
+            except KeyError:  # pragma: no cover
+                pass
+
+    def _set_endpoint_prom(self, var, hash_id, val, prom_labels):
+        ''' set an endpoint gauge, removing the series it previously set if its labels changed. '''
+        metric = self.prom_metrics[var]
+        try:
+            label_values = tuple(str(prom_labels[label])
+                                 for label in self.endpoint_labels[var])
+        except KeyError as e:
+            self.logger.error(
+                'Not exporting {0} for {1}, missing label {2}'.format(var, hash_id, str(e)))
+            return
+        if self.endpoint_series[var].get(hash_id, label_values) != label_values:
+            self._remove_endpoint_prom(var, hash_id)
+        self.endpoint_series[var][hash_id] = label_values
+        try:
+            metric.labels(*label_values).set(val)
+        except ValueError:
+            pass
+
+    def remove_endpoint(self, hash_id):
+        ''' remove all series exported for an endpoint. '''
+        for var in list(self.endpoint_series):
+            self._remove_endpoint_prom(var, hash_id)
+
+    def touch_endpoint(self, hash_id, update_time):
+        ''' update the time of an endpoint's gauges, if they have been exported and none of their labels changed. '''
+        if hash_id not in self.endpoint_series['endpoints']:
+            return False
+        for var in self.ENDPOINT_TIME_GAUGES:
+            label_values = self.endpoint_series[var].get(hash_id, None)
+            if label_values is not None:
+                self.prom_metrics[var].labels(*label_values).set(update_time)
+        return True
+
+    def update_endpoint(self, hash_id, endpoint, update_time):
+        endpoint_data = endpoint.endpoint_data
+        ipv4 = endpoint_data['ipv4']
+        ipv6 = endpoint_data['ipv6']
+        ip_labels = {
+            'ipv4_subnet': endpoint_data['ipv4_subnet'],
+            'ipv6_subnet': endpoint_data['ipv6_subnet'],
+            'ipv4_rdns': endpoint_data['ipv4_rdns'],
+            'ipv6_rdns': endpoint_data['ipv6_rdns'],
+        }
+        controller_labels = {
+            'controller': endpoint_data['controller'],
+            'controller_type': endpoint_data['controller_type'],
+        }
+        roles, confidences, pcap_labels = endpoint.get_roles_confidences_pcap_labels()
+        top_role = roles[0]
+        ipv4_os = endpoint.get_ipv4_os()
+        base_labels = {
+            'mac': endpoint_data['mac'],
+            'name': endpoint_data['name'],
+            'hash_id': hash_id,
+        }
+
+        role_labels = dict(
+            base_labels,
+            ipv4_os=ipv4_os,
+            ipv4_address=ipv4,
+            ipv6_address=ipv6,
+            pcap_labels=pcap_labels)
+        for var, role, confidence in zip(
+                ('endpoint_role_confidence_top',
+                 'endpoint_role_confidence_second',
+                 'endpoint_role_confidence_third'),
+                roles, confidences):
+            self._set_endpoint_prom(
+                var, hash_id, confidence, dict(role_labels, role=role))
+
+        port_labels = dict(
+            base_labels,
+            tenant=endpoint_data['tenant'],
+            segment=endpoint_data['segment'],
+            ether_vendor=endpoint_data['ether_vendor'],
+            port=endpoint_data['port'])
+        for var, prom_labels in (  # same order as ENDPOINT_TIME_GAUGES.
+                ('endpoints', controller_labels),
+                ('endpoint_state', {'state': endpoint.state}),
+                ('endpoint_os', {'ipv4_os': ipv4_os}),
+                ('endpoint_role', {'top_role': top_role}),
+                ('endpoint_ip', dict(
+                    ip_labels,
+                    ipv4_address=ipv4,
+                    ipv6_address=ipv6)),
+                ('endpoint_metadata', dict(
+                    ip_labels,
+                    prev_state=endpoint.p_prev_state,
+                    next_state=endpoint.p_next_state,
+                    acls=endpoint.acl_data,
+                    ignore=str(endpoint.ignore),
+                    state=endpoint.state,
+                    top_role=top_role,
                     ipv4_os=ipv4_os,
                     ipv4_address=ipv4,
                     ipv6_address=ipv6,
-                    pcap_labels=pcap_labels)
-
-            def update_prom(var, **prom_labels):
-                prom_labels.update({
-                    'tenant': tenant,
-                    'segment': segment,
-                    'ether_vendor': ether_vendor,
-                    'port': port,
-                })
-                set_prom(var, update_time, **prom_labels)
-
-            set_prom_role(
-                'endpoint_role_confidence_top',
-                top_conf,
-                top_role)
-            set_prom_role(
-                'endpoint_role_confidence_second',
-                second_conf,
-                second_role)
-            set_prom_role(
-                'endpoint_role_confidence_third',
-                third_conf,
-                third_role)
-            update_prom(
-                'endpoints',
-                controller_type=controller_type,
-                controller=controller)
-            update_prom(
-                'endpoint_state',
-                state=endpoint.state)
-            update_prom(
-                'endpoint_os',
-                ipv4_os=ipv4_os)
-            update_prom(
-                'endpoint_role',
-                top_role=top_role)
-            update_prom(
-                'endpoint_ip',
-                ipv4_subnet=ipv4_subnet,
-                ipv6_subnet=ipv6_subnet,
-                ipv4_rdns=ipv4_rdns,
-                ipv6_rdns=ipv6_rdns,
-                ipv4_address=ipv4,
-                ipv6_address=ipv6)
-            update_prom(
-                'endpoint_metadata',
-                prev_state=endpoint.p_prev_state,
-                next_state=endpoint.p_next_state,
-                acls=endpoint.acl_data,
-                ignore=str(endpoint.ignore),
-                ipv4_subnet=ipv4_subnet,
-                ipv6_subnet=ipv6_subnet,
-                ipv4_rdns=ipv4_rdns,
-                ipv6_rdns=ipv6_rdns,
-                controller_type=controller_type,
-                controller=controller,
-                state=endpoint.state,
-                top_role=top_role,
-                ipv4_os=ipv4_os,
-                ipv4_address=ipv4,
-                ipv6_address=ipv6)
+                    **controller_labels))):
+            self._set_endpoint_prom(
+                var, hash_id, update_time, dict(port_labels, **prom_labels))
+
+    def update_endpoint_metadata(self, endpoints):
+        '''
+        export per endpoint gauges. Given an EndpointRegistry, only the
+        endpoints that changed since the last export are processed.
+        '''
+        update_time = time.time()
+        if isinstance(endpoints, EndpointRegistry):
+            for hash_id in endpoints.pop_removed('prometheus'):
+                self.remove_endpoint(hash_id)
+            dirty_endpoints = endpoints.pop_dirty_fields('prometheus')
+            endpoints = {}
+            for hash_id, (endpoint, fields) in dirty_endpoints.items():
+                # only the time changed, so the labels don't need to be rebuilt.
+                if fields is not None and fields <= self.UNLABELLED_ENDPOINT_FIELDS:
+                    if self.touch_endpoint(hash_id, update_time):
+                        continue
+                endpoints[hash_id] = endpoint
+        for hash_id, endpoint in endpoints.items():
+            self.update_endpoint(hash_id, endpoint, update_time)
+        self.update_series_counts()
 
     @staticmethod
     def start(port=9304):
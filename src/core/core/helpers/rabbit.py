@@ -3,12 +3,15 @@
 Created on 21 August 2017
 @author: dgrossman
 """
+import asyncio
 import logging
+import queue
 import threading
 import time
 from functools import partial
 
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 
 
 class Rabbit:
@@ -84,3 +87,281 @@ class Rabbit:
         self.mq_recv_thread = threading.Thread(
             target=self.channel.start_consuming)
         self.mq_recv_thread.start()
+
+
+class AsyncRabbit:
+    '''
+    RabbitMQ consumer that binds any number of exchanges to one queue, on one
+    connection served by an asyncio event loop in its own thread.
+
+    Up to prefetch_count unacknowledged messages are delivered at a time.
+    Received messages pass through an asyncio queue and are handed to the
+    callback in batches, each batch acknowledged with one multiple=True ack.
+    '''
+
+    DEFAULT_PREFETCH_COUNT = 100
+
+    def __init__(self, prefetch_count=DEFAULT_PREFETCH_COUNT):
+        self.logger = logging.getLogger('rabbit')
+        self.prefetch_count = prefetch_count
+        self.queue_name = 'poseidon_main'
+        self.loop = None
+        self.connection = None
+        self.channel = None
+        self.messages = None
+        # futures for pika calls still waiting for their callback.
+        self.pending_calls = set()
+        self.mq_recv_thread = None
+
+    def close(self):
+        if self.connection and self.loop:
+            self.loop.call_soon_threadsafe(self.connection.close)
+
+    def start(self, host, port, exchange_keys, callback):
+        '''
+        consume messages for exchange_keys ({exchange: [routing keys]}),
+        calling callback with lists of (routing_key, body) from the event
+        loop thread. Reconnects until success, and whenever disconnected.
+        '''
+        self.loop = asyncio.new_event_loop()
+        self.mq_recv_thread = threading.Thread(
+            target=self.loop.run_until_complete,
+            args=(self.consume(host, port, exchange_keys, callback),),
+            daemon=True)
+        self.mq_recv_thread.start()
+
+    def _rabbit_call(self, method, *args, callback_arg='callback', **kwargs):
+        ''' call a pika channel/connection method, returning a future for its callback. '''
+        future = self.loop.create_future()
+        self.pending_calls.add(future)
+
+        def _done(result):
+            self.pending_calls.discard(future)
+            if not future.done():
+                future.set_result(result)
+
+        kwargs[callback_arg] = _done
+        method(*args, **kwargs)
+        return future
+
+    async def connect(self, host, port, exchange_keys):
+        ''' connect and start consuming, returning a future that completes when the connection closes. '''
+        opened = self.loop.create_future()
+        closed = self.loop.create_future()
+
+        def _on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def _on_open_error(_connection, error):
+            if not opened.done():
+                opened.set_exception(ConnectionError(str(error)))
+
+        def _on_close(_connection, reason):
+            # fail anything still being set up, so connect() can retry.
+            for future in [opened] + list(self.pending_calls):
+                if not future.done():
+                    future.set_exception(ConnectionError(str(reason)))
+            self.pending_calls = set()
+            if not closed.done():
+                closed.set_result(reason)
+
+        self.connection = AsyncioConnection(
+            pika.ConnectionParameters(host=host, port=port),
+            on_open_callback=_on_open,
+            on_open_error_callback=_on_open_error,
+            on_close_callback=_on_close,
+            custom_ioloop=self.loop)
+        await opened
+        self.channel = await self._rabbit_call(
+            self.connection.channel, callback_arg='on_open_callback')
+        await self._rabbit_call(
+            self.channel.queue_declare, queue=self.queue_name, exclusive=False, durable=True)
+        for exchange, keys in exchange_keys.items():
+            await self._rabbit_call(
+                self.channel.exchange_declare, exchange=exchange, exchange_type='topic')
+            for key in keys:
+                self.logger.debug(f'Adding key:{key} to rabbitmq channel')
+                await self._rabbit_call(
+                    self.channel.queue_bind, queue=self.queue_name, exchange=exchange, routing_key=key)
+        await self._rabbit_call(
+            self.channel.basic_qos, prefetch_count=self.prefetch_count)
+        self.messages = asyncio.Queue()
+        await self._rabbit_call(
+            self.channel.basic_consume, self.queue_name, self.on_message)
+        self.logger.info(f'Connected to {host} rabbitmq...')
+        return closed
+
+    def on_message(self, _channel, method, _properties, body):
+        self.messages.put_nowait((method.delivery_tag, method.routing_key, body))
+
+    async def dispatch(self, callback):
+        ''' hand received messages to callback in batches, acknowledging each batch at once. '''
+        messages = self.messages
+        while True:
+            batch = [await messages.get()]
+            while not messages.empty():
+                batch.append(messages.get_nowait())
+            try:
+                callback([(routing_key, body) for _, routing_key, body in batch])
+            except Exception as e:  # pragma: no cover
+                self.logger.error(
+                    f'Unable to handle {len(batch)} rabbitmq messages because: {e}')
+            self.channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+
+    async def consume(self, host, port, exchange_keys, callback):  # pragma: no cover
+        while True:
+            try:
+                closed = await self.connect(host, port, exchange_keys)
+            except Exception as e:
+                self.logger.debug(
+                    f'Waiting for connection to {host} rabbitmq...')
+                await asyncio.sleep(2)
+                continue
+            dispatcher = self.loop.create_task(self.dispatch(callback))
+            reason = await closed
+            dispatcher.cancel()
+            self.logger.warning(
+                f'Connection to {host} rabbitmq closed ({reason}), reconnecting...')
+            await asyncio.sleep(2)
+
+
+class RabbitPublisher:
+    '''
+    Long lived, thread safe publisher to a RabbitMQ exchange.
+
+    The connection is opened on first use and reused by later publishes,
+    and is reopened (with exponential backoff between attempts) if
+    publishing on it fails. Publisher confirms are enabled, so a publish
+    only succeeds once RabbitMQ has accepted every message.
+
+    publish_batch() waits for the messages to be confirmed (or given up
+    on), while publish_batch_background() queues them for a background
+    thread, so callers that mustn't block (e.g. the SDNEvents loop) aren't
+    held up by retries while RabbitMQ is unavailable. The background thread
+    also services heartbeats on the connection while idle, so the broker
+    doesn't drop it between publishes.
+    '''
+
+    def __init__(self, host, exchange, port=5672, exchange_type='topic',
+                 retries=3, backoff=0.5, max_backoff=5, max_pending=1000,
+                 heartbeat_secs=10):
+        self.logger = logging.getLogger('rabbit')
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat_secs = heartbeat_secs
+        self.connection = None
+        self.channel = None
+        self.lock = threading.Lock()
+        # batches of messages waiting for the background thread.
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.thread = None
+
+    def _connect(self):
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=self.host, port=self.port))
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        self.channel.exchange_declare(
+            exchange=self.exchange, exchange_type=self.exchange_type)
+
+    def _disconnect(self):
+        connection = self.connection
+        self.connection = None
+        self.channel = None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:  # pragma: no cover
+                pass
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+    def publish(self, routing_key, body):
+        return self.publish_batch([(routing_key, body)])
+
+    def publish_batch(self, messages):
+        ''' publish (routing_key, body) messages in order, returning True if all were confirmed. '''
+        messages = list(messages)
+        sent = 0
+        backoff = self.backoff
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                try:
+                    if self.channel is None or not self.channel.is_open:
+                        self._disconnect()
+                        self._connect()
+                    for routing_key, body in messages[sent:]:
+                        self.channel.basic_publish(
+                            exchange=self.exchange, routing_key=routing_key, body=body)
+                        sent += 1
+                    return True
+                except (pika.exceptions.AMQPError, OSError) as e:
+                    self.logger.warning(
+                        f'Unable to publish to {self.host} rabbitmq ({e}), retrying...')
+                    self._disconnect()
+        self.logger.error(
+            f'Gave up publishing {len(messages) - sent} messages to {self.host} rabbitmq')
+        return False
+
+    def process_events(self):
+        ''' service heartbeats on an open connection. '''
+        with self.lock:
+            if self.connection is None or not self.connection.is_open:
+                return
+            try:
+                self.connection.process_data_events(time_limit=0)
+            except (pika.exceptions.AMQPError, OSError) as e:
+                self.logger.warning(
+                    f'Connection to {self.host} rabbitmq lost ({e})')
+                self._disconnect()
+
+    def _publish_pending(self):
+        while True:
+            try:
+                messages = self.pending.get(timeout=self.heartbeat_secs)
+            except queue.Empty:
+                self.process_events()
+                continue
+            self.publish_batch(messages)
+
+    def publish_batch_background(self, messages):
+        ''' queue (routing_key, body) messages to be published in order by a background thread, returning False if too many are queued. '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._publish_pending, daemon=True)
+                self.thread.start()
+        try:
+            self.pending.put_nowait(list(messages))
+        except queue.Full:
+            self.logger.error(
+                f'Too many messages waiting to be published to {self.host} rabbitmq, dropping')
+            return False
+        return True
+
+
+# (host, port, exchange) -> RabbitPublisher shared by everything publishing there.
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(host, exchange, port=5672):
+    ''' return the shared RabbitPublisher for exchange on host. '''
+    key = (host, port, exchange)
+    with _publishers_lock:
+        publisher = _publishers.get(key, None)
+        if publisher is None:
+            publisher = RabbitPublisher(host, exchange, port=port)
+            _publishers[key] = publisher
+    return publisher
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed endpoint container, so that lookups by MAC, IP, state and
+ignore flag don't have to scan every endpoint.
+"""
+from collections import defaultdict
+
+
+class EndpointRegistry(dict):
+    '''
+    dict of endpoint name -> Endpoint, that also maintains secondary indexes.
+
+    Endpoints notify their registry (via Endpoint.registry) whenever an
+    indexed attribute (state, copro_state, ignore, copro_ignore or
+    endpoint_data) is assigned, so the indexes stay current without rescans.
+
+    The registry also tracks, per named consumer (e.g. the Prometheus
+    exporter or the endpoint store), which endpoints changed since that
+    consumer last called pop_dirty() and which were removed since it last
+    called pop_removed(), so consumers only need to process what changed.
+    A consumer's first pop_dirty() returns every endpoint. pop_dirty_fields()
+    also returns which fields of each endpoint changed (e.g. 'observed_time'
+    or 'endpoint_data.port'), where the endpoint reported them.
+    '''
+
+    INDEXED_DATA_FIELDS = ('mac', 'ipv4', 'ipv6')
+
+    def __init__(self, endpoints=None):
+        super().__init__()
+        self._buckets = defaultdict(dict)
+        self._bucket_keys = {}
+        # consumer -> name -> endpoint changed since the consumer's last pop.
+        self._dirty = {}
+        # consumer -> name -> set of changed fields, or None if unknown.
+        self._dirty_fields = {}
+        # consumer -> names removed since the consumer's last pop.
+        self._removed = {}
+        if endpoints:
+            self.update(endpoints)
+
+    @classmethod
+    def _endpoint_bucket_keys(cls, endpoint):
+        keys = [('ignore', endpoint.ignore),
+                ('copro_ignore', endpoint.copro_ignore),
+                ('any_copro_state', endpoint.copro_state)]
+        if not endpoint.ignore:
+            keys.append(('state', endpoint.state))
+        if not endpoint.copro_ignore:
+            keys.append(('copro_state', endpoint.copro_state))
+        endpoint_data = endpoint.endpoint_data
+        if endpoint_data:
+            for field in cls.INDEXED_DATA_FIELDS:
+                value = endpoint_data.get(field, None)
+                if value is not None:
+                    keys.append((field, value))
+        return tuple(keys)
+
+    def _index(self, name, endpoint):
+        keys = self._endpoint_bucket_keys(endpoint)
+        for key in keys:
+            self._buckets[key][name] = endpoint
+        self._bucket_keys[name] = keys
+
+    def _unindex(self, name):
+        for key in self._bucket_keys.pop(name, ()):
+            bucket = self._buckets.get(key, None)
+            if bucket is not None:
+                bucket.pop(name, None)
+                if not bucket:
+                    del self._buckets[key]
+
+    def reindex(self, endpoint):
+        ''' called by an endpoint when one of its indexed attributes changes. '''
+        name = endpoint.name
+        if super().get(name, None) is not endpoint:
+            return
+        keys = self._endpoint_bucket_keys(endpoint)
+        if keys == self._bucket_keys.get(name, None):
+            return
+        self._unindex(name)
+        self._index(name, endpoint)
+
+    def _mark_dirty(self, name, endpoint, fields=None):
+        for consumer, dirty in self._dirty.items():
+            dirty[name] = endpoint
+            dirty_fields = self._dirty_fields[consumer]
+            if fields is None:
+                dirty_fields[name] = None
+            elif name not in dirty_fields:
+                dirty_fields[name] = set(fields)
+            elif dirty_fields[name] is not None:
+                dirty_fields[name].update(fields)
+
+    def mark_dirty(self, endpoint, fields=None):
+        name = endpoint.name
+        if super().get(name, None) is endpoint:
+            self._mark_dirty(name, endpoint, fields)
+
+    def pop_dirty(self, consumer):
+        ''' return endpoints changed since consumer's last call, and reset. '''
+        dirty = self._dirty.get(consumer, None)
+        if dirty is None:
+            dirty = dict(self)
+            self._removed[consumer] = {}
+        self._dirty[consumer] = {}
+        self._dirty_fields[consumer] = {}
+        return dirty
+
+    def pop_dirty_fields(self, consumer):
+        ''' like pop_dirty(), but return name -> (endpoint, changed fields or None if unknown). '''
+        dirty_fields = self._dirty_fields.get(consumer, {})
+        return {
+            name: (endpoint, dirty_fields.get(name, None))
+            for name, endpoint in self.pop_dirty(consumer).items()}
+
+    def pop_removed(self, consumer):
+        ''' return names removed since consumer's last call, and reset. '''
+        removed = self._removed.get(consumer, {})
+        if consumer in self._removed:
+            self._removed[consumer] = {}
+        return list(removed)
+
+    def _bucket(self, key):
+        return list(self._buckets.get(key, {}).values())
+
+    def _bucket_len(self, key):
+        return len(self._buckets.get(key, ()))
+
+    def __setitem__(self, name, endpoint):
+        old_endpoint = super().get(name, None)
+        if old_endpoint is not None:
+            self._unindex(name)
+            if old_endpoint is not endpoint and old_endpoint.registry is self:
+                old_endpoint.registry = None
+        super().__setitem__(name, endpoint)
+        endpoint.registry = self
+        self._index(name, endpoint)
+        self._mark_dirty(name, endpoint)
+        for removed in self._removed.values():
+            removed.pop(name, None)
+
+    def __delitem__(self, name):
+        endpoint = super().__getitem__(name)
+        self._unindex(name)
+        for dirty in self._dirty.values():
+            dirty.pop(name, None)
+        for dirty_fields in self._dirty_fields.values():
+            dirty_fields.pop(name, None)
+        for removed in self._removed.values():
+            removed[name] = None
+        super().__delitem__(name)
+        if endpoint.registry is self:
+            endpoint.registry = None
+
+    def pop(self, name, *default):
+        if name in self:
+            endpoint = self[name]
+            del self[name]
+            return endpoint
+        if default:
+            return default[0]
+        raise KeyError(name)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): registry is empty')
+        name = next(reversed(self.keys()))
+        return (name, self.pop(name))
+
+    def clear(self):
+        for name in list(self.keys()):
+            del self[name]
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, endpoint in dict(*args, **kwargs).items():
+            self[name] = endpoint
+
+    def by_mac(self, mac):
+        return self._bucket(('mac', mac))
+
+    def by_ip(self, ip):
+        endpoints = dict(self._buckets.get(('ipv4', ip), {}))
+        endpoints.update(self._buckets.get(('ipv6', ip), {}))
+        return list(endpoints.values())
+
+    def ignored(self):
+        return self._bucket(('ignore', True))
+
+    def not_ignored(self, state=None):
+        if state:
+            return self._bucket(('state', state))
+        return self._bucket(('ignore', False))
+
+    def not_copro_ignored(self, copro_state=None):
+        if copro_state:
+            return self._bucket(('copro_state', copro_state))
+        return self._bucket(('copro_ignore', False))
+
+    def count_not_ignored(self, state):
+        return self._bucket_len(('state', state))
+
+    def count_not_ignored_copro(self, copro_state):
+        ''' count endpoints in copro_state that are not ignored (copro_ignore is not considered). '''
+        return len([
+            endpoint for endpoint in self._buckets.get(('any_copro_state', copro_state), {}).values()
+            if not endpoint.ignore])
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Local persistent storage of endpoints, so they can be reloaded on startup
+without rebuilding them from Prometheus.
+"""
+import logging
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+from poseidon_core.helpers.endpoint import EndpointDecoder
+
+
+class EndpointStore:
+    '''
+    Endpoint store that doesn't persist anything (store disabled).
+    '''
+
+    enabled = False
+
+    def load(self):
+        return {}
+
+    def find(self, key=None, ignored=None):
+        ''' return endpoints matching key and ignored, or None if the store can't look them up. '''
+        return None
+
+    def put_endpoints(self, endpoints):
+        return
+
+    def delete_endpoints(self, names):
+        return
+
+    def close(self):
+        return
+
+
+class SQLiteEndpointStore(EndpointStore):
+    '''
+    Endpoint store keeping one Endpoint.encode() record per endpoint in SQLite.
+
+    A read only store (e.g. for the CLI) opens an existing database without
+    creating or changing anything.
+    '''
+
+    enabled = True
+    # endpoint_data fields find() looks keys up in, besides the endpoint's name.
+    KEY_FIELDS = ('mac', 'ipv4', 'ipv6')
+
+    def __init__(self, path, read_only=False):
+        self.logger = logging.getLogger('store')
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect(
+                'file:{0}?mode=ro'.format(pathname2url(path)), uri=True)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS endpoints (name TEXT PRIMARY KEY, endpoint TEXT NOT NULL)')
+        self.conn.commit()
+
+    def _query(self, query, params=()):
+        try:
+            rows = self.conn.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                'Unable to load endpoints from {0} because: {1}'.format(self.path, str(e)))
+            return None
+        return self._decode(rows)
+
+    def load(self):
+        endpoints = self._query('SELECT name, endpoint FROM endpoints')
+        if endpoints is None:
+            return {}
+        return endpoints
+
+    def find(self, key=None, ignored=None):
+        ''' return endpoints whose name, MAC or IP is key (if given), and whose ignore flag is ignored (if given). '''
+        conditions = []
+        params = []
+        if key is not None:
+            conditions.append(
+                '(name = ? OR ' + ' OR '.join(
+                    "json_extract(endpoint, '$.endpoint_data.{0}') = ?".format(field)
+                    for field in self.KEY_FIELDS) + ')')
+            params.extend([key] * (len(self.KEY_FIELDS) + 1))
+        if ignored is not None:
+            conditions.append("json_extract(endpoint, '$.ignore') = ?")
+            params.append(int(bool(ignored)))
+        query = 'SELECT name, endpoint FROM endpoints'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self._query(query, params)
+
+    def _decode(self, rows):
+        endpoints = {}
+        for name, encoded in rows:
+            try:
+                endpoint = EndpointDecoder(encoded).get_endpoint()
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.warning(
+                    'Skipping unreadable stored endpoint {0}: {1}'.format(name, str(e)))
+                continue
+            endpoints[endpoint.name] = endpoint
+        return endpoints
+
+    def put_endpoints(self, endpoints):
+        records = [(endpoint.name, endpoint.encode()) for endpoint in endpoints]
+        if not records:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO endpoints (name, endpoint) VALUES (?, ?)', records)
+        except sqlite3.Error as e:
+            self.logger.error(
+                'Unable to store endpoints in {0} because: {1}'.format(self.path, str(e)))
+
+    def delete_endpoints(self, names):
+        records = [(name,) for name in names]
+        if not records:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    'DELETE FROM endpoints WHERE name = ?', records)
+        except sqlite3.Error as e:
+            self.logger.error(
+                'Unable to delete endpoints from {0} because: {1}'.format(self.path, str(e)))
+
+    def close(self):
+        self.conn.close()
+
+
+def get_endpoint_store(config, read_only=False):
+    ''' return the endpoint store configured by endpoint_store_file, if any. '''
+    logger = logging.getLogger('store')
+    path = config.get('endpoint_store_file', None)
+    if path:
+        if os.path.isdir(os.path.dirname(path) or '.'):
+            try:
+                return SQLiteEndpointStore(path, read_only=read_only)
+            except sqlite3.Error as e:
+                logger.error(
+                    'Unable to open endpoint store {0} because: {1}'.format(path, str(e)))
+        else:
+            logger.warning(
+                'Directory for endpoint store {0} does not exist, not persisting endpoints'.format(path))
+    return EndpointStore()
@@ -8,15 +8,13 @@ Created on 3 December 2018
 """
 import logging
 import sys
-import threading
-import time
-from functools import partial
 
 import schedule
 from poseidon_core.controllers.faucet.config import FaucetRemoteConfGetSetter
 from poseidon_core.controllers.sdnconnect import SDNConnect
 from poseidon_core.controllers.sdnevents import SDNEvents
 from poseidon_core.helpers.config import Config
+from poseidon_core.helpers.config import ConfigWatcher
 from poseidon_core.helpers.log import Logger
 from poseidon_core.helpers.prometheus import Prometheus
 from poseidon_core.operations.monitor import Monitor
@@ -33,15 +31,6 @@ def start_prometheus(logger):
     return prom
 
 
-def schedule_thread_worker(logger, scheduler=schedule):
-    ''' schedule thread, takes care of running processes in the future '''
-    logger.debug('Starting thread_worker')
-    while True:
-        sys.stdout.flush()
-        scheduler.run_pending()
-        time.sleep(1)
-
-
 def main():  # pragma: no cover
     logging.getLogger('pika').setLevel(logging.CRITICAL)
     Logger()
@@ -59,13 +48,13 @@ def main():  # pragma: no cover
     # TODO this should be the default operation, but can be overridden with config to do other operations instead or additionally
     monitor = Monitor(logger, config, schedule, sdne.job_queue, sdnc, prom)
 
-    # schedule all threads
-    schedule_thread = threading.Thread(
-        target=partial(
-            schedule_thread_worker,
-            logger, scheduler=schedule),
-        name='st_worker')
-    schedule_thread.start()
+    # reload the config when it changes.
+    if config['config_check_frequency']:
+        config_watcher = ConfigWatcher()
+        for subscriber in (sdnc, sdne, monitor):
+            config_watcher.subscribe(subscriber.update_config)
+        schedule.every(config['config_check_frequency']).seconds.do(
+            config_watcher.check)
 
     try:
         # TODO each operation should have its own thread running its own "process" and this is just a main infinite loop
@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 import json
 import queue
-import random
 import sys
 import time
 
+from poseidon_core.helpers.config import apply_config_changes
+from poseidon_core.helpers.investigations import InvestigationQueue
+
 
 class Monitor:
 
@@ -16,12 +18,31 @@ class Monitor:
         self.job_queue = job_queue
         self.sdnc = sdnc
         self.prom = prom
+        self.schedule = schedule
+        self.investigation_queue = InvestigationQueue(
+            confidence_secs=self.config['reinvestigation_frequency'])
+        self.jobs = []
+        self.schedule_jobs()
+
+    def schedule_jobs(self):
+        ''' (re)schedule periodic jobs at their configured frequencies. '''
+        for job in self.jobs:
+            self.schedule.cancel_job(job)
+        # timer class to call things periodically, run from SDNEvents.process()
+        self.jobs = [
+            self.schedule.every(self.config['scan_frequency']).seconds.do(
+                self.schedule_job_update_metrics),
+            self.schedule.every(self.config['reinvestigation_frequency']).seconds.do(
+                self.schedule_job_reinvestigation_timeout)]
 
-        # timer class to call things periodically in own thread
-        schedule.every(self.config['scan_frequency']).seconds.do(
-            self.schedule_job_update_metrics)
-        schedule.every(self.config['reinvestigation_frequency']).seconds.do(
-            self.schedule_job_reinvestigation_timeout)
+    def update_config(self, snapshot, changed):
+        ''' apply a changed config (see ConfigWatcher), rescheduling jobs if their frequencies changed. '''
+        apply_config_changes(self.config, snapshot, changed)
+        if not changed.isdisjoint(('scan_frequency', 'reinvestigation_frequency')):
+            self.schedule_jobs()
+        if 'reinvestigation_frequency' in changed:
+            self.investigation_queue.reset(
+                confidence_secs=self.config['reinvestigation_frequency'])
 
     def get_hosts(self):
         # TODO consolidate with update_endpoint_metadata
@@ -48,6 +69,10 @@ class Monitor:
         try:
             hosts = self.get_hosts()
             self.prom.update_metrics(hosts)
+            endpoints = self.sdnc.not_ignored_endpoints()
+            ages = InvestigationQueue.investigation_ages(endpoints)
+            self.prom.update_investigation_ages(
+                ages, len(endpoints) - len(ages))
         except Exception as e:  # pragma: no cover
             self.logger.error(
                 'Unable to get current state and send it to Prometheus because: {0}'.format(str(e)))
@@ -78,6 +103,7 @@ class Monitor:
             return 0
         events = 0
         timeout = 2*self.config['reinvestigation_frequency']
+        mirror_timeouts = []
         for endpoint in self.sdnc.not_ignored_endpoints():
             if endpoint.observed_timeout(timeout):
                 self.logger.info(
@@ -87,14 +113,17 @@ class Monitor:
             elif endpoint.operation_active() and endpoint.state_timeout(timeout):
                 self.logger.info(
                     'mirror timing out: {0}'.format(endpoint.name))
-                self.sdnc.unmirror_endpoint(endpoint)
+                mirror_timeouts.append(endpoint)
                 events += 1
+        if mirror_timeouts:
+            self.sdnc.unmirror_endpoints(mirror_timeouts)
         budget = self.sdnc.investigation_budget()
-        candidates = self.sdnc.not_ignored_endpoints('queued')
+        self.investigation_queue.sync(self.sdnc.endpoints)
+        candidates = self.investigation_queue.top('queued', budget)
         if not candidates:
-            candidates = self.sdnc.not_ignored_endpoints('known')
+            candidates = self.investigation_queue.top('known', budget)
         return events + self._schedule_queued_work(
-            candidates, budget, 'operate', self.sdnc.mirror_endpoint, shuffle=True)
+            candidates, budget, 'operate', self.sdnc.mirror_endpoints)
 
     def schedule_job_update_metrics(self):
         self.job_queue.put(self.job_update_metrics)
@@ -102,18 +131,19 @@ class Monitor:
     def schedule_job_reinvestigation_timeout(self):
         self.job_queue.put(self.job_reinvestigation_timeout)
 
-    def _schedule_queued_work(self, queued_endpoints, budget, endpoint_state, endpoint_work, shuffle=False):
+    def _schedule_queued_work(self, queued_endpoints, budget, endpoint_state, endpoints_work):
+        ''' transition up to budget queued endpoints with endpoint_state, then call endpoints_work with them. '''
         events = 0
         if self.sdnc.sdnc:
-            if shuffle:
-                random.shuffle(queued_endpoints)
-            for endpoint in queued_endpoints[:budget]:
+            scheduled_endpoints = queued_endpoints[:budget]
+            for endpoint in scheduled_endpoints:
                 getattr(endpoint, endpoint_state)()
-                endpoint_work(endpoint)
                 if endpoint_state in ['trigger_next', 'operate']:
                     # TODO this may not be necessarily true going forward
                     self.prom.prom_metrics['ncapture_count'].inc()
                 events += 1
+            if scheduled_endpoints:
+                endpoints_work(scheduled_endpoints)
         return events
 
     # TODO make generic
@@ -121,13 +151,12 @@ class Monitor:
         for endpoint in self.sdnc.not_ignored_endpoints('unknown'):
             endpoint.queue_next('operate')
         budget = self.sdnc.investigation_budget()
-        queued_endpoints = [
-            endpoint for endpoint in self.sdnc.not_ignored_endpoints('queued')
-            if endpoint.operation_requested()]
-        queued_endpoints = sorted(queued_endpoints, key=lambda x: x.state_time)
+        self.investigation_queue.sync(self.sdnc.endpoints)
+        queued_endpoints = self.investigation_queue.top(
+            'queued', budget, requested=True)
         self.logger.debug('operations {0}, budget {1}, queued {2}'.format(
-            str(self.sdnc.investigations), str(budget), str(len(queued_endpoints))))
-        return self._schedule_queued_work(queued_endpoints, budget, 'trigger_next', self.sdnc.mirror_endpoint)
+            str(self.sdnc.investigations), str(budget), str(self.sdnc.endpoints.count_not_ignored('queued'))))
+        return self._schedule_queued_work(queued_endpoints, budget, 'trigger_next', self.sdnc.mirror_endpoints)
 
     # TODO make generic
     def schedule_coprocessing(self):
@@ -140,4 +169,4 @@ class Monitor:
             queued_endpoints, key=lambda x: x.copro_state_time)
         self.logger.debug('coprocessing {0}, budget {1}, queued {2}'.format(
             str(self.sdnc.coprocessing), str(budget), str(len(queued_endpoints))))
-        return self._schedule_queued_work(queued_endpoints, budget, 'copro_trigger_next', self.sdnc.coprocess_endpoint)
+        return self._schedule_queued_work(queued_endpoints, budget, 'copro_trigger_next', self.sdnc.coprocess_endpoints)
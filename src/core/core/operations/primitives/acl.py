@@ -3,8 +3,126 @@
 Created on 4 March 2020
 @author: Charlie Lewis
 """
+import hashlib
 import logging
 import os
+from collections import defaultdict
+
+import yaml
+from poseidon_core.helpers.endpoint import endpoint_data_field
+
+# Endpoint fields that rules match on, or that locate the endpoint's port;
+# endpoints where only other fields changed don't need ACLs re-evaluated.
+ACL_ENDPOINT_FIELDS = frozenset(
+    ['metadata'] + [endpoint_data_field(key) for key in ('mac', 'segment', 'port', 'ipv4', 'ipv6')])
+# rules file -> CompiledRules for the last compiled version of that file.
+_compiled_rules_cache = {}
+# included ACL file copy -> sha256 of the ACLs doc last written to it.
+_written_acls_digests = {}
+
+
+def rules_file_mtime(rules_file):
+    if rules_file:
+        try:
+            return os.path.getmtime(rules_file)
+        except OSError:
+            pass
+    return None
+
+
+class CompiledRules:
+    '''
+    The rules section of a rules file, indexed by the device_key values
+    that can satisfy each rule, so matching an endpoint only has to check
+    rules with at least one clause the endpoint could meet.
+    '''
+
+    DEVICE_KEYS = ('os', 'role')
+
+    def __init__(self, rules):
+        self.rules = rules
+        # rule -> position in the rules file, to apply ACLs in file order.
+        self.rule_order = {}
+        # rule -> ACLs the rule applies, without duplicates.
+        self.rule_acls = {}
+        # (device_key, value) -> rules with a clause matching that value.
+        self.rules_by_key = defaultdict(set)
+        self.acls = set()
+        for i, (rule, clauses) in enumerate(rules.items()):
+            self.rule_order[rule] = i
+            rule_acls = []
+            for clause in clauses:
+                rule_data = clause.get('rule', {})
+                rule_acls.extend(rule_data.get('acls', []))
+                device_key = rule_data.get('device_key', None)
+                if device_key in self.DEVICE_KEYS:
+                    self.rules_by_key[(device_key, rule_data.get('value', None))].add(
+                        rule)
+            self.rule_acls[rule] = list(dict.fromkeys(rule_acls))
+            self.acls.update(rule_acls)
+
+    @staticmethod
+    def endpoint_facts(endpoint):
+        ''' return the OSes and the latest (role, confidence %) predictions rules can match. '''
+        metadata = endpoint.metadata
+        oses = set()
+        for addresses in ('ipv4_addresses', 'ipv6_addresses'):
+            for ip_metadata in metadata.get(addresses, {}).values():
+                if 'os' in ip_metadata:
+                    oses.add(ip_metadata['os'])
+        roles = []
+        for mac_metadata in metadata.get('mac_addresses', {}).values():
+            if not mac_metadata:
+                continue
+            most_recent = mac_metadata[max(mac_metadata, key=float)]
+            if 'labels' in most_recent and 'confidences' in most_recent:
+                # check top three
+                roles.extend(zip(
+                    most_recent['labels'][:3],
+                    [float(confidence) * 100 for confidence in most_recent['confidences'][:3]]))
+        return oses, roles
+
+    def _rule_matches(self, rule, oses, roles):
+        for clause in self.rules[rule]:
+            rule_data = clause.get('rule', {})
+            device_key = rule_data.get('device_key', None)
+            value = rule_data.get('value', None)
+            if device_key == 'os':
+                if value not in oses:
+                    return False
+            elif device_key == 'role':
+                min_confidence = rule_data.get('min_confidence', None)
+                if not [label for label, confidence in roles
+                        if label == value and (min_confidence is None or confidence >= min_confidence)]:
+                    return False
+            else:
+                # clauses without a device_key only apply when forced.
+                return False
+        return True
+
+    def matching_rules(self, endpoint):
+        ''' return the rules all of whose clauses match endpoint. '''
+        oses, roles = self.endpoint_facts(endpoint)
+        candidates = set()
+        for os_name in oses:
+            candidates.update(self.rules_by_key.get(('os', os_name), ()))
+        for label, _ in roles:
+            candidates.update(self.rules_by_key.get(('role', label), ()))
+        return {rule for rule in candidates if self._rule_matches(rule, oses, roles)}
+
+
+def compile_rules(rules_file, rules):
+    '''
+    return CompiledRules for rules, reusing the last compile while rules is
+    the same (shared, see cached_yaml_in()) parse of rules_file.
+    '''
+    cached = _compiled_rules_cache.get(rules_file, None)
+    if cached is not None and cached.rules is rules:
+        return cached
+    compiled = CompiledRules(rules)
+    if rules_file:
+        _compiled_rules_cache[rules_file] = compiled
+    return compiled
 
 
 class ACL:
@@ -12,6 +130,8 @@ class ACL:
     def __init__(self, faucetconfgetsetter):
         self.logger = logging.getLogger('acl')
         self.frpc = faucetconfgetsetter
+        # (switch, port) -> acls_in, for ports changed by the last apply_acls().
+        self.port_acl_changes = {}
 
     def _config_file_paths(self, file_paths):
         return [self.frpc.config_file_path(f) for f in file_paths]
@@ -24,9 +144,9 @@ class ACL:
         acls_docs = {}
         for f in files:
             if f.startswith('/'):
-                acls_doc = self.frpc.read_faucet_conf(f)
+                acls_doc = self.frpc.read_config_file(f)
             else:
-                acls_doc = self.frpc.read_faucet_conf(
+                acls_doc = self.frpc.read_config_file(
                     os.path.join(rules_path, f))
             if isinstance(acls_doc, bool):
                 self.logger.warning(
@@ -41,10 +161,12 @@ class ACL:
                     coprocess_rules_files)
             for f in files:
                 if '/' in f:
-                    acls_filenames.append(f.rsplit('/', 1)[1])
+                    acls_filename = f.rsplit('/', 1)[1]
                 else:
-                    acls_filenames.append(f)
-            for conf_file in conf_files:
+                    acls_filename = f
+                # keep the copies of still included files.
+                acls_filenames.extend([acls_filename, 'poseidon_' + acls_filename])
+            for conf_file in list(conf_files):
                 if conf_file.startswith('poseidon') and conf_file not in acls_filenames:
                     obj_doc['include'].remove(conf_file)
                     self.logger.info(
@@ -58,11 +180,17 @@ class ACL:
             else:
                 acls_filename = f
             poseidon_acls_filename = 'poseidon_' + acls_filename
+            poseidon_acls_file = os.path.join(rules_path, poseidon_acls_filename)
+            acls_digest = hashlib.sha256(
+                yaml.safe_dump(acls_doc).encode()).hexdigest()
             if poseidon_acls_filename not in conf_files:
                 obj_doc['include'].append(poseidon_acls_filename)
-                self.frpc.write_faucet_conf(os.path.join(
-                    rules_path, poseidon_acls_filename), acls_doc)
                 self.logger.info('Adding {0} to config'.format(acls_filename))
+            elif _written_acls_digests.get(poseidon_acls_file, None) == acls_digest:
+                # copy already included and up to date.
+                continue
+            self.frpc.write_faucet_conf(poseidon_acls_file, acls_doc)
+            _written_acls_digests[poseidon_acls_file] = acls_digest
 
         # get defined ACL names from included files
         acl_names = []
@@ -70,75 +198,10 @@ class ACL:
             acl_names.extend(list(acls_doc.get('acls', [])))
         return obj_doc, acl_names
 
-    def match_rules(self, rule, rules, obj_doc, endpoint, switch, port, all_rule_acls, force_apply_rules):
-        matches = 0
-        for r in rules[rule]:
-            if 'rule' in r and 'device_key' in r['rule']:
-                rule_data = r['rule']
-                if rule_data['device_key'] == 'os':
-                    match = False
-                    for addresses in ('ipv4_addresses', 'ipv6_addresses'):
-                        if 'addresses' in endpoint.metadata:
-                            for ip, ip_metadata in endpoint.metadata['addresses']:
-                                if 'os' in ip_metadata and ip_metadata['os'] == rule_data['value']:
-                                    self.logger.info('{0} os match: {1} {2}, rule: {3}'.format(
-                                        addresses, ip, rule_data['value'], rule))
-                                    match = True
-                    if match:
-                        matches += 1
-                elif rule_data['device_key'] == 'role':
-                    match = False
-                    if 'mac_addresses' in endpoint.metadata:
-                        for mac, mac_metadata in endpoint.metadata['mac_addresses'].items():
-                            most_recent = 0
-                            for record in mac_metadata:
-                                if float(record) > most_recent:
-                                    most_recent = float(record)
-                            most_recent = str(most_recent)
-                            if most_recent != '0' and most_recent in mac_metadata and 'labels' in mac_metadata[most_recent] and 'confidences' in mac_metadata[most_recent]:
-                                # check top three
-                                for i in range(3):
-                                    if mac_metadata[most_recent]['labels'][i] == rule_data['value']:
-                                        if 'min_confidence' in rule_data['value']:
-                                            if float(mac_metadata[most_recent]['confidences'][i])*100 >= rule_data['min_confidence']:
-                                                self.logger.info('Confidence match: {0} {1}, rule: {2}'.format(mac, float(
-                                                    mac_metadata[most_recent]['confidences'][i])*100, rule))
-                                                match = True
-                                        else:
-                                            self.logger.info('Role match: {0} {1}, rule: {2}'.format(
-                                                mac, rule_data['value'], rule))
-                                            match = True
-                    if match:
-                        matches += 1
-        if matches == len(rules[rule]) or (force_apply_rules and rule in force_apply_rules):
-            rule_acls = []
-            for r in rules[rule]:
-                rule_acls += r['rule']['acls']
-                all_rule_acls += r['rule']['acls']
-            rule_acls = list(set(rule_acls))
-            interfaces_conf = obj_doc['dps'][switch]['interfaces']
-            if rule_acls:
-                if port not in interfaces_conf:
-                    interfaces_conf[port] = {}
-            port_conf = interfaces_conf[port]
-            if 'acls_in' not in port_conf:
-                self.logger.info('All rules met for: {0} on switch: {1} and port: {2}; applying ACLs: {3}'.format(
-                    endpoint.endpoint_data['mac'], switch, port, rule_acls))
-                port_conf['acls_in'] = rule_acls
-            else:
-                # add new ACLs
-                orig_rule_acls = rule_acls
-                rule_acls += port_conf['acls_in']
-                rule_acls = list(set(rule_acls))
-                if port_conf['acls_in'] != rule_acls:
-                    port_conf['acls_in'] = rule_acls
-                    self.logger.info('All rules met for: {0} on switch: {1} and port: {2}; applying ACLs: {3}'.format(
-                        endpoint.endpoint_data['mac'], switch, port, orig_rule_acls))
-        return obj_doc, all_rule_acls
-
     def apply_acls(self, rules_file, endpoints, force_apply_rules,
                    force_remove_rules, coprocess_rules_files, obj_doc,
                    rules_doc):
+        self.port_acl_changes = {}
         if not endpoints:
             return obj_doc
 
@@ -152,21 +215,18 @@ class ACL:
                                                         obj_doc)
 
         if 'rules' in rules_doc:
-            acls = []
-            rules = rules_doc['rules']
-
-            for rule in rules:
-                for r in rules[rule]:
-                    acls += r['rule']['acls']
-            acls = list(set(acls))
+            compiled = compile_rules(rules_file, rules_doc['rules'])
 
             # check that acls in rules exist in the included acls file
             if 'include' in rules_doc:
-                for acl in acls:
+                for acl in compiled.acls:
                     if acl not in acl_names:
                         self.logger.info(
                             'Using named ACL: {0}, but it was not found in included ACL files, assuming ACL name exists in Faucet config'.format(acl))
 
+            force_apply_rules = set(force_apply_rules or ()).intersection(
+                compiled.rules)
+            force_remove_rules = set(force_remove_rules or ())
             for endpoint in endpoints:
                 port = int(endpoint.endpoint_data['port'])
                 switch = endpoint.endpoint_data['segment']
@@ -179,19 +239,38 @@ class ACL:
                 existing_acls = port_conf.get('acls_in', None)
                 if not existing_acls:
                     continue
-                all_rule_acls = []
-                for rule in rules:
-                    obj_doc, all_rule_acls = self.match_rules(
-                        rule, rules, obj_doc, endpoint, switch, port, all_rule_acls, force_apply_rules)
-                # remove ACLs that were previously applied
-                all_rule_acls = list(set(all_rule_acls))
-                for acl in existing_acls:
-                    if acl in acls and (acl not in all_rule_acls or acl in force_remove_rules):
-                        port_conf['acls_in'].remove(acl)
-                        self.logger.info('Removing no longer needed ACL: {0} for: {1} on switch: {2} and port: {3}'.format(
-                            acl, endpoint.endpoint_data['mac'], switch, port))
+                self.apply_port_acls(
+                    compiled, endpoint, switch, port, port_conf,
+                    compiled.matching_rules(endpoint).union(force_apply_rules),
+                    force_remove_rules)
 
         # TODO acl by port - potentially later update rules in acls to be mac/ip specific
         # TODO ignore trunk ports/stacking ports?
 
         return obj_doc
+
+    def apply_port_acls(self, compiled, endpoint, switch, port, port_conf, rules, force_remove_rules):
+        ''' set acls_in for the port to its existing ACLs plus those of rules, less ACLs of rules no longer met. '''
+        existing_acls = port_conf['acls_in']
+        mac = endpoint.endpoint_data['mac']
+        rule_acls = []
+        for rule in sorted(rules, key=compiled.rule_order.get):
+            rule_acls.extend(compiled.rule_acls[rule])
+            self.logger.debug('All rules met for: {0} on switch: {1} and port: {2}; rule: {3}'.format(
+                mac, switch, port, rule))
+        rule_acls = list(dict.fromkeys(rule_acls))
+        new_acls = list(existing_acls)
+        added_acls = [acl for acl in rule_acls if acl not in existing_acls]
+        if added_acls:
+            new_acls.extend(added_acls)
+            self.logger.info('All rules met for: {0} on switch: {1} and port: {2}; applying ACLs: {3}'.format(
+                mac, switch, port, added_acls))
+        # remove ACLs that were previously applied
+        for acl in existing_acls:
+            if acl in compiled.acls and (acl not in rule_acls or acl in force_remove_rules):
+                new_acls.remove(acl)
+                self.logger.info('Removing no longer needed ACL: {0} for: {1} on switch: {2} and port: {3}'.format(
+                    acl, mac, switch, port))
+        if new_acls != existing_acls:
+            port_conf['acls_in'] = new_acls
+            self.port_acl_changes[(switch, port)] = new_acls
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark construction time and memory of endpoints (with typical
+endpoint_data), comparing the shared table driven state machines with a
+transitions.Machine per state family per endpoint (as endpoints used to be
+built).
+
+Usage: python3 tests/benchmark_endpoints.py [endpoints]
+"""
+import gc
+import resource
+import sys
+import time
+
+from poseidon_core.constants import NO_DATA
+from poseidon_core.helpers.endpoint import Endpoint
+from poseidon_core.helpers.endpoint import endpoint_factory
+from transitions import Machine
+
+
+class LegacyEndpoint(Endpoint):
+    ''' Endpoint with a __dict__, so transitions can bind triggers to it. '''
+
+
+def legacy_endpoint_factory(hashed_val):
+    endpoint = LegacyEndpoint(hashed_val)
+    machine = Machine(
+        model=endpoint,
+        model_attribute='state',
+        states=Endpoint.states,
+        transitions=Endpoint.transitions,
+        initial='unknown',
+        send_event=True)
+    copro_machine = Machine(
+        model=endpoint,
+        model_attribute='copro_state',
+        states=Endpoint.copro_states,
+        transitions=Endpoint.copro_transitions,
+        initial='copro_unknown',
+        send_event=True)
+    endpoint.__dict__['machine'] = machine
+    endpoint.__dict__['copro_machine'] = copro_machine
+    return endpoint
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark(factory, count):
+    gc.collect()
+    start_rss = max_rss_kb()
+    start = time.monotonic()
+    endpoints = [factory('%032x' % i) for i in range(count)]
+    for i, endpoint in enumerate(endpoints):
+        endpoint.endpoint_data = {
+            'mac': '0e:00:00:%02x:%02x:%02x' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+            'segment': 'switch1', 'port': str(i % 48 + 1), 'vlan': 'VLAN100',
+            'tenant': 'VLAN100', 'active': 1, 'ipv4': '10.0.%u.%u' % (i >> 8 & 0xff, i & 0xff),
+            'ipv6': 0, 'ipv4_subnet': '10.0.%u.0/24' % (i >> 8 & 0xff), 'ipv4_rdns': NO_DATA,
+            'ipv6_subnet': NO_DATA, 'ipv6_rdns': NO_DATA, 'ether_vendor': 'Vendor',
+            'controller_type': 'faucet', 'controller': '', 'name': None}
+    elapsed = time.monotonic() - start
+    rss = max_rss_kb() - start_rss
+    for endpoint in endpoints:
+        endpoint.operate()
+        endpoint.copro_queue()
+    return elapsed, rss, endpoints
+
+
+def main():
+    count = 10000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    per = count / 1e4
+    # shared machines first, so the legacy run doesn't reuse its freed memory.
+    for label, factory in (
+            ('shared machine', endpoint_factory),
+            ('machine per endpoint', legacy_endpoint_factory)):
+        elapsed, rss, endpoints = benchmark(factory, count)
+        print('{0:>20}: {1:.3f}s and {2:.1f}MB max RSS growth per 10k endpoints'.format(
+            label, elapsed / per, rss / 1024 / per))
+        del endpoints
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from poseidon_core.controllers.sdnconnect import SDNConnect
 from poseidon_core.helpers.config import Config
 from poseidon_core.helpers.config import yaml_in
 from poseidon_core.helpers.config import yaml_out
+from poseidon_core.helpers.endpoint import endpoint_factory
 from poseidon_core.helpers.prometheus import Prometheus
 
 
@@ -10,6 +11,7 @@ class FaucetLocalConfGetSetter(FaucetRemoteConfGetSetter):
 
     def __init__(self, **_kwargs):
         self.faucet_conf = {}
+        self.init_snapshot(cache_ttl=0)
 
     @staticmethod
     def config_file_path(config_file):
@@ -82,9 +84,20 @@ class FaucetLocalConfGetSetter(FaucetRemoteConfGetSetter):
 def get_test_config():
     config = Config().get_config()
     config['faucetconfrpc_address'] = None
+    config['endpoint_store_file'] = None
+    config['endpoint_feed_file'] = None
+    config['publish_endpoint_changes'] = False
     return config
 
 
+def get_test_endpoint(name, mac='00:00:00:00:00:01', ipv4='', ipv6=''):
+    endpoint = endpoint_factory(name)
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': mac, 'segment': 'foo', 'port': '1',
+        'ipv4': ipv4, 'ipv6': ipv6}
+    return endpoint
+
+
 def get_sdn_connect(logger):
     config = get_test_config()
     prom = Prometheus()
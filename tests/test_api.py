@@ -1,6 +1,11 @@
+import json
+import time
+import zlib
+
 import falcon
 import pytest
 from falcon import testing
+from poseidon_api import data
 from poseidon_api.api import api
 
 
@@ -35,3 +40,248 @@ def test_network_full(client):
 def test_info(client):
     response = client.simulate_get('/v1/info')
     assert response.status == falcon.HTTP_OK
+
+
+def test_response_cache():
+    from threading import Barrier, Thread
+
+    cache = data.ResponseCache()
+    fetches = []
+    barrier = Barrier(4)
+
+    def fetch():
+        fetches.append(None)
+        time.sleep(0.2)
+        return len(fetches)
+
+    results = []
+
+    def get():
+        barrier.wait()
+        results.append(cache.get('foo', fetch, 60))
+
+    threads = [Thread(target=get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1, 1, 1, 1]
+    assert cache.get('foo', fetch, 60) == 1
+    assert cache.get('bar', fetch, 0) == 2
+    assert cache.get('bar', fetch, 0) == 3
+
+    def fail():
+        raise ValueError('no prometheus')
+
+    with pytest.raises(ValueError):
+        cache.get('baz', fail, 60)
+    assert cache.get('baz', fetch, 60) == 4
+
+
+def test_scrape_prometheus(monkeypatch):
+    results = {
+        'poseidon_endpoint_metadata': [
+            {'metric': {'hash_id': 'foo', 'mac': '00:00:00:00:00:01', 'state': 'known'}, 'value': [1, '10']},
+            {'metric': {'hash_id': 'foo', 'mac': '00:00:00:00:00:01', 'state': 'operating'}, 'value': [1, '20']}],
+        'poseidon_role_confidence_top': [
+            {'metric': {'hash_id': 'foo', 'mac': '00:00:00:00:00:01', 'role': 'printer'}, 'value': [1, '0.9']}],
+        'poseidon_role_confidence_second': [
+            {'metric': {'hash_id': 'foo', 'role': 'server'}, 'value': [1, '0.1']}],
+        'poseidon_role_confidence_third': []}
+    queries = []
+
+    def prom_instant_query(_client, _prometheus_addr, metric):
+        queries.append(metric)
+        return results[metric]
+
+    monkeypatch.setattr(data, 'prom_instant_query', prom_instant_query)
+    monkeypatch.setattr(data, 'PROM_CACHE', data.ResponseCache())
+    nodes = data.Nodes(data.Network.get_fields())
+    nodes.build_nodes()
+    assert sorted(queries) == sorted(results)
+    assert len(nodes.nodes) == 1
+    assert nodes.nodes[0]['state'] == 'operating'
+    assert nodes.nodes[0]['top_role'] == 'printer'
+    assert nodes.nodes[0]['top_confidence'] == 0.9
+    # served from the cache.
+    data.Network.get_dataset()
+    assert len(queries) == len(results)
+    index = data.Nodes(data.Network.get_fields()).get_index()
+    assert index.hash_ids == ['foo']
+    assert data.Nodes(data.Network.get_fields()).get_index() is index
+
+
+def _node(hash_id, state, ipv4, ipv4_subnet, role='printer'):
+    return dict(data.NetworkFull.get_fields(), hash_id=hash_id, state=state,
+                ipv4_address=ipv4, ipv4_subnet=ipv4_subnet, top_role=role)
+
+
+def test_node_index():
+    index = data.NodeIndex([
+        _node('c', 'known', '10.0.1.1', '10.0.1.0/24'),
+        _node('a', 'known', '10.0.0.1', '10.0.0.0/24', role='server'),
+        _node('b', 'operating', '192.168.0.1', '192.168.0.0/24')])
+    assert [index.hash_ids[position] for position in index.select({})] == ['a', 'b', 'c']
+    assert index.select({'state': 'known'}) == [0, 2]
+    assert index.select({'state': 'known', 'role': 'printer'}) == [2]
+    assert index.select({'subnet': '10.0.0.0/16'}) == [0, 2]
+    assert index.select({'ip': '192.168.0.1'}) == [1]
+    assert index.select({'state': 'unknown', 'subnet': '10.0.0.0/16'}) == []
+    with pytest.raises(ValueError):
+        index.select({'subnet': 'foo'})
+    positions = index.select({})
+    nodes, cursor = index.page(positions, limit=2)
+    assert [node['hash_id'] for node in nodes] == ['a', 'b']
+    assert cursor == 'b'
+    nodes, cursor = index.page(positions, cursor=cursor, limit=2)
+    assert [node['hash_id'] for node in nodes] == ['c']
+    assert cursor is None
+
+
+def test_network_query(client, monkeypatch):
+    nodes = [
+        _node('c', 'known', '10.0.1.1', '10.0.1.0/24'),
+        _node('a', 'known', '10.0.0.1', '10.0.0.0/24'),
+        _node('b', 'operating', '192.168.0.1', '192.168.0.0/24')]
+    monkeypatch.setattr(
+        data.Nodes, 'get_index', lambda _self: data.NodeIndex(nodes))
+    monkeypatch.setattr(data, 'STREAM_CHUNK_SIZE', 16)
+    response = client.simulate_get(
+        '/v1/network', params={'state': 'known', 'fields': 'hash_id,ipv4_address', 'limit': 1})
+    assert response.status == falcon.HTTP_OK
+    assert response.json['dataset'] == [
+        {'hash_id': 'a', 'ipv4_address': '10.0.0.1'}]
+    assert [field['path'] for field in response.json['configuration']['fields']] == [
+        ['hash_id'], ['ipv4_address']]
+    assert response.json['next_cursor'] == 'a'
+    response = client.simulate_get(
+        '/v1/network', params={'state': 'known', 'fields': 'hash_id', 'cursor': 'a'})
+    assert response.json['dataset'] == [{'hash_id': 'c'}]
+    assert 'next_cursor' not in response.json
+    response = client.simulate_get('/v1/network/192.168.0.1')
+    assert [node['hash_id'] for node in response.json['dataset']] == ['b']
+    response = client.simulate_get('/v1/network_full', params={'subnet': '10.0.0.0/8'})
+    assert [node['hash_id'] for node in response.json['dataset']] == ['a', 'c']
+    response = client.simulate_get('/v1/network', params={'fields': 'foo'})
+    assert response.status == falcon.HTTP_BAD_REQUEST
+    response = client.simulate_get('/v1/network', params={'subnet': 'foo'})
+    assert response.status == falcon.HTTP_BAD_REQUEST
+    assert b''.join(data.stream_dataset(nodes, ['hash_id'], chunk_size=1)) == \
+        b'{"dataset":[{"hash_id":"c"},{"hash_id":"a"},{"hash_id":"b"}]}'
+
+
+def test_network_conditional_get(client, monkeypatch):
+    nodes = [_node('a', 'known', '10.0.0.1', '10.0.0.0/24')]
+    index = data.NodeIndex(nodes)
+    monkeypatch.setattr(data.Nodes, 'get_index', lambda _self: index)
+    response = client.simulate_get('/v1/network')
+    assert response.status == falcon.HTTP_OK
+    etag = response.headers['etag']
+    assert response.headers['last-modified']
+    response = client.simulate_get(
+        '/v1/network', headers={'If-None-Match': etag})
+    assert response.status == falcon.HTTP_NOT_MODIFIED
+    assert not response.content
+    response = client.simulate_get(
+        '/v1/network', headers={'If-Modified-Since': response.headers['last-modified']})
+    assert response.status == falcon.HTTP_NOT_MODIFIED
+    # other parameters or content have other ETags.
+    response = client.simulate_get(
+        '/v1/network', params={'state': 'known'}, headers={'If-None-Match': etag})
+    assert response.status == falcon.HTTP_OK
+    index = data.NodeIndex([_node('a', 'operating', '10.0.0.1', '10.0.0.0/24')])
+    response = client.simulate_get(
+        '/v1/network', headers={'If-None-Match': etag})
+    assert response.status == falcon.HTTP_OK
+    assert response.json['dataset'][0]['state'] == 'operating'
+
+
+def test_compression(client, monkeypatch):
+    nodes = [_node(str(i), 'known', '10.0.0.1', '10.0.0.0/24') for i in range(100)]
+    monkeypatch.setattr(
+        data.Nodes, 'get_index', lambda _self: data.NodeIndex(nodes))
+    plain = client.simulate_get('/v1/network')
+    assert 'content-encoding' not in plain.headers
+    for encoding, wbits in (('gzip', 31), ('deflate', 15)):
+        response = client.simulate_get(
+            '/v1/network', headers={'Accept-Encoding': f'br;q=1.0, {encoding}'})
+        assert response.headers['content-encoding'] == encoding
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert zlib.decompress(response.content, wbits) == plain.content
+        assert len(response.content) < len(plain.content)
+        # each encoding has its own ETag, that's current for that encoding only.
+        etag = response.headers['etag']
+        assert etag == plain.headers['etag'][:-1] + f'-{encoding}"'
+        assert client.simulate_get(
+            '/v1/network', headers={'Accept-Encoding': encoding, 'If-None-Match': etag}).status == falcon.HTTP_NOT_MODIFIED
+        assert client.simulate_get(
+            '/v1/network', headers={'If-None-Match': etag}).status == falcon.HTTP_OK
+        response = client.simulate_get(
+            '/v1/network', headers={'If-None-Match': plain.headers['etag'], 'Accept-Encoding': encoding})
+        assert response.status == falcon.HTTP_OK
+    response = client.simulate_get(
+        '/v1/network', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'content-encoding' not in response.headers
+    # small bodies aren't worth compressing.
+    response = client.simulate_get(
+        '/v1/info', headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in response.headers
+
+
+def test_endpoint_replica(client, monkeypatch, tmp_path):
+    from poseidon_core.helpers.endpoint import endpoint_factory
+    from poseidon_core.helpers.feed import FileEndpointFeed
+
+    def _endpoint(name, ipv4):
+        endpoint = endpoint_factory(name)
+        endpoint.endpoint_data = {
+            'tenant': 'vlan1', 'mac': '00:00:00:00:00:01', 'segment': 'switch1', 'port': '1',
+            'ipv4': ipv4, 'ipv6': '', 'ipv4_subnet': '10.0.0.0/24'}
+        endpoint.metadata = {
+            'mac_addresses': {'00:00:00:00:00:01': {'classification': {
+                'labels': ['printer', 'server', 'foo'], 'confidences': [0.7, 0.2, 0.1]}}},
+            'ipv4_addresses': {ipv4: {'short_os': 'Linux'}}}
+        return endpoint
+
+    path = str(tmp_path / 'endpoints.feed')
+    replica = data.EndpointReplica(path)
+    assert replica.read() == (None, None)
+
+    feed = FileEndpointFeed(path)
+    foo = _endpoint('foo', '10.0.0.1')
+    feed.put_snapshot([foo])
+    version, records = replica.read()
+    assert [record['name'] for record in records] == ['foo']
+    assert replica.read()[0] is version
+
+    foo.operate()
+    feed.put_delta([foo, _endpoint('bar', '10.0.0.2')], [])
+    # a partially written delta isn't applied until it is complete.
+    with open(path + '.deltas', 'a') as deltas:
+        deltas.write('{"seq": 3, "removed": ["foo"]')
+    version, records = replica.read()
+    assert sorted(record['name'] for record in records) == ['bar', 'foo']
+    with open(path + '.deltas', 'a') as deltas:
+        deltas.write(', "put": []}\n')
+    version, records = replica.read()
+    assert [record['name'] for record in records] == ['bar']
+    feed.close()
+
+    node = data.record_node(data.Network.get_fields(), json.loads(foo.encode()))
+    assert node['hash_id'] == 'foo'
+    assert node['state'] == 'operating'
+    assert node['ipv4_address'] == '10.0.0.1'
+    assert node['top_role'] == 'printer'
+    assert node['top_confidence'] == 0.7
+    assert node['ipv4_os'] == 'Linux'
+    assert node['ignore'] == 'False'
+
+    # the API serves from the replica rather than Prometheus.
+    def no_prometheus(_self):
+        raise AssertionError('queried Prometheus')
+
+    monkeypatch.setenv('ENDPOINT_FEED_FILE', path)
+    monkeypatch.setattr(data.Nodes, 'query_prometheus', no_prometheus)
+    response = client.simulate_get('/v1/network/10.0.0.2')
+    assert [node['hash_id'] for node in response.json['dataset']] == ['bar']
+    assert response.json['dataset'][0]['top_role'] == 'printer'
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for endpoint change data capture.
+"""
+import json
+import logging
+
+from faucetconfgetsetter import get_sdn_connect
+from faucetconfgetsetter import get_test_endpoint
+from poseidon_core.controllers.sdnevents import SDNEvents
+from poseidon_core.helpers.changes import EndpointChangeLog
+from poseidon_core.helpers.prometheus import Prometheus
+from poseidon_core.helpers.registry import EndpointRegistry
+
+logger = logging.getLogger('test')
+
+
+def test_endpoint_change_log():
+    changes = EndpointChangeLog(size=3)
+    endpoints = EndpointRegistry({'foo': get_test_endpoint('foo')})
+    assert changes.capture(endpoints) == []
+    epoch = changes.epoch
+
+    endpoints['bar'] = get_test_endpoint('bar')
+    endpoints['foo'].operate()
+    endpoints['foo'].endpoint_data = dict(
+        endpoints['foo'].endpoint_data, port='2')
+    records = changes.capture(endpoints)
+    assert [(record['seq'], record['name'], record['op']) for record in records] == [
+        (1, 'bar', 'put'), (2, 'foo', 'update')]
+    assert records[0]['endpoint']['name'] == 'bar'
+    assert records[1]['fields'] == {'endpoint_data.port': '2', 'state': 'operating'}
+
+    del endpoints['bar']
+    endpoints['foo'].ignore = True
+    records = changes.capture(endpoints)
+    assert [(record['seq'], record['op']) for record in records] == [
+        (3, 'remove'), (4, 'update')]
+    assert changes.capture(endpoints) == []
+
+    assert [record['seq'] for record in changes.since(2)] == [3, 4]
+    assert changes.since(4) == []
+    # seq 2 is no longer logged, or from the future.
+    assert changes.since(0) is None
+    assert changes.since(5) is None
+    snapshot = changes.snapshot(endpoints.values())
+    assert [(record['seq'], record['name'], record['op']) for record in snapshot] == [
+        (4, 'foo', 'put')]
+
+    messages = changes.messages('foo', records, resync=True)
+    assert len(messages) == 1
+    assert messages[0][0] == 'foo'
+    message = json.loads(messages[0][1])
+    assert message['epoch'] == epoch
+    assert message['seq'] == 4
+    assert message['resync']
+    changes.BATCH_SIZE = 1
+    assert len(changes.messages('foo', records)) == 2
+    assert len(changes.messages('foo', [])) == 1
+
+    # a new registry starts a new epoch.
+    assert changes.capture(EndpointRegistry()) == []
+    assert changes.epoch != epoch
+    assert changes.seq == 0
+
+
+def test_endpoint_change_log_heartbeats():
+    changes = EndpointChangeLog()
+    endpoints = EndpointRegistry({'foo': get_test_endpoint('foo')})
+    changes.capture(endpoints)
+    # just seeing an endpoint again isn't a change.
+    endpoints['foo'].touch()
+    assert changes.capture(endpoints) == []
+    endpoints['foo'].touch()
+    endpoints['foo'].operate()
+    assert [record['fields'] for record in changes.capture(endpoints)] == [
+        {'state': 'operating'}]
+    assert changes.seq == 1
+
+
+def test_publish_changes():
+    s = get_sdn_connect(logger)
+    sdne = SDNEvents(logger, Prometheus(), s)
+    published = []
+    s.publish_actions_background = published.extend
+    s.endpoints['foo'] = get_test_endpoint('foo')
+    s.publish_changes()
+    assert published == []
+    s.config['publish_endpoint_changes'] = True
+    s.publish_changes()
+    assert published == []
+    s.endpoints['foo'].operate()
+    s.publish_changes()
+    assert [routing_key for routing_key, _ in published] == [
+        'poseidon.endpoints.changes']
+    message = json.loads(published[0][1])
+    assert [record['fields'] for record in message['changes']] == [
+        {'state': 'operating'}]
+
+    published.clear()
+    sdne.handler_action_changes_since(
+        [{'seq': 0, 'epoch': message['epoch']}], [], [])
+    routing_key, body = published[-1]
+    assert routing_key == 'poseidon.endpoints.catchup'
+    assert [record['seq'] for record in json.loads(body)['changes']] == [1]
+    sdne.handler_action_changes_since(
+        [{'seq': 0, 'epoch': 'other', 'reply_to': 'bar'}], [], [])
+    routing_key, body = published[-1]
+    assert routing_key == 'bar'
+    assert json.loads(body)['resync']
+    assert [record['name'] for record in json.loads(body)['changes']] == ['foo']
+    sdne.handler_action_changes_since([{'seq': 'foo'}], [], [])
+    assert len(published) == 2
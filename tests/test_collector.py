@@ -4,7 +4,11 @@ Test module for collector.
 @author: Charlie Lewis
 """
 from poseidon_core.helpers.collector import Collector
+from poseidon_core.helpers.collector import get_network_tap_client
+from poseidon_core.helpers.collector import NetworkTapClient
+from poseidon_core.helpers.config import Config
 from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.helpers.registry import EndpointRegistry
 
 
 def test_Collector():
@@ -23,3 +27,63 @@ def test_Collector():
         'mac': '00:00:00:00:00:00', 'container_id': 'foo'}
     a = Collector(endpoint, 'foo')
     a.stop_collector()
+
+
+def test_Collector_batch():
+    config = Config().get_config()
+    config['collector_nic'] = 'eth0'
+    client = get_network_tap_client(config)
+    assert client is get_network_tap_client(config)
+
+    class MockHistogram:
+
+        def __init__(self):
+            self.observed = []
+
+        def labels(self, action):
+            self.observed.append(action)
+            return self
+
+        def observe(self, _value):
+            return
+
+    class MockClient:
+
+        def __init__(self):
+            self.requests = []
+
+        def request(self, action, method='POST', payload=None):
+            self.requests.append((action, payload))
+            if action == 'create':
+                return '[true, "created: %s"]' % payload['id']
+            return "(True, 'stopped')"
+
+    endpoints = []
+    for name in ('foo', 'bar'):
+        endpoint = endpoint_factory(name)
+        endpoint.endpoint_data = {'mac': '00:00:00:00:00:00'}
+        endpoints.append(endpoint)
+    registry = EndpointRegistry({endpoint.name: endpoint for endpoint in endpoints})
+    registry.pop_dirty('store')
+    collectors = [Collector(endpoint, 'foo', config=config) for endpoint in endpoints]
+    mock_client = MockClient()
+    mock_client.parse_response = NetworkTapClient.parse_response
+    for collector in collectors:
+        collector.client = mock_client
+    assert Collector.start_collectors(collectors) == [True, True]
+    assert [endpoint.endpoint_data['container_id'] for endpoint in endpoints] == ['foo', 'bar']
+    # the container IDs are tracked as changes, so they are stored.
+    assert {name: fields for name, (_, fields) in registry.pop_dirty_fields('store').items()} == {
+        'foo': {'endpoint_data.container_id'}, 'bar': {'endpoint_data.container_id'}}
+    assert Collector.stop_collectors(collectors) == [True, True]
+    assert mock_client.requests[-1] == ('stop', {'id': ['foo', 'bar']})
+    assert len(mock_client.requests) == 3
+
+    histogram = MockHistogram()
+    client = NetworkTapClient('localhost:1', timeout=0.1, connect_timeout=0.1)
+    client.request_secs = histogram
+    try:
+        client.request('list', method='GET')
+    except Exception:
+        pass
+    assert histogram.observed == ['list']
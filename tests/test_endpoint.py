@@ -3,11 +3,16 @@
 Test module for endpoints.
 @author: Charlie Lewis
 """
+import copy
+import json
 import time
 
+import pytest
 from poseidon_core.helpers.endpoint import Endpoint
 from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.helpers.endpoint import EndpointData
 from poseidon_core.helpers.endpoint import EndpointDecoder
+from transitions import MachineError
 
 
 def test_Endpoint():
@@ -29,3 +34,58 @@ def test_times_next():
     assert endpoint.copro_state_timeout(0)
     endpoint.trigger_next()
     endpoint.copro_trigger_next()
+
+
+def test_shared_machine():
+    foo = endpoint_factory('foo')
+    bar = endpoint_factory('bar')
+    assert foo.machine is bar.machine
+    assert (foo.state, foo.copro_state) == ('unknown', 'copro_unknown')
+    foo.operate()
+    assert foo.state == 'operating'
+    assert foo.state_time
+    assert bar.state == 'unknown'
+    with pytest.raises(MachineError):
+        foo.queue()
+    assert foo.state == 'operating'
+    foo.machine_trigger('known')
+    assert foo.state == 'known'
+    with pytest.raises(KeyError):
+        foo.machine_trigger('copro_queue')
+    foo.copro_machine_trigger('copro_queue')
+    foo.copro_coprocess()
+    assert foo.copro_state == 'copro_coprocessing'
+    assert foo.copro_state_time
+    assert bar.copro_state == 'copro_unknown'
+
+
+def test_endpoint_data():
+    data = {'mac': '00:00:00:00:00:01', 'segment': 'switch1', 'port': '1',
+            'tenant': 'VLAN100', 'ipv4': '10.0.0.1', 'custom': 'foo'}
+    endpoint = endpoint_factory('foo')
+    with pytest.raises(AttributeError):
+        endpoint.foo = 'bar'
+    endpoint.endpoint_data = data
+    endpoint_data = endpoint.endpoint_data
+    assert isinstance(endpoint_data, EndpointData)
+    assert endpoint_data == data
+    assert dict(endpoint_data) == data
+    assert endpoint_data['custom'] == 'foo'
+    assert 'ipv6' not in endpoint_data
+    assert endpoint_data.get('ipv6', None) is None
+    with pytest.raises(KeyError):
+        endpoint_data['ipv6']
+    other_data = EndpointData(data)
+    assert other_data['segment'] is endpoint_data['segment']
+    other_data['container_id'] = 'abc'
+    del other_data['custom']
+    assert other_data != data
+    assert endpoint_data.changed_fields(other_data) == {'custom', 'container_id'}
+    assert endpoint_data.changed_fields(data) == set()
+    assert 'container_id' not in endpoint_data
+    copied_data = copy.deepcopy(endpoint_data)
+    copied_data['port'] = '2'
+    assert endpoint_data['port'] == '1'
+    decoded = EndpointDecoder(endpoint.encode()).get_endpoint()
+    assert decoded.endpoint_data == data
+    assert json.loads(endpoint.encode())['endpoint_data'] == data
@@ -7,8 +7,10 @@ import os
 import shutil
 import tempfile
 
+import mock
 import yaml
 from faucetconfgetsetter import FaucetLocalConfGetSetter
+from poseidon_core.controllers.faucet.config import FaucetRemoteConfGetSetter
 from poseidon_core.controllers.faucet.faucet import FaucetProxy
 from poseidon_core.helpers.config import Config
 from poseidon_core.helpers.config import parse_rules
@@ -16,6 +18,8 @@ from poseidon_core.helpers.config import represent_none
 from poseidon_core.helpers.config import yaml_in
 from poseidon_core.helpers.config import yaml_out
 from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.operations.primitives.acl import ACL
+from poseidon_core.operations.primitives.acl import compile_rules
 
 
 SAMPLE_CONFIG = 'tests/sample_faucet_config.yaml'
@@ -113,6 +117,21 @@ def test_parse_rules():
         parse_rules(os.path.join(tmpdir, os.path.basename(SAMPLE_CONFIG)))
 
 
+def test_parse_rules_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rules_file = os.path.join(tmpdir, 'rules.yaml')
+        yaml_out(rules_file, {'rules': {'foo': []}})
+        rules_doc = parse_rules(rules_file)
+        assert parse_rules(rules_file) is rules_doc
+        # same content with a new mtime is not parsed again.
+        stat = os.stat(rules_file)
+        os.utime(rules_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert parse_rules(rules_file) is rules_doc
+        yaml_out(rules_file, {'rules': {'bar': []}})
+        assert parse_rules(rules_file) == {'rules': {'bar': []}}
+    assert not parse_rules(None)
+
+
 def test_clear_mirrors():
     with tempfile.TemporaryDirectory() as tmpdir:
         faucetconfgetsetter_cl = FaucetLocalConfGetSetter
@@ -405,3 +424,250 @@ def test_config():
         check_config(parser, endpoints)
         check_config(parser2, endpoints)
         check_config(proxy, endpoints)
+
+        # mirror counts are reverted if the changes couldn't be sent.
+        assert parser.flush()
+        mirror_counts = dict(parser.mirror_counts)
+        parser.mirror_mac('00:00:00:00:00:00', 't1-1', 1)
+        assert dict(parser.mirror_counts) != mirror_counts
+        with mock.patch.object(parser.frpc, 'flush', return_value=False):
+            assert not parser.flush()
+        assert dict(parser.mirror_counts) == mirror_counts
+
+
+class FakeFaucetConfRpcClient:
+
+    def __init__(self, **_kwargs):
+        self.faucet_conf = yaml.safe_load("""
+dps:
+    s1:
+        interfaces:
+            1:
+                output_only: true
+            2:
+                native_vlan: 100
+            3:
+                native_vlan: 100
+""")
+        self.gets = 0
+        self.set_dp_interfaces_calls = []
+
+    def get_config_file(self, config_filename=None):
+        self.gets += 1
+        return yaml.safe_load(yaml.dump(self.faucet_conf))
+
+    def set_config_file(self, config_yaml, config_filename=None, merge=False):
+        return True
+
+    def set_dp_interfaces(self, dp_interfaces):
+        self.set_dp_interfaces_calls.append(dp_interfaces)
+        for dp, interfaces in dp_interfaces:
+            for port, port_conf in interfaces.items():
+                self.faucet_conf['dps'][dp]['interfaces'][port] = yaml.safe_load(
+                    port_conf)
+        return True
+
+
+def test_remote_batched_mirrors():
+    with mock.patch('poseidon_core.controllers.faucet.config.FaucetConfRpcClient', FakeFaucetConfRpcClient):
+        frpc = FaucetRemoteConfGetSetter()
+    client = frpc.client
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True}
+    assert frpc.get_switch_conf('s1')
+    assert client.gets == 1
+
+    # mirror/unmirror of the same port cancel out, so nothing is sent.
+    frpc.mirror_port('s1', 1, 2)
+    frpc.unmirror_port('s1', 1, 2)
+    frpc.flush()
+    assert client.set_dp_interfaces_calls == []
+
+    frpc.mirror_port('s1', 1, 2)
+    frpc.mirror_port('s1', 1, 3)
+    frpc.mirror_port('s1', 1, 3)
+    frpc.set_port_conf('s1', 3, {'native_vlan': 200})
+    frpc.flush()
+    assert len(client.set_dp_interfaces_calls) == 1
+    assert client.faucet_conf['dps']['s1']['interfaces'][1]['mirror'] == [2, 3]
+    assert client.faucet_conf['dps']['s1']['interfaces'][3] == {'native_vlan': 200}
+
+    frpc.clear_mirror_port('s1', 1)
+    frpc.flush()
+    assert client.faucet_conf['dps']['s1']['interfaces'][1] == {'output_only': True}
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True}
+    # each batch is queued against a freshly fetched snapshot.
+    assert client.gets == 5
+
+    # so others' changes to the mirror port aren't overwritten.
+    client.faucet_conf['dps']['s1']['interfaces'][1]['description'] = 'mirror'
+    frpc.mirror_port('s1', 1, 2)
+    frpc.flush()
+    assert client.faucet_conf['dps']['s1']['interfaces'][1] == {
+        'output_only': True, 'description': 'mirror', 'mirror': [2]}
+    client.faucet_conf['dps']['s1']['interfaces'][1] = {'output_only': True}
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True}
+    gets = client.gets
+
+    # other files are cached too, until written.
+    frpc.read_config_file('/etc/faucet/acls.yaml')
+    frpc.read_config_file('/etc/faucet/acls.yaml')
+    assert client.gets == gets + 1
+    frpc.write_faucet_conf('/etc/faucet/acls.yaml', {'acls': {}})
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True}
+    frpc.read_config_file('/etc/faucet/acls.yaml')
+    assert client.gets == gets + 2
+
+
+def test_remote_failed_flush():
+    with mock.patch('poseidon_core.controllers.faucet.config.FaucetConfRpcClient', FakeFaucetConfRpcClient):
+        frpc = FaucetRemoteConfGetSetter(cache_ttl=60)
+    client = frpc.client
+    client.set_dp_interfaces = lambda dp_interfaces: None
+
+    # callers get copies, so can't change the snapshot behind its back.
+    port_conf = frpc.get_port_conf('s1', 1)
+    port_conf['mirror'] = [2]
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True}
+
+    # a failed flush doesn't leave unsent changes in the snapshot.
+    frpc.mirror_port('s1', 1, 2)
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True, 'mirror': [2]}
+    assert frpc.flush() is False
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True}
+    assert client.gets == 3
+    assert frpc.flush() is True
+
+    # the snapshot isn't refetched (flushing) while changes are queued.
+    frpc.mirror_port('s1', 1, 2)
+    frpc.snapshot_time = 0
+    assert frpc.get_port_conf('s1', 1) == {'output_only': True, 'mirror': [2]}
+    assert frpc.flush() is False
+
+    # failures flushing before a write are reported by the next flush().
+    frpc.mirror_port('s1', 1, 2)
+    frpc.write_faucet_conf(config_file=None, faucet_conf={})
+    assert frpc.flush() is False
+    assert frpc.flush() is True
+
+
+def test_remote_config_snapshot():
+    with mock.patch('poseidon_core.controllers.faucet.config.FaucetConfRpcClient', FakeFaucetConfRpcClient):
+        frpc = FaucetRemoteConfGetSetter(cache_ttl=60)
+    client = frpc.client
+    assert frpc.get_stack_root_switch() is None
+    assert list(frpc.get_dps()) == ['s1']
+    assert frpc.get_port_conf('s1', 2) == {'native_vlan': 100}
+    assert frpc.get_port_conf('s1', 99) is None
+    assert frpc.get_switch_conf('s2') is None
+    assert client.gets == 1
+    assert frpc.snapshot_version == 1
+    assert frpc.pop_snapshot_stats() == {'miss': 1, 'hit': 4}
+
+    # our own writes invalidate the snapshot.
+    frpc.update_switch_conf('s1', {'timeout': 10})
+    assert frpc.get_switch_conf('s1')
+    assert frpc.snapshot_version == 2
+
+    # others' changes are picked up when the TTL expires.
+    client.faucet_conf['dps']['s1']['stack'] = {'priority': 1}
+    frpc.cache_ttl = 0
+    assert frpc.get_stack_root_switch() == 's1'
+    assert frpc.pop_snapshot_stats() == {'miss': 1, 'refresh': 1}
+
+
+def test_compiled_acl_rules():
+    rules_doc = yaml.safe_load("""
+rules:
+  os-rule:
+    - rule:
+        device_key: os
+        value: Mac
+        acls: [mac-acl]
+  role-rule:
+    - rule:
+        device_key: os
+        value: Mac
+        acls: [both-acl]
+    - rule:
+        device_key: role
+        value: Printer
+        min_confidence: 50
+        acls: [both-acl, printer-acl]
+  forced-rule:
+    - rule:
+        acls: [forced-acl]
+""")
+    obj_doc = yaml.safe_load("""
+dps:
+  s1:
+    interfaces:
+      1:
+        acls_in: [existing-acl]
+      2:
+        native_vlan: 100
+""")
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 's1', 'port': '1'}
+    endpoint.metadata = {
+        'mac_addresses': {'00:00:00:00:00:00': {
+            '1551805502.0': {'labels': ['Printer'], 'confidences': [0.4]},
+            '1551805503.0': {'labels': ['Printer'], 'confidences': [0.6]}}},
+        'ipv4_addresses': {'0.0.0.0': {'os': 'Mac'}}}
+    endpoint2 = endpoint_factory('bar')
+    endpoint2.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:01', 'segment': 's1', 'port': '2'}
+    endpoint2.metadata = endpoint.metadata
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rules_file = os.path.join(tmpdir, 'rules.yaml')
+        yaml_out(rules_file, rules_doc)
+        compiled = compile_rules(rules_file, rules_doc['rules'])
+        assert compile_rules(rules_file, rules_doc['rules']) is compiled
+        # a new parse of the file (e.g. rewritten with the same mtime) is recompiled.
+        assert compile_rules(rules_file, {'foo': []}).rules == {'foo': []}
+        compiled = compile_rules(rules_file, rules_doc['rules'])
+        assert compiled.matching_rules(endpoint) == {'os-rule', 'role-rule'}
+
+        acl = ACL(None)
+        acl.apply_acls(rules_file, [endpoint, endpoint2], None, None, None,
+                       obj_doc, rules_doc)
+        assert acl.port_acl_changes == {
+            ('s1', 1): ['existing-acl', 'mac-acl', 'both-acl', 'printer-acl']}
+        assert obj_doc['dps']['s1']['interfaces'][2] == {'native_vlan': 100}
+
+        # newest prediction is below min_confidence, so role-rule no longer applies.
+        endpoint.metadata['mac_addresses']['00:00:00:00:00:00']['1551805504.0'] = {
+            'labels': ['Printer'], 'confidences': [0.2]}
+        acl.apply_acls(rules_file, [endpoint], ['forced-rule'], None, None,
+                       obj_doc, rules_doc)
+        assert acl.port_acl_changes == {
+            ('s1', 1): ['existing-acl', 'mac-acl', 'forced-acl']}
+
+        # nothing changed, so nothing to send.
+        acl.apply_acls(rules_file, [endpoint], ['forced-rule'], None, None,
+                       obj_doc, rules_doc)
+        assert acl.port_acl_changes == {}
+
+
+def test_include_acl_files_unchanged():
+    class CountingConfGetSetter(FaucetLocalConfGetSetter):
+
+        writes = []
+
+        def write_faucet_conf(self, config_file=None, faucet_conf=None):
+            self.writes.append(config_file)
+            return super().write_faucet_conf(config_file, faucet_conf)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rules_file = os.path.join(tmpdir, 'rules.yaml')
+        shutil.copy('tests/sample_acls.yaml', os.path.join(tmpdir, 'acls.yaml'))
+        rules_doc = {'include': ['acls.yaml']}
+        frpc = CountingConfGetSetter()
+        acl = ACL(frpc)
+        obj_doc, acl_names = acl.include_acl_files(
+            rules_doc, rules_file, None, {'include': ['other.yaml']})
+        assert obj_doc['include'] == ['other.yaml', 'poseidon_acls.yaml']
+        assert 'acl_same_a' in acl_names
+        acl.include_acl_files(rules_doc, rules_file, None, obj_doc)
+        assert frpc.writes == [os.path.join(tmpdir, 'poseidon_acls.yaml')]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the endpoint feed.
+"""
+import json
+import logging
+import os
+import tempfile
+
+from faucetconfgetsetter import get_sdn_connect
+from faucetconfgetsetter import get_test_config
+from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.helpers.feed import EndpointFeed
+from poseidon_core.helpers.feed import FileEndpointFeed
+from poseidon_core.helpers.feed import get_endpoint_feed
+
+logger = logging.getLogger('test')
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_get_endpoint_feed():
+    config = get_test_config()
+    assert type(get_endpoint_feed(config)) == EndpointFeed
+    config['endpoint_feed_file'] = '/does/not/exist/endpoints.feed'
+    assert type(get_endpoint_feed(config)) == EndpointFeed
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config['endpoint_feed_file'] = os.path.join(tmpdir, 'endpoints.feed')
+        feed = get_endpoint_feed(config)
+        assert isinstance(feed, FileEndpointFeed)
+        assert feed.snapshot_due()
+
+
+def test_sdnconnect_publish_endpoints():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'endpoints.feed')
+        s = get_sdn_connect(logger)
+        s.feed = FileEndpointFeed(path, snapshot_secs=3600)
+        for name in ('foo', 'bar'):
+            endpoint = endpoint_factory(name)
+            endpoint.endpoint_data = {
+                'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
+            s.endpoints[endpoint.name] = endpoint
+        s.publish_endpoints()
+        snapshot = _read_lines(path)
+        snapshot_id = snapshot[0]['snapshot']
+        assert snapshot[0]['seq'] == 0
+        assert sorted(record['name'] for record in snapshot[1:]) == ['bar', 'foo']
+        assert _read_lines(path + '.deltas') == [{'snapshot': snapshot_id}]
+
+        # nothing changed, nothing published.
+        s.publish_endpoints()
+        assert len(_read_lines(path + '.deltas')) == 1
+        s.endpoints['foo'].touch()
+        s.publish_endpoints()
+        assert len(_read_lines(path + '.deltas')) == 1
+        s.endpoints['foo'].ignore = True
+        del s.endpoints['bar']
+        s.publish_endpoints()
+        deltas = _read_lines(path + '.deltas')
+        assert len(deltas) == 2
+        assert deltas[1]['seq'] == 1
+        assert deltas[1]['removed'] == ['bar']
+        assert [record['name'] for record in deltas[1]['put']] == ['foo']
+        assert deltas[1]['put'][0]['ignore']
+
+        s.feed.snapshot_secs = 0
+        s.publish_endpoints()
+        snapshot = _read_lines(path)
+        assert snapshot[0]['snapshot'] != snapshot_id
+        assert snapshot[0]['seq'] == 1
+        assert [record['name'] for record in snapshot[1:]] == ['foo']
+        assert _read_lines(path + '.deltas') == [
+            {'snapshot': snapshot[0]['snapshot']}]
+        s.feed.close()
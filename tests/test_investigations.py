@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the investigation queue.
+"""
+from faucetconfgetsetter import get_test_endpoint
+from poseidon_core.helpers.investigations import InvestigationQueue
+from poseidon_core.helpers.registry import EndpointRegistry
+
+
+def _endpoint(name, investigation_time, confidence=None):
+    endpoint = get_test_endpoint(name)
+    if confidence is not None:
+        endpoint.metadata = {'mac_addresses': {'00:00:00:00:00:01': {
+            'classification': {'labels': ['foo', 'bar', 'baz'], 'confidences': [confidence, 0, 0]}}}}
+    endpoint.known()
+    endpoint.investigation_time = investigation_time
+    endpoint.mark_dirty()
+    return endpoint
+
+
+def test_investigation_queue_priority():
+    endpoints = EndpointRegistry()
+    investigations = InvestigationQueue(confidence_secs=100)
+    stale = _endpoint('stale', 1000, confidence=0.9)
+    recent = _endpoint('recent', 1050)
+    unsure = _endpoint('unsure', 1020, confidence=0.1)
+    new = _endpoint('new', 0)
+    for endpoint in (stale, recent, unsure, new):
+        endpoints[endpoint.name] = endpoint
+    investigations.sync(endpoints)
+    assert investigations.top('known', 4) == [new, unsure, recent, stale]
+    # top() doesn't consume endpoints until their state changes.
+    assert investigations.top('known', 2) == [new, unsure]
+    assert investigations.top('queued', 2) == []
+
+    new.operate()
+    unsure.queue_next('operate')
+    investigations.sync(endpoints)
+    assert len(investigations) == 3
+    assert investigations.top('known', 4) == [recent, stale]
+    assert investigations.top('queued', 1) == [unsure]
+    assert investigations.top(
+        'queued', 1, requested=True) == [unsure]
+    assert investigations.top(
+        'queued', 1, requested=False) == []
+    idle = _endpoint('idle', 1010)
+    idle.queue_next('operate')
+    idle.p_next_state = None
+    endpoints[idle.name] = idle
+    investigations.sync(endpoints)
+    assert investigations.top('queued', 1, requested=True) == [unsure]
+    assert investigations.top('queued', 1, requested=False) == [idle]
+    assert investigations.top('queued', 2) == [idle, unsure]
+    del endpoints[idle.name]
+
+    stale.ignore = True
+    del endpoints[recent.name]
+    investigations.sync(endpoints)
+    assert investigations.top('known', 4) == []
+
+    new.known()
+    assert new.investigation_time
+    investigations.sync(endpoints)
+    assert investigations.top('known', 4) == [new]
+    assert InvestigationQueue.investigation_ages(
+        [new, unsure], now=new.investigation_time + 10) == [
+            10, new.investigation_time + 10 - 1020]
+
+
+def test_investigation_queue_resync():
+    investigations = InvestigationQueue()
+    endpoints = EndpointRegistry()
+    endpoint = _endpoint('foo', 0)
+    endpoints[endpoint.name] = endpoint
+    investigations.sync(endpoints)
+    assert investigations.top('known', 1) == [endpoint]
+    other_endpoints = EndpointRegistry()
+    investigations.sync(other_endpoints)
+    assert investigations.top('known', 1) == []
+    investigations.reset(confidence_secs=10)
+    investigations.sync(other_endpoints)
+    assert investigations.confidence_secs == 10
@@ -7,9 +7,13 @@ Created on 28 June 2016
 """
 import json
 import logging
+import os
 import queue
+import threading
 import time
+from functools import partial
 
+import pika
 import schedule
 from faucetconfgetsetter import FaucetLocalConfGetSetter
 from faucetconfgetsetter import get_sdn_connect
@@ -18,10 +22,16 @@ from poseidon_core.constants import NO_DATA
 from poseidon_core.controllers.sdnconnect import SDNConnect
 from poseidon_core.controllers.sdnevents import SDNEvents
 from poseidon_core.helpers.config import Config
+from poseidon_core.helpers.config import ConfigWatcher
 from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.helpers.investigations import InvestigationQueue
 from poseidon_core.helpers.metadata import DNSResolver
+from poseidon_core.helpers.metadata import get_ether_vendor
+from poseidon_core.helpers.metadata import OUIIndex
 from poseidon_core.helpers.prometheus import Prometheus
+from poseidon_core.helpers.rabbit import AsyncRabbit
 from poseidon_core.helpers.rabbit import Rabbit
+from poseidon_core.helpers.rabbit import RabbitPublisher
 from poseidon_core.operations.monitor import Monitor
 from prometheus_client import REGISTRY
 
@@ -32,6 +42,25 @@ prom = Prometheus()
 prom.initialize_metrics()
 
 
+def test_get_ether_vendor(tmp_path):
+    lookup_path = str(tmp_path / 'prefixes.txt')
+    with open(lookup_path, 'w') as f:
+        f.write('# comment\n0E0000\tFoo Inc\n0E00001\tBar\n0E0000AB2\tBaz\n')
+    assert get_ether_vendor('0e:00:00:00:00:01', lookup_path) == 'Foo'
+    assert get_ether_vendor('0e:00:00:10:00:01', lookup_path) == 'Bar'
+    assert get_ether_vendor('0e:00:00:ab:20:01', lookup_path) == 'Baz'
+    assert get_ether_vendor('0e:00:01:00:00:01', lookup_path) is None
+    assert get_ether_vendor('0e:00:00:00:00:01', str(tmp_path / 'missing')) == NO_DATA
+
+    oui_index = OUIIndex(lookup_path)
+    assert oui_index.vendor('0e:00:01:00:00:01') is None
+    with open(lookup_path, 'a') as f:
+        f.write('0E0001\tQux\n')
+    os.utime(lookup_path, ns=(0, 0))
+    oui_index.last_check = None
+    assert oui_index.vendor('0e:00:01:00:00:01') == 'Qux'
+
+
 def test_rdns():
     resolver = DNSResolver()
     for _ in range(3):
@@ -40,6 +69,51 @@ def test_rdns():
             assert name != NO_DATA
 
 
+def test_rdns_cache():
+    lookups = []
+    release = threading.Event()
+
+    def resolve_ip(ip):
+        lookups.append(ip)
+        if ip == '10.0.0.3':
+            release.wait(5)
+        return {'10.0.0.1': 'foo', '10.0.0.3': 'slow'}.get(ip, NO_DATA)
+
+    completed = threading.Event()
+    resolver = DNSResolver(timeout=1, cache_size=2, on_resolved=completed.set)
+    resolver._resolve_ip = resolve_ip
+    assert resolver.resolve_ips(['10.0.0.1', '10.0.0.2']) == {
+        '10.0.0.1': 'foo', '10.0.0.2': NO_DATA}
+    # cached, including the negative result.
+    assert resolver.resolve_ips(['10.0.0.1', '10.0.0.2']) == {
+        '10.0.0.1': 'foo', '10.0.0.2': NO_DATA}
+    assert sorted(lookups) == ['10.0.0.1', '10.0.0.2']
+    assert resolver.pop_resolved() == {}
+    # a slow lookup times out, and its result is available later.
+    completed.clear()
+    assert resolver.resolve_ips(['10.0.0.3'], timeout=0.1) == {'10.0.0.3': NO_DATA}
+    assert not completed.is_set()
+    release.set()
+    assert completed.wait(5)
+    resolver.executor.shutdown(wait=True)
+    assert resolver.pop_resolved() == {'10.0.0.3': 'slow'}
+    assert len(resolver.cache) == 2
+    assert resolver.resolve_ips(['10.0.0.3']) == {'10.0.0.3': 'slow'}
+
+
+def test_update_rdns():
+    s = get_sdn_connect(logger)
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1',
+        'ipv4': '10.0.0.1', 'ipv4_rdns': NO_DATA}
+    s.endpoints[endpoint.name] = endpoint
+    s.dns_resolver.resolved = {'10.0.0.1': 'foo.example.com'}
+    assert s.update_rdns() == 1
+    assert endpoint.endpoint_data['ipv4_rdns'] == 'foo.example.com'
+    assert s.update_rdns() == 0
+
+
 def test_mirror_endpoint():
     s = get_sdn_connect(logger)
     endpoint = endpoint_factory('foo')
@@ -143,79 +217,209 @@ def test_get_q_item():
     assert (True, 'Item') == sdne.get_q_item(m_queue)
 
 
-def test_format_rabbit_message():
+def test_wait_for_work():
+
+    class MockScheduler:
+
+        def __init__(self, job_queue):
+            self.job_queue = job_queue
+
+        def idle_seconds(self):
+            return -1
+
+        def run_pending(self):
+            self.job_queue.put('job')
+
+    sdne = SDNEvents(logger, prom, get_sdn_connect(logger))
+    sdne.batching_window = 0
+    sdne.m_queue.put(('foo', {}))
+    start = time.time()
+    sdne.wait_for_work()
+    assert time.time() - start < 1
+    assert not sdne.wakeup.is_set()
+
+    # overdue scheduled jobs don't wait.
+    sdne.wait_for_work(MockScheduler(sdne.job_queue))
+    assert sdne.get_q_item(sdne.job_queue) == (True, 'job')
+    assert not sdne.wakeup.is_set()
+
+
+def test_format_rabbit_messages():
     sdne = SDNEvents(logger, prom, get_sdn_connect(logger))
     faucet_event = []
     remove_list = []
 
     data = {'id': '', 'type': 'metadata', 'file_path': '/files/foo.pcap', 'data': {'10.0.2.15': {'full_os': 'Windows NT kernel', 'short_os': 'Windows',
                                                                                                  'link': 'Ethernet or modem', 'raw_mtu': '1500', 'mac': '08:00:27:cc:3f:1b'}, 'results': {'tool': 'p0f', 'version': '0.11.17'}}}
-    message = ('poseidon.algos.decider', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert not retval
-    assert msg_valid
-
-    data = {'id': '', 'type': 'metadata', 'file_path': '/files/foo', 'data': {'6b33db53faf33c77d694ecab2e3fefadc7dacc70': {'valid': True, 'pcap_labels': None, 'decisions': {'investigate': False}, 'classification': {'labels': ['Administrator workstation', 'Developer workstation', 'Active Directory controller'], 'confidences': [
+    data2 = {'id': '', 'type': 'metadata', 'file_path': '/files/foo', 'data': {'6b33db53faf33c77d694ecab2e3fefadc7dacc70': {'valid': True, 'pcap_labels': None, 'decisions': {'investigate': False}, 'classification': {'labels': ['Administrator workstation', 'Developer workstation', 'Active Directory controller'], 'confidences': [
         0.9955250173194201, 0.004474982679786006, 7.939512151303659e-13]}, 'timestamp': 1608179739.839953, 'source_ip': '208.50.77.134', 'source_mac': '00:1a:8c:15:f9:80'}, 'pcap': 'trace_foo.pcap'}, 'results': {'tool': 'networkml', 'version': '0.6.7.dev4'}}
-    message = ('poseidon.algos.decider', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert not retval
-    assert msg_valid
-
-    data = dict({'Key1': 'Val1'})
-    message = ('FAUCET.Event', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {'Key1': 'Val1'}
-    assert msg_valid
-    assert faucet_event == [{'Key1': 'Val1'}]
-
-    message = (None, data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert not msg_valid
+    assert sdne.format_rabbit_messages(
+        'poseidon.algos.decider', [data, data2], faucet_event, remove_list)
+
+    # FAUCET events are all handled together, later.
+    assert sdne.format_rabbit_messages(
+        'FAUCET.Event', [{'Key1': 'Val1'}, {'Key2': 'Val2'}], faucet_event, remove_list)
+    assert faucet_event == [{'Key1': 'Val1'}, {'Key2': 'Val2'}]
+
+    assert not sdne.format_rabbit_messages(
+        None, [{'Key1': 'Val1'}], faucet_event, remove_list)
 
     data = dict({'foo': 'bar'})
-    message = ('poseidon.action.ignore', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert msg_valid
-
-    message = ('poseidon.action.clear.ignored', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert msg_valid
-
-    message = ('poseidon.action.remove', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert msg_valid
-
-    message = ('poseidon.action.remove.ignored', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert msg_valid
+    for routing_key in (
+            'poseidon.action.ignore', 'poseidon.action.clear.ignored',
+            'poseidon.action.remove.ignored'):
+        assert sdne.format_rabbit_messages(
+            routing_key, [data], faucet_event, remove_list)
+
+    assert sdne.format_rabbit_messages(
+        'poseidon.action.remove', [['foo'], ['bar']], faucet_event, remove_list)
+    assert remove_list == ['foo', 'bar']
 
     ip_data = dict({'10.0.0.1': ['rule1']})
-    message = ('poseidon.action.update_acls', ip_data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert msg_valid
+    assert sdne.format_rabbit_messages(
+        'poseidon.action.update_acls', [ip_data], faucet_event, remove_list)
 
     data = [('foo', 'unknown')]
-    message = ('poseidon.action.change', data)
-    retval, msg_valid = sdne.format_rabbit_message(
-        message, faucet_event, remove_list)
-    assert retval == {}
-    assert msg_valid
+    assert sdne.format_rabbit_messages(
+        'poseidon.action.change', [data], faucet_event, remove_list)
+
+
+def test_handle_rabbit():
+    sdne = SDNEvents(logger, prom, get_sdn_connect(logger))
+    handled = []
+
+    def handler(my_objs, _faucet_event, _remove_list):
+        handled.append(my_objs)
+
+    sdne.rabbit_handlers['poseidon.action.ignore'] = (handler, 'handler')
+    for i in range(3):
+        sdne.m_queue.put(('FAUCET.Event', {'event': i}))
+    sdne.m_queue.put(('poseidon.action.ignore', ['foo']))
+    sdne.m_queue.put(('poseidon.action.remove', ['foo']))
+    sdne.m_queue.put((None, {}))
+    events, faucet_event, remove_list = sdne.handle_rabbit()
+    assert events == 6
+    assert faucet_event == [{'event': i} for i in range(3)]
+    assert handled == [[['foo']]]
+    assert remove_list == ['foo']
+    assert sdne.get_q_items(sdne.m_queue, 10) == []
+
+
+def test_async_rabbit_dispatch():
+    import asyncio
+
+    class MockChannel:
+        acks = []
+
+        def basic_ack(self, delivery_tag, multiple=False):
+            self.acks.append((delivery_tag, multiple))
+
+    class MockMethod:
+        def __init__(self, delivery_tag, routing_key):
+            self.delivery_tag = delivery_tag
+            self.routing_key = routing_key
+
+    sdne = SDNEvents(logger, prom, get_sdn_connect(logger))
+    rabbit = AsyncRabbit(prefetch_count=10)
+    rabbit.channel = MockChannel()
+
+    async def dispatch():
+        rabbit.messages = asyncio.Queue()
+        for i in range(1, 4):
+            rabbit.on_message(rabbit.channel, MockMethod(
+                i, 'poseidon.action.ignore'), None, json.dumps(['foo%u' % i]))
+        rabbit.on_message(rabbit.channel, MockMethod(
+            4, 'poseidon.action.ignore'), None, '{bad json')
+        dispatcher = asyncio.ensure_future(
+            rabbit.dispatch(partial(sdne.rabbit_messages, q=sdne.m_queue)))
+        await asyncio.sleep(0.1)
+        dispatcher.cancel()
+
+    asyncio.run(dispatch())
+    assert rabbit.channel.acks == [(4, True)]
+    assert sdne.get_q_items(sdne.m_queue, 10) == [
+        ('poseidon.action.ignore', ['foo%u' % i]) for i in range(1, 4)]
+
+
+def test_rabbit_publisher():
+
+    class MockChannel:
+        is_open = True
+
+        def __init__(self, fail_after):
+            self.fail_after = fail_after
+            self.published = []
+
+        def confirm_delivery(self):
+            return
+
+        def exchange_declare(self, exchange, exchange_type):
+            return
+
+        def basic_publish(self, exchange, routing_key, body):
+            if len(self.published) == self.fail_after:
+                raise pika.exceptions.StreamLostError('lost')
+            self.published.append((routing_key, body))
+
+    class MockConnection:
+        is_open = True
+
+        def __init__(self, channel):
+            self._channel = channel
+            self.closed = False
+            self.events = 0
+
+        def channel(self):
+            return self._channel
+
+        def close(self):
+            self.closed = True
+
+        def process_data_events(self, time_limit=None):
+            self.events += 1
+
+    publisher = RabbitPublisher('foo', 'bar', backoff=0)
+    channels = [MockChannel(1), MockChannel(None)]
+    connections = []
+
+    def mock_connect():
+        connection = MockConnection(channels.pop(0))
+        connections.append(connection)
+        publisher.connection = connection
+        publisher.channel = connection.channel()
+        publisher.channel.confirm_delivery()
+
+    publisher._connect = mock_connect
+    messages = [('poseidon.action.ignore', str(i)) for i in range(3)]
+    assert publisher.publish_batch(messages)
+    # the first message isn't resent after reconnecting.
+    assert connections[0].closed
+    assert connections[0].channel().published == messages[:1]
+    assert connections[1].channel().published == messages[1:]
+    # the connection is reused for later publishes.
+    assert publisher.publish('poseidon.action.remove', 'baz')
+    assert len(connections) == 2
+    assert connections[1].channel().published[-1] == ('poseidon.action.remove', 'baz')
+
+    # background publishes don't wait, and heartbeats are serviced while idle.
+    publisher.heartbeat_secs = 0.01
+    assert publisher.publish_batch_background([('poseidon.action.remove', 'qux')])
+    for _ in range(100):
+        if connections[1].events:
+            break
+        time.sleep(0.01)
+    assert connections[1].channel().published[-1] == ('poseidon.action.remove', 'qux')
+    assert connections[1].events
+    publisher.pending = queue.Queue(maxsize=1)
+    publisher.pending.put([])
+    assert not publisher.publish_batch_background([('poseidon.action.remove', 'qux')])
+
+    def failed_connect():
+        raise pika.exceptions.AMQPConnectionError('down')
+
+    publisher.close()
+    publisher._connect = failed_connect
+    assert not publisher.publish('poseidon.action.remove', 'baz')
 
 
 def test_rabbit_callback():
@@ -281,6 +485,101 @@ def test_find_new_machines():
     s.find_new_machines(machines)
 
 
+def test_find_changed_machines():
+    s = get_sdn_connect(logger)
+    machine = {'tenant': 'vlan1', 'port': 1, 'segment': 'switch1',
+               'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:00'}
+    s.find_new_machines([dict(machine)])
+    endpoint = list(s.endpoints.values())[0]
+    s.endpoints.pop_dirty_fields('test')
+    s.find_new_machines([dict(machine)])
+    assert s.endpoints.pop_dirty_fields('test') == {
+        endpoint.name: (endpoint, {'observed_time'})}
+    s.find_new_machines([dict(machine, port=2)])
+    assert s.endpoints.pop_dirty_fields('test') == {
+        endpoint.name: (endpoint, {'observed_time', 'endpoint_data.port'})}
+    assert endpoint.endpoint_data['port'] == 2
+
+
+def test_acl_endpoints():
+    s = get_sdn_connect(logger)
+    s.config['RULES_FILE'] = 'config/rules.yaml'
+    for name, port in (('foo', '1'), ('bar', '2')):
+        endpoint = endpoint_factory(name)
+        endpoint.endpoint_data = {
+            'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': port}
+        s.endpoints[endpoint.name] = endpoint
+    assert len(s.acl_endpoints()) == 2
+    assert s.acl_endpoints() == []
+    s.endpoints['foo'].metadata = {'ipv4_addresses': {}}
+    assert s.acl_endpoints() == [s.endpoints['foo']]
+    # fields the rules don't depend on don't need ACLs re-evaluated.
+    s.endpoints['foo'].touch()
+    s.endpoints['bar'].set_endpoint_data(
+        dict(s.endpoints['bar'].endpoint_data, ether_vendor='foo'))
+    assert s.acl_endpoints() == []
+    s.endpoints['bar'].set_endpoint_data(
+        dict(s.endpoints['bar'].endpoint_data, port='3'))
+    assert s.acl_endpoints() == [s.endpoints['bar']]
+    # a changed rules file re-evaluates all endpoints.
+    s.acl_rules_mtime = None
+    assert len(s.acl_endpoints()) == 2
+
+
+def test_config_watcher(tmp_path, monkeypatch):
+    config_path = str(tmp_path / 'poseidon.config')
+    with open('config/poseidon.config') as f:
+        config_text = f.read()
+    with open(config_path, 'w') as f:
+        f.write(config_text)
+    monkeypatch.setenv('POSEIDON_CONFIG', config_path)
+    snapshot = Config().get_snapshot()
+    assert Config().get_snapshot() is snapshot
+    config = Config().get_config()
+    config['scan_frequency'] = 1
+    assert snapshot['scan_frequency'] == 5
+
+    watcher = ConfigWatcher()
+    updates = []
+    watcher.subscribe(lambda snapshot, changed: updates.append(changed))
+    sdnc = SDNConnect(
+        config, logger, prom, faucetconfgetsetter_cl=FaucetLocalConfGetSetter)
+    monitor = Monitor(logger, config, schedule, queue.Queue(), sdnc, prom)
+    watcher.subscribe(monitor.update_config)
+    jobs = list(monitor.jobs)
+    assert watcher.check() == set()
+
+    with open(config_path, 'w') as f:
+        f.write(config_text.replace('scan_frequency = 5', 'scan_frequency = 7'))
+    os.utime(config_path, ns=(0, 0))
+    assert watcher.check() == {'scan_frequency'}
+    assert updates == [{'scan_frequency'}]
+    assert config['scan_frequency'] == 7
+    assert monitor.jobs[0].interval == 7
+    for job in jobs:
+        assert job not in schedule.jobs
+
+    # Monitor config doesn't need a new controller proxy.
+    watcher.subscribe(sdnc.update_config)
+    proxy = sdnc.sdnc
+    proxy.mirror_counts[('switch1', 1)] = 1
+    proxy.mac_table['00:00:00:00:00:01'] = [{'port': 1}]
+    with open(config_path, 'w') as f:
+        f.write(config_text.replace('scan_frequency = 5', 'scan_frequency = 7').replace(
+            'reinvestigation_frequency = 900', 'reinvestigation_frequency = 60'))
+    os.utime(config_path, ns=(1, 1))
+    assert watcher.check() == {'reinvestigation_frequency'}
+    assert sdnc.sdnc is proxy
+    assert proxy.reinvestigation_frequency == 60
+    # a new proxy keeps track of existing mirrors.
+    sdnc.get_sdn_context()
+    assert sdnc.sdnc is not proxy
+    assert sdnc.sdnc.mirror_counts[('switch1', 1)] == 1
+    assert sdnc.sdnc.mac_table == proxy.mac_table
+    for job in monitor.jobs:
+        schedule.cancel_job(job)
+
+
 def test_Monitor_init():
     config = get_test_config()
     sdnc = SDNConnect(
@@ -323,6 +622,7 @@ def test_process():
             self.sdnc.get_sdn_context()
             self.job_queue = queue.Queue()
             self.prom = prom
+            self.investigation_queue = InvestigationQueue()
             endpoint = endpoint_factory('foo')
             endpoint.endpoint_data = {
                 'active': 0, 'ipv4_subnet': '12.12.12.12/24', 'ipv6_subnet': '', 'ipv4_rdns': '', 'ipv6_rdns': '', 'controller_type': 'faucet', 'controller': '', 'name': '', 'ipv4': '12.12.12.12', 'ipv6': '', 'ether_vendor': 'foo', 'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
@@ -351,9 +651,6 @@ def test_process():
                 return (True, ('foo', {'data': {}}))
             return (False, None)
 
-        def format_rabbit_message(self, item, faucet_event, remove_list):
-            return ({'data': {}}, False)
-
     mock_monitor = MockMonitor()
 
     assert mock_monitor.sdnc.investigation_budget()
@@ -3,7 +3,11 @@
 Test module for prometheus
 @author: Charlie Lewis
 """
+from poseidon_core.constants import NO_DATA
+from poseidon_core.helpers.endpoint import endpoint_factory
 from poseidon_core.helpers.prometheus import Prometheus
+from poseidon_core.helpers.registry import EndpointRegistry
+from prometheus_client import REGISTRY
 
 
 def test_Prometheus():
@@ -38,3 +42,126 @@ def test_decode_endpoints():
                      'GPU laptop', 'Developer workstation')
     assert confidences == (1.0, 0.0006269307506632729, 0.000399485844886532)
     assert pcap_labels == 'foo'
+
+
+def _initialized_prometheus():
+    # prometheus keeps a global registry, start with a clean one.
+    for collector, _ in tuple(REGISTRY._collector_to_names.items()):
+        REGISTRY.unregister(collector)
+    p = Prometheus()
+    p.initialize_metrics()
+    return p
+
+
+def _sample_endpoint(name):
+    endpoint = endpoint_factory(name)
+    endpoint.endpoint_data = {
+        'mac': '00:00:00:00:00:01', 'name': None, 'tenant': 'VLAN100',
+        'segment': 'switch1', 'port': '1', 'ether_vendor': 'foo',
+        'controller': '', 'controller_type': 'faucet',
+        'ipv4': '10.0.0.1', 'ipv6': '', 'ipv4_subnet': '10.0.0.0/24',
+        'ipv6_subnet': NO_DATA, 'ipv4_rdns': NO_DATA, 'ipv6_rdns': NO_DATA}
+    return endpoint
+
+
+def _state_series(hash_id):
+    return [
+        sample.labels['state']
+        for metric in REGISTRY.collect() if metric.name == 'poseidon_endpoint_state'
+        for sample in metric.samples if sample.labels['hash_id'] == hash_id]
+
+
+def test_update_endpoint_metadata_dirty():
+    p = _initialized_prometheus()
+    endpoints = EndpointRegistry()
+    endpoint = _sample_endpoint('foo')
+    endpoints[endpoint.name] = endpoint
+    p.update_endpoint_metadata(endpoints)
+    assert _state_series('foo') == ['unknown']
+    assert not endpoints.pop_dirty('prometheus')
+
+    endpoint.operate()
+    endpoint.touch()
+    assert endpoints.pop_dirty_fields('prometheus') == {
+        'foo': (endpoint, {'state', 'observed_time'})}
+    endpoint.mark_dirty()
+    p.update_endpoint_metadata(endpoints)
+    # superseded label set was removed.
+    assert _state_series('foo') == ['operating']
+    assert not endpoints.pop_dirty('prometheus')
+
+    # only the observed time changed, so the exported series are reused.
+    p.update_endpoint = None
+    endpoint.touch()
+    p.update_endpoint_metadata(endpoints)
+    assert _state_series('foo') == ['operating']
+
+
+def _series_count(metric_name):
+    for metric in REGISTRY.collect():
+        if metric.name == 'poseidon_metric_series':
+            for sample in metric.samples:
+                if sample.labels['metric'] == metric_name:
+                    return sample.value
+    return None
+
+
+def test_remove_endpoint_series():
+    p = _initialized_prometheus()
+    endpoints = EndpointRegistry()
+    for name in ('foo', 'bar'):
+        endpoint = _sample_endpoint(name)
+        endpoints[endpoint.name] = endpoint
+    p.update_endpoint_metadata(endpoints)
+    assert _series_count('poseidon_endpoint_state') == 2
+
+    del endpoints['foo']
+    p.update_endpoint_metadata(endpoints)
+    assert _state_series('foo') == []
+    assert _state_series('bar') == ['unknown']
+    assert _series_count('poseidon_endpoint_state') == 1
+
+    # series missing a label aren't exported.
+    p._set_endpoint_prom('endpoint_state', 'foo', 1, {'state': 'unknown'})
+    assert _state_series('foo') == []
+
+
+def test_update_metrics_stale_labels():
+    p = _initialized_prometheus()
+    host = {'role': 'foo', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1',
+            'port': 1, 'segment': 'switch1', 'ipv4': '10.0.0.1', 'mac': '00:00:00:00:00:00', 'id': 'foo1'}
+    p.update_metrics([host])
+    assert _series_count('poseidon_endpoint_roles') == 1
+    p.update_metrics([dict(host, role='bar', ipv4='')])
+    assert _series_count('poseidon_endpoint_roles') == 1
+    assert _series_count('poseidon_endpoint_ip_table') == 0
+
+
+def test_update_faucet_config_metrics():
+    p = _initialized_prometheus()
+    p.update_faucet_config_metrics({'hit': 3, 'miss': 1, 'refresh': 0})
+    p.update_faucet_config_metrics({'hit': 2})
+    assert REGISTRY.get_sample_value(
+        'poseidon_faucet_config_cache_total', {'result': 'hit'}) == 5
+    assert REGISTRY.get_sample_value(
+        'poseidon_faucet_config_cache_total', {'result': 'miss'}) == 1
+
+
+def test_update_investigation_ages():
+    p = _initialized_prometheus()
+    p.update_investigation_ages([10, 7200], 1)
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoint_investigation_age_max_secs') == 7200
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoints_investigation_age', {'le': '3600'}) == 1
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoints_investigation_age', {'le': '21600'}) == 2
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoints_investigation_age', {'le': '+Inf'}) == 2
+    p.update_investigation_ages([15], 2)
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoint_investigation_age_max_secs') == 15
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoints_investigation_age', {'le': '21600'}) == 1
+    assert REGISTRY.get_sample_value(
+        'poseidon_endpoints_never_investigated') == 2
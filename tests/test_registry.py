@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the endpoint registry.
+"""
+from faucetconfgetsetter import get_test_endpoint
+from poseidon_core.helpers.registry import EndpointRegistry
+
+
+def test_registry_lookups():
+    endpoints = EndpointRegistry()
+    foo = get_test_endpoint('foo', '00:00:00:00:00:01', ipv4='10.0.0.1')
+    bar = get_test_endpoint('bar', '00:00:00:00:00:02', ipv6='1212::1')
+    endpoints[foo.name] = foo
+    endpoints[bar.name] = bar
+    assert endpoints.by_mac('00:00:00:00:00:01') == [foo]
+    assert endpoints.by_ip('10.0.0.1') == [foo]
+    assert endpoints.by_ip('1212::1') == [bar]
+    assert endpoints.by_ip('10.0.0.2') == []
+    assert endpoints.not_ignored('unknown') == [foo, bar]
+    assert endpoints.not_copro_ignored('copro_unknown') == [foo, bar]
+
+
+def test_registry_tracks_changes():
+    endpoints = EndpointRegistry()
+    foo = get_test_endpoint('foo', '00:00:00:00:00:01', ipv4='10.0.0.1')
+    endpoints[foo.name] = foo
+
+    foo.operate()
+    assert endpoints.not_ignored('unknown') == []
+    assert endpoints.not_ignored('operating') == [foo]
+    assert endpoints.count_not_ignored('operating') == 1
+
+    foo.copro_coprocess()
+    assert endpoints.count_not_ignored_copro('copro_coprocessing') == 1
+
+    foo.ignore = True
+    assert endpoints.ignored() == [foo]
+    assert endpoints.not_ignored() == []
+    assert endpoints.count_not_ignored('operating') == 0
+    assert endpoints.count_not_ignored_copro('copro_coprocessing') == 0
+    foo.ignore = False
+    assert endpoints.not_ignored('operating') == [foo]
+
+    new_data = dict(foo.endpoint_data)
+    new_data['ipv4'] = '10.0.0.2'
+    foo.endpoint_data = new_data
+    assert endpoints.by_ip('10.0.0.1') == []
+    assert endpoints.by_ip('10.0.0.2') == [foo]
+
+    del endpoints[foo.name]
+    assert endpoints.by_mac('00:00:00:00:00:01') == []
+    assert endpoints.not_ignored() == []
+    assert foo.registry is None
+
+
+def test_registry_dict_operations():
+    foo = get_test_endpoint('foo', '00:00:00:00:00:01')
+    bar = get_test_endpoint('bar', '00:00:00:00:00:01')
+    endpoints = EndpointRegistry({foo.name: foo})
+    endpoints.update({bar.name: bar})
+    assert endpoints.by_mac('00:00:00:00:00:01') == [foo, bar]
+    assert endpoints.pop('foo') == foo
+    assert endpoints.pop('foo', None) is None
+    assert endpoints.by_mac('00:00:00:00:00:01') == [bar]
+    endpoints.clear()
+    assert not endpoints
+    assert endpoints.by_mac('00:00:00:00:00:01') == []
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for the endpoint store.
+"""
+import logging
+import os
+import tempfile
+
+from faucetconfgetsetter import get_sdn_connect
+from faucetconfgetsetter import get_test_config
+from poseidon_core.helpers.endpoint import endpoint_factory
+from poseidon_core.helpers.store import EndpointStore
+from poseidon_core.helpers.store import get_endpoint_store
+from poseidon_core.helpers.store import SQLiteEndpointStore
+
+logger = logging.getLogger('test')
+
+
+def test_get_endpoint_store():
+    config = get_test_config()
+    assert type(get_endpoint_store(config)) == EndpointStore
+    config['endpoint_store_file'] = '/does/not/exist/endpoints.db'
+    assert type(get_endpoint_store(config)) == EndpointStore
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config['endpoint_store_file'] = os.path.join(tmpdir, 'endpoints.db')
+        store = get_endpoint_store(config)
+        assert isinstance(store, SQLiteEndpointStore)
+        store.close()
+
+
+def test_read_only_endpoint_store():
+    config = get_test_config()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config['endpoint_store_file'] = os.path.join(tmpdir, 'endpoints.db')
+        # a read only store isn't created.
+        assert type(get_endpoint_store(config, read_only=True)) == EndpointStore
+        assert not os.path.exists(config['endpoint_store_file'])
+        get_endpoint_store(config).close()
+        store = get_endpoint_store(config, read_only=True)
+        assert isinstance(store, SQLiteEndpointStore)
+        assert store.find(key='foo') == {}
+        store.close()
+
+
+def test_sqlite_endpoint_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SQLiteEndpointStore(os.path.join(tmpdir, 'endpoints.db'))
+        assert store.load() == {}
+        endpoint = endpoint_factory('foo')
+        endpoint.endpoint_data = {
+            'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
+        endpoint.ignore = True
+        endpoint.acl_data = [(('rule1', 'acl1', True), 1)]
+        store.put_endpoints([endpoint])
+        store.close()
+
+        store = SQLiteEndpointStore(os.path.join(tmpdir, 'endpoints.db'))
+        endpoints = store.load()
+        assert list(endpoints) == ['foo']
+        assert endpoints['foo'].ignore
+        assert endpoints['foo'].endpoint_data == endpoint.endpoint_data
+        assert endpoints['foo'].acl_data == [[['rule1', 'acl1', True], 1]]
+
+        # a read only store looks up only the endpoints asked for.
+        read_only_store = SQLiteEndpointStore(
+            os.path.join(tmpdir, 'endpoints.db'), read_only=True)
+        assert list(read_only_store.find(key='foo')) == ['foo']
+        assert list(read_only_store.find(key='00:00:00:00:00:00')) == ['foo']
+        assert read_only_store.find(key='bar') == {}
+        assert list(read_only_store.find(ignored=True)) == ['foo']
+        assert read_only_store.find(key='foo', ignored=False) == {}
+        read_only_store.put_endpoints([endpoint_factory('bar')])
+        assert list(store.load()) == ['foo']
+        read_only_store.close()
+        store.delete_endpoints(['foo'])
+        assert store.load() == {}
+        store.close()
+
+
+def test_sdnconnect_store_endpoints():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        s = get_sdn_connect(logger)
+        s.store = SQLiteEndpointStore(os.path.join(tmpdir, 'endpoints.db'))
+        for name in ('foo', 'bar'):
+            endpoint = endpoint_factory(name)
+            endpoint.endpoint_data = {
+                'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
+            s.endpoints[endpoint.name] = endpoint
+        s.store_endpoints()
+        s.endpoints['foo'].ignore = True
+        del s.endpoints['bar']
+        s.store_endpoints()
+
+        s.endpoints = {}
+        s.get_stored_endpoints()
+        assert list(s.endpoints) == ['foo']
+        assert s.ignored_endpoints() == [s.endpoints['foo']]
+        s.store.close()